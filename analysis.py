@@ -1,143 +1,365 @@
-from contextlib import redirect_stderr
 import pandas as pd
-import geopandas as gpd
-from sklearn.cluster import DBSCAN
 import numpy as np
 import sys, os
 sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
 import config as cfg
-from shapely import geometry, wkt
-import matplotlib.pyplot as plt
-import matplotlib.ticker as plticker
-import datetime
-import plotly.express as px
-import pandas as pd
+from storage import read_stage, read_polygons
+from profiling import profiled
+from preprocess import ship_time_order
+from polygon_index import PolygonIndex
+from reporting import HOURS, hour_matrix, draw_hour_plot, draw_gantt_chart, write_table, render_report
+
+DIMENSION_COLUMNS = ['length', 'beam', 'draft']
+# Aggregates of a labelled frame that can be merged over parts of the data and
+# give the table of cluster_results, see result_aggregates
+RESULT_AGGREGATES = {
+    'runs': {'sourcemmsi': 'int32', 'cluster': 'int32', 'start': 'int64', 'before_end': 'int64', 'end': 'int64', 'points': 'int64'},
+    'dimensions': {'cluster': 'int32', 'column': 'str', 'value': 'float32', 'count': 'int64'},
+    'drafts': {'cluster': 'int32', 'changes': 'int64', 'change_sum': 'float64'},
+}
+
+def label_points(lon, lat, polygons, ids, chunk_size=None, default=-999):
+    """
+    Return the id of the polygon each point falls in, or `default`. Points
+    are looked up in chunks of `chunk_size` (all at once when None). When a
+    point lies in several polygons, the polygon that comes last in
+    `polygons` wins.
+    """
+    return PolygonIndex(polygons, ids, default).lookup(lon, lat, chunk_size)
 
-# Parallelize with dask
-def add_clusters_to_data(gdf, polygons):
-    gdf['cluster'] = -999
-    for i, cluster in polygons[1:].iterrows():
-        geom = cluster.geometry
-        sindex = gdf.sindex
-        possible_matches_index = list(sindex.intersection(geom.bounds))
-        possible_matches = gdf.iloc[possible_matches_index]
-        precise_matches = possible_matches[possible_matches.intersects(geom)]
-        gdf.loc[precise_matches.index, 'cluster'] = cluster.anchorage_id
+@profiled
+def add_clusters_to_data(gdf, polygons, id_column=None, chunk_size=cfg.LABEL_CHUNK_SIZE):
+    labels = PolygonIndex.from_polygons(polygons, id_column).lookup(gdf.lon.values, gdf.lat.values, chunk_size)
+    gdf['cluster'] = labels.astype(np.int32)
     return gdf
 
+def visit_spans(arrays):
+    # Ship, cluster, start and end of every visit to a cluster
+    inside = arrays['cluster'] >= 0
+    visits, t = arrays['visit'][inside], arrays['t'][inside]
+    if len(visits) == 0:
+        return pd.DataFrame({'sourcemmsi': [], 'cluster': [], 'start': [], 'end': []})
+    starts = group_starts(visits)
+    return pd.DataFrame({'sourcemmsi': arrays['ship_ids'][arrays['ship'][inside][starts]], 'cluster': arrays['cluster'][inside][starts],
+                         'start': np.minimum.reduceat(t, starts), 'end': np.maximum.reduceat(t, starts)})
+
 def ship_visit_gantt_chart(gdf):
-    gdf.sort_values(['sourcemmsi', 't'], inplace=True)
-    stops = df_geo.groupby(['change_in_cluster'])
-    a,b,c  = stops.Date.min(), stops.Date.max(), stops.cluster.max()
-    stops_df = pd.DataFrame().from_dict({'cluster':c, 'date_min':a, 'date_max':b})
-    stops_df['berth_num'] = stops_df.index
-    fig = px.timeline(stops_df[stops_df.cluster>=0], x_start="date_min", x_end="date_max", y="cluster", color='berth_num')
-    fig.write_html(str(cfg.FILE_PREFIX + '_gantt.html'))
-
-# Parallellize?
+    draw_gantt_chart(visit_spans(analysis_arrays(gdf)), str(cfg.FILE_PREFIX + '_gantt.html'))
+
+def transition_hours(gdf):
+    """
+    Counts of the arrival and departure hours per cluster. Arrivals and
+    departures are taken from the ship and time ordered arrays, no flag
+    columns are added to `gdf`.
+    """
+    ships = pd.factorize(gdf.sourcemmsi, sort=True)[0]
+    order = ship_time_order(ships, gdf.t.values)
+    clusters, hours = gdf.cluster.values[order], gdf.hours.values[order]
+    enters, leaves = cluster_transitions(ships[order], clusters)
+    arrivals = pd.DataFrame({'cluster': clusters[enters], 'hours': hours[enters]}).groupby('cluster').hours.value_counts()
+    departures = pd.DataFrame({'cluster': clusters[leaves], 'hours': hours[leaves]}).groupby('cluster').hours.value_counts()
+    return arrivals, departures
+
+def transition_matrices(arrays):
+    # Cluster x hour matrices of the arrivals and departures, clusters without any are left out
+    enters, leaves = cluster_transitions(arrays['ship'], arrays['cluster'])
+    matrices = []
+    for flags in (enters, leaves):
+        matrix = np.zeros((len(arrays['cluster_ids']), HOURS), dtype=np.int64)
+        np.add.at(matrix, (arrays['group'][flags], arrays['hours'][flags].astype(np.int64)), 1)
+        seen = matrix.any(axis=1)
+        matrices.append(pd.DataFrame(matrix[seen], index=pd.Index(arrays['cluster_ids'][seen], name='cluster'),
+                                     columns=pd.RangeIndex(HOURS, name='hours')))
+    return matrices
+
+def draw_transition_plots(arrivals, departures):
+    draw_hour_plot(hour_matrix(arrivals), 'Arrival hours', str(cfg.FILE_PREFIX + '_arrival-plot.png'))
+    draw_hour_plot(hour_matrix(departures), 'Departure hours', str(cfg.FILE_PREFIX + '_departure-plot.png'))
+
+@profiled
 def arrival_departing_analysis(gdf):
-    gdf.sort_values(['sourcemmsi','t'], inplace=True)
-    gdf['enters_cluster'] = gdf.groupby('sourcemmsi').cluster.diff()>0
-    gdf['leaves_cluster'] = gdf.groupby('sourcemmsi').cluster.diff()<0
-    gdf['leaves_cluster'] = gdf.leaves_cluster.shift(-1).fillna(False)
-    gdf['change_in_cluster'] = (gdf['enters_cluster'] | gdf['leaves_cluster']).cumsum()
-    arrivals = gdf[gdf.enters_cluster].groupby('cluster').hours.value_counts()
-    departures = gdf[gdf.leaves_cluster].groupby('cluster').hours.value_counts()
-    draw_hour_plot(arrivals, 'Arrival hours', str(cfg.FILE_PREFIX + '_arrival-plot.png'))
-    draw_hour_plot(departures, 'Departure hours', str(cfg.FILE_PREFIX + '_departure-plot.png'))
+    draw_transition_plots(*transition_hours(gdf))
     return gdf
 
-def draw_hour_plot(hours, title, filename):
-    fig, ax = plt.subplots()
-    # clusters = [27,28,29, 8, 5, 10]
-    hours = hours.rename('count').reset_index()
-    #hours = hours[hours['cluster'].isin(clusters)]
-    loc = plticker.MultipleLocator(base=1.0)
-    ax.set_xlim(0,23)
-    ax.set_ylim(0,max(hours['count'])+1)
-    ax.set_ylabel('count')
-    ax.set_xlabel('hour')
-    ax.xaxis.set_major_locator(loc)
-    for cluster in hours.cluster.unique():
-        data = hours.loc[hours.cluster==cluster]
-        data.sort_values('hours', inplace=True)
-        line, = ax.plot(data.hours.values, data['count'].values)
-        line.set_label(str('Cluster ' + str(cluster)))
-    ax.set_title(title, size=32)
-    
-    box = ax.get_position()
-    #ax.set_position([box.x0 + box.width, box.y0 + box.height * 0.1,
-    #             box.width, box.height * 0.90])
-    lgd = ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.1),
-          fancybox=True, shadow=True, ncol=4)
-    plt.savefig(filename, bbox_extra_artists=(lgd,), bbox_inches='tight')
-    #plt.show()
-
-def ship_dimension_analysis(gdf):
-    clusters = gdf.groupby('cluster')
-    result_df = pd.DataFrame(columns=['max_length', 'max_beam', 'max_draft'])
-    result_df.max_length = clusters.length.quantile(0.995, interpolation='nearest')
-    result_df.max_beam = clusters.beam.quantile(0.995, interpolation='nearest')
-    result_df.max_draft = clusters.draft.quantile(0.995, interpolation='nearest')
-    return result_df
+def cluster_transitions(ships, clusters):
+    """
+    Flags of the points where a ship enters a cluster (the label goes up)
+    and of the last points before it leaves one (the next label goes down),
+    for arrays sorted by ship and time.
+    """
+    same_ship = np.r_[False, ships[1:] == ships[:-1]]
+    step = np.r_[0, np.diff(clusters)]
+    enters = same_ship & (step > 0)
+    leaves = np.r_[(same_ship & (step < 0))[1:], False]
+    return enters, leaves
 
-def draft_change_analysis(gdf):
-    gdf = gdf[gdf.draft!=0]
-    gdf['draft_change'] = gdf.sort_values(['sourcemmsi','t']).groupby('sourcemmsi').draft.diff()
-    gdf.draft_change.fillna(0, inplace=True)
-    draft_rows = gdf[gdf.draft_change!=0].groupby('cluster')
-    num_draft_change = draft_rows.size()
-    av_draft_change = draft_rows.draft_change.describe()['mean']
-    return num_draft_change, av_draft_change
-
-def ship_duration_analysis(gdf):
-    gdf.sort_values(['sourcemmsi','t'], inplace=True)
-    visits = gdf[gdf.cluster>-1].groupby('change_in_cluster')
-    times = visits.t.max()-visits.t.min()
-    times = times.apply(lambda x: datetime.timedelta(seconds=x))
-    clusters = visits.cluster.describe()['max']
-    visits_df = pd.DataFrame().from_dict({'time': times.values, 'cluster': clusters.values})
-    visits_df = visits_df[visits_df.time>datetime.timedelta(hours=12)]
-    return visits_df.groupby('cluster').time.mean()
+def visit_keys(ships, clusters):
+    # Visit number of every point, a new visit starts at every cluster transition
+    enters, leaves = cluster_transitions(ships, clusters)
+    return np.cumsum(enters | leaves)
 
-def ship_type_analysis(gdf):
-    ship_percentage = (gdf.groupby('cluster').shiptype.value_counts()/gdf.groupby('cluster').size()*100).drop(index=-999).reset_index(level=[1])
+def group_starts(keys):
+    # Index of the first element of every run of equal keys
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+def count_unique(groups, keys, n_groups):
+    # Number of distinct keys per group code
+    pairs = np.unique(keys.astype(np.int64) * n_groups + groups)
+    return np.bincount(pairs % n_groups, minlength=n_groups)
+
+def group_quantile(values, groups, n_groups, q):
+    # Per group quantile with pandas' 'nearest' interpolation, NaN skipped
+    valid = ~np.isnan(values)
+    values, groups = values[valid], groups[valid]
+    order = np.lexsort((values, groups))
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    position = q * (counts - 1)
+    below = np.floor(position)
+    frac = position - below
+    idx = below.astype(np.int64) + ((frac > .5) | ((frac == .5) & (q > .5)))
+    result = np.full(n_groups, np.nan)
+    has_values = counts > 0
+    result[has_values] = values[order][starts[has_values] + idx[has_values]]
+    return result
+
+def count_quantile(values, counts, q):
+    # group_quantile of one group given as distinct values and their counts
+    order = np.argsort(values)
+    position = q * (counts.sum() - 1)
+    below = np.floor(position)
+    frac = position - below
+    idx = int(below) + ((frac > .5) | ((frac == .5) & (q > .5)))
+    return values[order][np.searchsorted(np.cumsum(counts[order]), idx, side='right')]
+
+def ship_dimension_analysis(arrays, q=0.995):
+    # Near maximum length, beam and draft of the ships in every cluster
+    return pd.DataFrame({column: group_quantile(arrays[column], arrays['group'], len(arrays['cluster_ids']), q)
+                         for column in DIMENSION_COLUMNS}, index=arrays['cluster_ids'])
+
+def mean_duration(durations, clusters, min_duration=12*3600):
+    # Mean of the visit durations in seconds longer than min_duration per cluster
+    long_visits = durations > min_duration
+    # Built from timedelta objects like before, so the mean keeps the same resolution
+    durations = pd.Series(durations[long_visits].astype('timedelta64[s]').astype(object))
+    return durations.groupby(clusters[long_visits]).mean()
+
+def ship_duration_analysis(arrays, min_duration=12*3600):
+    # Mean duration of the visits longer than min_duration seconds per cluster
+    inside = arrays['cluster'] > -1
+    visits, t, clusters = arrays['visit'][inside], arrays['t'][inside], arrays['cluster'][inside]
+    if len(visits) == 0:
+        return pd.Series(dtype='timedelta64[ns]')
+    starts = group_starts(visits)
+    durations = np.maximum.reduceat(t, starts) - np.minimum.reduceat(t, starts)
+    return mean_duration(durations, np.maximum.reduceat(clusters, starts), min_duration)
+
+def draft_change_values(arrays, previous=None):
+    """
+    Draft changes between consecutive reports of a ship and the cluster of
+    the later report. `previous` holds the last reported draft of ships
+    in earlier data by MMSI; without it the first report of a ship is no
+    change.
+    """
+    reported = arrays['draft'] != 0
+    ships, draft, clusters = arrays['ship'][reported], arrays['draft'][reported], arrays['cluster'][reported]
+    change = np.zeros_like(draft)
+    change[1:] = np.diff(draft)
+    first = np.r_[True, ships[1:] != ships[:-1]] if len(ships) else np.zeros(0, dtype=bool)
+    change[first] = 0 if previous is None else draft[first] - previous.reindex(arrays['ship_ids'][ships[first]]).values
+    change[np.isnan(change)] = 0
+    changed = change != 0
+    return change[changed], clusters[changed]
+
+def draft_change_analysis(arrays):
+    # Number and mean size of the draft changes between consecutive reports of a ship
+    change, clusters = draft_change_values(arrays)
+    changes = pd.Series(change.astype(np.float64)).groupby(clusters)
+    return changes.size(), changes.mean()
+
+def analysis_arrays(gdf):
+    """
+    The columns used by the analysis as arrays sorted once by ship and time,
+    with ship, cluster and visit codes. Clusters are coded in sorted order,
+    `group` indexes `cluster_ids`.
+    """
+    ships, ship_ids = pd.factorize(gdf.sourcemmsi, sort=True)
+    order = ship_time_order(ships, gdf.t.values)
+    arrays = {'ship': ships[order], 'ship_ids': np.asarray(ship_ids), 't': gdf.t.values[order], 'cluster': gdf.cluster.values[order]}
+    for column in DIMENSION_COLUMNS:
+        arrays[column] = gdf[column].values[order] if column in gdf else np.full(len(order), np.nan, dtype=np.float32)
+    if 'hours' in gdf:
+        arrays['hours'] = gdf.hours.values[order]
+    if 'shiptype' in gdf:
+        arrays['shiptype'] = gdf.shiptype.values.take(order)
+    arrays['group'], arrays['cluster_ids'] = pd.factorize(arrays['cluster'], sort=True)
+    arrays['visit'] = visit_keys(arrays['ship'], arrays['cluster'])
+    return arrays
+
+def ship_type_counts(gdf):
+    # Points per cluster and ship type, and points per cluster
+    counts = gdf.groupby('cluster').shiptype.value_counts()
+    # Ship types are categorical, leave out the types not seen in a cluster
+    return counts[counts > 0], gdf.groupby('cluster').size()
+
+def ship_type_table(counts, sizes):
+    # Share of the points of every ship type per cluster in percent
+    ship_percentage = (counts/sizes*100).drop(index=-999, errors='ignore').reset_index(level=[1])
     ship_percentage.rename(columns= {0:'percentage'},inplace=True)
-    ship_percentage.to_html('ship_types.html')
+    return ship_percentage
 
-def analysis_dataframe(gdf):
-    dimensions = ship_dimension_analysis(gdf)
-    duration = ship_duration_analysis(gdf)
-    num_draft_change, av_draft_change = draft_change_analysis(gdf)
-    result_df = pd.DataFrame()
-    result_df['Unique ships'] = gdf.groupby('cluster').sourcemmsi.nunique()
-    result_df['Number of visits'] = gdf.groupby('cluster').change_in_cluster.nunique()
-    result_df[['Max length', 'Max beam', 'Max draft']] = dimensions
-    result_df['Median time in cluster'] =  duration
+def write_ship_types(counts, sizes):
+    write_table(ship_type_table(counts, sizes), str(cfg.FILE_PREFIX + '_ship_types.html'))
+
+@profiled
+def ship_type_analysis(gdf):
+    write_ship_types(*ship_type_counts(gdf))
+
+def cluster_results(arrays):
+    groups, n_groups = arrays['group'], len(arrays['cluster_ids'])
+    num_draft_change, av_draft_change = draft_change_analysis(arrays)
+    result_df = pd.DataFrame(index=pd.Index(arrays['cluster_ids'], name='cluster'))
+    result_df['Unique ships'] = count_unique(groups, arrays['ship'], n_groups)
+    result_df['Number of visits'] = count_unique(groups, arrays['visit'], n_groups)
+    result_df[['Max length', 'Max beam', 'Max draft']] = ship_dimension_analysis(arrays).values
+    result_df['Median time in cluster'] = ship_duration_analysis(arrays)
     result_df['Number of draft changes'] = num_draft_change
     result_df['Average draft change'] = av_draft_change
-    result_df.to_html(str(cfg.FILE_PREFIX + '_results.html'))
+    return result_df
+
+def empty_aggregates():
+    return {name: pd.DataFrame({c: pd.Series(dtype=d) for c, d in dtypes.items()}) for name, dtypes in RESULT_AGGREGATES.items()}
+
+def visit_runs(arrays):
+    """
+    Runs of consecutive points of a ship with the same cluster label (the
+    points outside the clusters included), with their first, second to
+    last and last time and number of points. The visits of cluster_results
+    follow from the runs and their order.
+    """
+    ships, clusters, t = arrays['ship'], arrays['cluster'], arrays['t'].astype(np.int64)
+    if len(ships) == 0:
+        return empty_aggregates()['runs']
+    starts = np.flatnonzero(np.r_[True, (ships[1:] != ships[:-1]) | (clusters[1:] != clusters[:-1])])
+    lasts = np.r_[starts[1:], len(ships)] - 1
+    runs = pd.DataFrame({'sourcemmsi': arrays['ship_ids'][ships[starts]], 'cluster': clusters[starts], 'start': t[starts],
+                         'before_end': t[np.maximum(lasts - 1, starts)], 'end': t[lasts], 'points': lasts - starts + 1})
+    return runs.astype(RESULT_AGGREGATES['runs'])
+
+def result_aggregates(arrays, previous_drafts=None):
+    """
+    Aggregates of the analysis arrays of a part of the data that are merged
+    with merge_result_aggregates and turned into the cluster_results table
+    with aggregate_results: the visit runs, the point counts of every
+    dimension value and the number and sum of the draft changes per
+    cluster. `previous_drafts` is passed to draft_change_values.
+    """
+    dimensions = []
+    for column in DIMENSION_COLUMNS:
+        counts = pd.DataFrame({'cluster': arrays['cluster'], 'value': arrays[column]}).value_counts(sort=False)
+        dimensions.append(counts.rename('count').reset_index().assign(column=column))
+    change, clusters = draft_change_values(arrays, previous_drafts)
+    changes = pd.Series(change.astype(np.float64)).groupby(clusters)
+    drafts = pd.DataFrame({'changes': changes.size(), 'change_sum': changes.sum()}).rename_axis('cluster').reset_index()
+    aggregates = {'runs': visit_runs(arrays), 'dimensions': pd.concat(dimensions, ignore_index=True), 'drafts': drafts}
+    return {name: aggregates[name][list(dtypes)].astype(dtypes) for name, dtypes in RESULT_AGGREGATES.items()}
+
+def merge_runs(runs):
+    """
+    Visit runs of parts of the data concatenated in time order, with the
+    runs of a ship in the same cluster on both sides of a part boundary
+    joined.
+    """
+    runs = runs.iloc[np.argsort(runs.sourcemmsi.values, kind='stable')].reset_index(drop=True)
+    ships, clusters = runs.sourcemmsi.values, runs.cluster.values
+    joined = np.r_[False, (ships[1:] == ships[:-1]) & (clusters[1:] == clusters[:-1])]
+    if not joined.any():
+        return runs
+    # A joined run of one point follows the last point of the run before it
+    before_end = np.where(joined & (runs.points.values == 1), np.r_[0, runs.end.values[:-1]], runs.before_end.values)
+    starts = np.flatnonzero(~joined)
+    lasts = np.r_[starts[1:], len(runs)] - 1
+    return pd.DataFrame({'sourcemmsi': ships[starts], 'cluster': clusters[starts], 'start': runs.start.values[starts],
+                         'before_end': before_end[lasts], 'end': runs.end.values[lasts],
+                         'points': np.add.reduceat(runs.points.values, starts)}).astype(RESULT_AGGREGATES['runs'])
+
+def merge_result_aggregates(parts):
+    # Aggregates of parts in time order (or of disjoint ships), merged
+    parts = list(parts)
+    runs = merge_runs(pd.concat([p['runs'] for p in parts], ignore_index=True))
+    dimensions = pd.concat([p['dimensions'] for p in parts], ignore_index=True)
+    dimensions = dimensions.groupby(['cluster', 'column', 'value'])['count'].sum().reset_index()
+    drafts = pd.concat([p['drafts'] for p in parts], ignore_index=True).groupby('cluster')[['changes', 'change_sum']].sum().reset_index()
+    merged = {'runs': runs, 'dimensions': dimensions, 'drafts': drafts}
+    return {name: merged[name][list(dtypes)].astype(dtypes) for name, dtypes in RESULT_AGGREGATES.items()}
+
+def visit_segments(runs):
+    """
+    The (cluster, visit key) pairs of visit_keys over ship and time ordered
+    runs, with the first and last time of their points. A run gets a new
+    key when it is entered from a lower label and its last point gets one
+    when the ship leaves to a lower label, a run of one point only one.
+    """
+    ships, clusters, points = runs.sourcemmsi.values, runs.cluster.values, runs.points.values
+    same_previous = np.r_[False, ships[1:] == ships[:-1]]
+    same_next = np.r_[same_previous[1:], False]
+    enters = same_previous & (clusters > np.r_[clusters[:1], clusters[:-1]])
+    leaves = same_next & (np.r_[clusters[1:], clusters[-1:]] < clusters)
+    split = (points > 1) & leaves
+    steps = np.where(points > 1, enters.astype(np.int64) + leaves, enters | leaves)
+    keys = np.cumsum(steps) - steps + np.where(points > 1, enters, enters | leaves)
+    return pd.DataFrame({'sourcemmsi': np.r_[ships, ships[split]], 'cluster': np.r_[clusters, clusters[split]],
+                         'key': np.r_[keys, keys[split] + 1],
+                         'start': np.r_[runs.start.values, runs.end.values[split]],
+                         'end': np.r_[np.where(split, runs.before_end.values, runs.end.values), runs.end.values[split]]})
+
+def aggregate_results(aggregates, q=0.995, min_duration=12*3600):
+    # The table of cluster_results from merged result_aggregates
+    runs = aggregates['runs'].sort_values('sourcemmsi', kind='stable')
+    segments = visit_segments(runs)
+    result_df = pd.DataFrame(index=pd.Index(np.unique(runs.cluster.values), name='cluster'))
+    result_df['Unique ships'] = runs.drop_duplicates(['cluster', 'sourcemmsi']).groupby('cluster').size()
+    result_df['Number of visits'] = segments.drop_duplicates(['cluster', 'key']).groupby('cluster').size()
+    dimensions = aggregates['dimensions']
+    for column, name in zip(DIMENSION_COLUMNS, ['Max length', 'Max beam', 'Max draft']):
+        counts = dimensions[dimensions.column == column]
+        quantiles = {cluster: count_quantile(c.value.values, c['count'].values, q) for cluster, c in counts.groupby('cluster')}
+        result_df[name] = pd.Series(quantiles, dtype=np.float64)
+    inside = segments[segments.cluster > -1]
+    if len(inside):
+        visits = inside.groupby('key').agg(start=('start', 'min'), end=('end', 'max'), cluster=('cluster', 'max'))
+        result_df['Median time in cluster'] = mean_duration((visits.end - visits.start).values, visits.cluster.values, min_duration)
+    else:
+        result_df['Median time in cluster'] = pd.Series(dtype='timedelta64[ns]')
+    drafts = aggregates['drafts'].set_index('cluster')
+    result_df['Number of draft changes'] = drafts.changes
+    result_df['Average draft change'] = drafts.change_sum / drafts.changes
+    return result_df
+
+@profiled
+def analysis_dataframe(gdf):
+    result_df = cluster_results(analysis_arrays(gdf))
+    write_table(result_df, str(cfg.FILE_PREFIX + '_results.html'))
+    return result_df
+
+@profiled
+def report_aggregates(gdf, gantt=cfg.REPORT_GANTT):
+    """
+    The aggregates of the report files of a labelled frame, from one sort of
+    the points: arrival and departure hour matrices, the ship type table,
+    the result table and with `gantt` the visits.
+    """
+    arrays = analysis_arrays(gdf)
+    aggregates = dict(zip(['arrivals', 'departures'], transition_matrices(arrays)))
+    aggregates['ship_types'] = ship_type_table(*ship_type_counts(gdf))
+    aggregates['results'] = cluster_results(arrays)
+    if gantt:
+        aggregates['visits'] = visit_spans(arrays)
+    return aggregates
 
 if __name__ == "__main__":
-    df = pd.read_csv('processed_ais.csv')
-    df['geometry'] = df['geometry'].apply(wkt.loads)
-    gdf = gpd.GeoDataFrame(df, crs='epsg:4326')
-    gdf.Date = gdf.Date.apply(pd.to_datetime)
-    polygons = pd.read_csv(cfg.POLYGON_CSV_OUT)
-    polygons['geometry'] = polygons['geometry'].apply(wkt.loads)
-    
-    polygons = gpd.GeoDataFrame(polygons, crs='epsg:4326')
-    polygons.geometry = polygons.geometry.buffer(0.0002)
+    gdf = read_stage(cfg.PROCESSED_AIS, columns=['sourcemmsi', 't', 'hours', 'lon', 'lat', 'shiptype', 'length', 'beam', 'draft'])
+    polygons = read_polygons()
    
     gdf = add_clusters_to_data(gdf, polygons)
-    arrival_departing_analysis(gdf)
-    dimensions = ship_dimension_analysis(gdf)
-    types = ship_type_analysis(gdf)
-    duration = ship_duration_analysis(gdf)
-    result_df = pd.DataFrame()
-    result_df['Unique ships'] = gdf.groupby('cluster').sourcemmsi.nunique()
-    result_df['Number of visits'] = gdf.groupby('cluster').change_in_cluster.nunique()
-    result_df[['Max length', 'Max beam', 'Max draft']] = dimensions
-    result_df['Median time in cluster'] =  duration
-    types.to_html(str(cfg.FILE_PREFIX + '_types.html'))
-    result_df.to_html(str(cfg.FILE_PREFIX + '_results.html'))
\ No newline at end of file
+    render_report(report_aggregates(gdf))
@@ -0,0 +1,83 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import datetime
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import config as cfg
+from preprocess import preprocess_data, include_static_data
+from dbscan import dbscan_clusters
+from analysis import add_clusters_to_data, arrival_departing_analysis, analysis_dataframe
+from synthetic import generate_ais, generate_static, START_T
+
+
+def groupby_analysis_dataframe(gdf):
+    # Repeated sort and groupby version that analysis_dataframe replaced, with
+    # the visit numbering arrival_departing_analysis used to add to the frame
+    gdf = gdf.sort_values(['sourcemmsi','t'])
+    enters_cluster = gdf.groupby('sourcemmsi').cluster.diff()>0
+    leaves_cluster = (gdf.groupby('sourcemmsi').cluster.diff()<0).shift(-1, fill_value=False)
+    gdf['change_in_cluster'] = (enters_cluster | leaves_cluster).cumsum()
+    clusters = gdf.groupby('cluster')
+    dimensions = pd.DataFrame(columns=['max_length', 'max_beam', 'max_draft'])
+    dimensions.max_length = clusters.length.quantile(0.995, interpolation='nearest')
+    dimensions.max_beam = clusters.beam.quantile(0.995, interpolation='nearest')
+    dimensions.max_draft = clusters.draft.quantile(0.995, interpolation='nearest')
+
+    gdf.sort_values(['sourcemmsi','t'], inplace=True)
+    visits = gdf[gdf.cluster>-1].groupby('change_in_cluster')
+    times = visits.t.max()-visits.t.min()
+    times = times.apply(lambda x: datetime.timedelta(seconds=x))
+    visit_clusters = visits.cluster.describe()['max']
+    visits_df = pd.DataFrame().from_dict({'time': times.values, 'cluster': visit_clusters.values})
+    visits_df = visits_df[visits_df.time>datetime.timedelta(hours=12)]
+    duration = visits_df.groupby('cluster').time.mean()
+
+    drafts = gdf[gdf.draft!=0].copy()
+    drafts['draft_change'] = drafts.sort_values(['sourcemmsi','t']).groupby('sourcemmsi').draft.diff()
+    drafts['draft_change'] = drafts.draft_change.fillna(0)
+    draft_rows = drafts[drafts.draft_change!=0].groupby('cluster')
+
+    result_df = pd.DataFrame()
+    result_df['Unique ships'] = gdf.groupby('cluster').sourcemmsi.nunique()
+    result_df['Number of visits'] = gdf.groupby('cluster').change_in_cluster.nunique()
+    result_df[['Max length', 'Max beam', 'Max draft']] = dimensions
+    result_df['Median time in cluster'] = duration
+    result_df['Number of draft changes'] = draft_rows.size()
+    result_df['Average draft change'] = draft_rows.draft_change.describe()['mean']
+    return result_df
+
+def labelled_points(n_points, n_vessels, seed=0):
+    ais, _ = generate_ais(n_points, n_vessels, seed=seed)
+    static = generate_static(n_vessels, seed, span=int(ais.t.max()) - START_T)
+    df = preprocess_data(ais)
+    df = include_static_data(df, static=static, bounds=(-180, -90, 180, 90))
+    df = add_clusters_to_data(df, dbscan_clusters(df))
+    # Missing and zero drafts are skipped by the draft change count
+    rng = np.random.default_rng(seed)
+    df.loc[rng.random(len(df)) < 0.01, 'draft'] = np.nan
+    df.loc[rng.random(len(df)) < 0.01, 'draft'] = 0
+    return arrival_departing_analysis(df)
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time analysis_dataframe against the repeated groupby version')
+    parser.add_argument('--points', type=int, default=10000000)
+    parser.add_argument('--vessels', type=int, default=None, help='default one per 2000 points')
+    args = parser.parse_args()
+    cfg.USE_CACHE = False
+    cfg.FILE_PREFIX = os.path.join(tempfile.mkdtemp(prefix='bench_analysis_'), 'synthetic')
+    df = labelled_points(args.points, args.vessels or max(args.points // 2000, 10))
+    result, engine_time = timed(analysis_dataframe, df)
+    reference, groupby_time = timed(groupby_analysis_dataframe, df)
+    assert result.to_html() == reference.to_html(), 'result tables differ'
+    print(f'rows={len(df)} clusters={len(result)}')
+    print(f'single pass: {engine_time:.2f}s')
+    print(f'groupby:     {groupby_time:.2f}s ({groupby_time/engine_time:.1f}x)')
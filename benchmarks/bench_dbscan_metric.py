@@ -0,0 +1,59 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import time
+import numpy as np
+import config as cfg
+from dbscan import fit_dbscan
+from synthetic import planted_berths, METERS_PER_DEGREE, SEA_POINT
+
+
+def make_centers(n_centers, n_berths=200, noise_share=0.02, spread_m=15, seed=0):
+    # Berth visit centers scattered around planted berths, plus centers spread over the port
+    rng = np.random.default_rng(seed)
+    berths = planted_berths(n_berths)
+    n_noise = int(n_centers * noise_share)
+    berth = rng.integers(0, n_berths, n_centers - n_noise)
+    lat = berths.lat.values[berth] + rng.normal(0, spread_m, len(berth)) / METERS_PER_DEGREE
+    lon = berths.lon.values[berth] + rng.normal(0, spread_m, len(berth)) / (METERS_PER_DEGREE * np.cos(np.radians(lat)))
+    lat = np.r_[lat, rng.uniform(SEA_POINT[1], berths.lat.max() + 0.01, n_noise)]
+    lon = np.r_[lon, rng.uniform(SEA_POINT[0], berths.lon.max() + 0.01, n_noise)]
+    order = rng.permutation(n_centers)
+    return list(zip(lat[order], lon[order]))
+
+def mismatch_share(labels, reference):
+    # Share of points not in the reference cluster that most of their cluster falls in
+    pairs = np.stack([labels, reference], axis=1)
+    pair_values, pair_counts = np.unique(pairs, axis=0, return_counts=True)
+    # For every cluster the most common reference label
+    order = np.lexsort((-pair_counts, pair_values[:, 0]))
+    first = np.r_[True, pair_values[order][1:, 0] != pair_values[order][:-1, 0]]
+    matched = pair_counts[order][first].sum()
+    return 1 - matched / len(labels)
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the projected KD-tree DBSCAN with the haversine ball tree')
+    parser.add_argument('--centers', type=int, default=200000)
+    parser.add_argument('--eps-m', type=float, default=cfg.MAX_EPS_M)
+    parser.add_argument('--min-samples', type=int, default=cfg.MIN_SAMPLES)
+    parser.add_argument('--max-mismatch', type=float, default=0.001, help='largest share of centers labelled differently')
+    args = parser.parse_args()
+    coords = make_centers(args.centers)
+    eps = args.eps_m / 1000 / 6371.0088
+    haversine, haversine_time = timed(fit_dbscan, coords, eps, args.min_samples, metric='haversine', n_jobs=1)
+    projected, projected_time = timed(fit_dbscan, coords, eps, args.min_samples, metric='projected', n_jobs=1)
+    parallel, parallel_time = timed(fit_dbscan, coords, eps, args.min_samples, metric='projected', n_jobs=-1)
+    mismatch = max(mismatch_share(projected.labels_, haversine.labels_), mismatch_share(haversine.labels_, projected.labels_))
+    assert (projected.labels_ == parallel.labels_).all(), 'n_jobs changed the labels'
+    assert mismatch <= args.max_mismatch, f'{mismatch:.4%} of the centers are labelled differently'
+    print(f'centers={len(coords)} clusters={projected.labels_.max() + 1} eps={args.eps_m}m')
+    print(f'haversine ball tree: {haversine_time:.2f}s')
+    print(f'projected KD-tree:   {projected_time:.2f}s ({haversine_time/projected_time:.1f}x)')
+    print(f'projected, n_jobs=-1: {parallel_time:.2f}s ({haversine_time/parallel_time:.1f}x)')
+    print(f'labels differing: {mismatch:.4%}')
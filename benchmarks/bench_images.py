@@ -0,0 +1,102 @@
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dockerize'))
+import argparse
+import tempfile
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import geopandas as gpd
+import requests
+import config as cfg
+from drydocks import fetch_images, image_bounds, image_session
+
+# Times fetch_images against a local stand-in for the static image API that
+# answers every request after a fixed latency, and checks that a rerun is
+# served from the image cache and that failing tiles do not stop the others.
+
+class TileHandler(BaseHTTPRequestHandler):
+    latency = 0.05
+    requests = 0
+    # Share of the tiles answered with 503, the same tiles on every retry
+    fail_share = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with TileHandler.lock:
+            TileHandler.requests += 1
+        time.sleep(TileHandler.latency)
+        if failing(self.path, TileHandler.fail_share):
+            self.send_error(503)
+            return
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def failing(path, share):
+    return zlib.crc32(path.split('?')[0].encode()) % 1000 < share * 1000
+
+def make_polygons(n_clusters, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = gpd.points_from_xy(rng.uniform(4.0, 4.5, n_clusters), rng.uniform(51.8, 52.0, n_clusters))
+    return gpd.GeoDataFrame({'anchorage_id': np.arange(n_clusters)}, geometry=centers.buffer(0.001), crs='epsg:4326')
+
+def serial_images(polygons, url_template, image_dir):
+    # One blocking request per cluster without a session, as download_image did
+    for anchorage_id, bounds in zip(polygons.anchorage_id.values, image_bounds(polygons)):
+        bounds = '[' + ','.join([str(x) for x in bounds]) + ']'
+        r = requests.get(url_template.format(bounds=bounds, resolution=cfg.MAPBOX_RESOLUTION, token=cfg.MAPBOX_TOKEN))
+        with open(os.path.join(image_dir, f'cluster{anchorage_id}.jpeg'), 'wb') as f:
+            f.write(r.content)
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the concurrent image fetcher against a local stand-in server')
+    parser.add_argument('--clusters', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request of the stand-in server')
+    parser.add_argument('--workers', type=int, default=cfg.IMAGE_WORKERS)
+    parser.add_argument('--fail-share', type=float, default=0.1, help='share of the tiles failing in the failure check')
+    args = parser.parse_args()
+    TileHandler.latency = args.latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url_template = f'http://127.0.0.1:{server.server_port}' + '/static/{bounds}/{resolution}?access_token={token}'
+    polygons = make_polygons(args.clusters)
+    out = tempfile.mkdtemp(prefix='bench_images_')
+    serial_dir, image_dir, cache_dir = (os.path.join(out, d) for d in ('serial', 'img', 'cache'))
+    os.makedirs(serial_dir)
+    _, serial_time = timed(serial_images, polygons, url_template, serial_dir)
+    status, fetch_time = timed(fetch_images, polygons, url_template, image_dir=image_dir, cache_dir=cache_dir, max_workers=args.workers)
+    assert all(code == 200 for code in status.values()), 'downloads failed'
+    for anchorage_id in polygons.anchorage_id.values:
+        with open(os.path.join(serial_dir, f'cluster{anchorage_id}.jpeg'), 'rb') as a, open(os.path.join(image_dir, f'cluster{anchorage_id}.jpeg'), 'rb') as b:
+            assert a.read() == b.read(), f'image of cluster {anchorage_id} differs'
+    before = TileHandler.requests
+    _, rerun_time = timed(fetch_images, polygons, url_template, image_dir=image_dir, cache_dir=cache_dir, max_workers=args.workers)
+    assert TileHandler.requests == before, 'rerun downloaded cached images'
+    # Failing tiles come back as None after the retries, the other clusters are still downloaded
+    TileHandler.fail_share = args.fail_share
+    fail_dir = os.path.join(out, 'fail')
+    status = fetch_images(polygons, url_template, image_dir=fail_dir, cache_dir=os.path.join(out, 'fail_cache'),
+                          max_workers=args.workers, session=image_session(args.workers, retries=1))
+    failed = {anchorage_id for anchorage_id, code in status.items() if code is None}
+    assert len(status) == len(polygons) and failed, 'no failing tiles'
+    assert all(code == 200 for anchorage_id, code in status.items() if anchorage_id not in failed), 'working tiles failed'
+    assert all(os.path.exists(os.path.join(fail_dir, f'cluster{anchorage_id}.jpeg')) != (anchorage_id in failed) for anchorage_id in status), 'image files do not match the statuses'
+    server.shutdown()
+    print(f'clusters={args.clusters} latency={args.latency*1000:.0f}ms workers={args.workers}')
+    print(f'serial:     {serial_time:.2f}s')
+    print(f'concurrent: {fetch_time:.2f}s ({serial_time/fetch_time:.1f}x)')
+    print(f'cached:     {rerun_time:.2f}s')
+    print(f'failing:    {len(failed)} of {len(status)} clusters returned None, the others were downloaded')
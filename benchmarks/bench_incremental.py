@@ -0,0 +1,57 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import tempfile
+import time
+import pandas as pd
+import config as cfg
+from preprocess import preprocess_data, include_static_data
+from dbscan import dbscan_clusters
+from analysis import add_clusters_to_data, analysis_arrays, cluster_results
+from incremental import update, results_table
+from synthetic import generate_ais, generate_static, START_T
+
+# Adds synthetic AIS to incremental mode one day at a time and checks that the
+# result table of the stored aggregates is the table of a full run over all
+# days with the same clusters. The clusters themselves differ from a full run
+# only by the berth visits still open at the end of the data, which incremental
+# mode leaves out until they are closed.
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def full_run(ais, static, bounds):
+    df = include_static_data(preprocess_data(ais), static=static, bounds=bounds)
+    polygons = dbscan_clusters(df)
+    cluster_results(analysis_arrays(add_clusters_to_data(df, polygons)))
+    return df, polygons
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare day by day incremental runs with a full run')
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--vessels', type=int, default=500)
+    args = parser.parse_args()
+    cfg.USE_CACHE = False
+    workdir = tempfile.mkdtemp(prefix='bench_incremental_')
+    cfg.STAGE_DIR = os.path.join(workdir, 'stages')
+    bounds = (-180, -90, 180, 90)
+    ais, _ = generate_ais(args.points, args.vessels)
+    static = generate_static(args.vessels, span=int(ais.t.max()) - START_T)
+    (df, polygons), full_time = timed(full_run, ais, static, bounds)
+    days = (ais.t - START_T) // 86400
+    update_times = []
+    for day in sorted(days.unique()):
+        path = os.path.join(workdir, f'ais_{day}.csv')
+        ais[days == day].to_csv(path, index=False)
+        state, seconds = timed(update, path, os.path.join(workdir, 'state'), static=static, bounds=bounds)
+        update_times.append(seconds)
+    results = results_table(state)
+    reference = cluster_results(analysis_arrays(add_clusters_to_data(df, state['polygons'])))
+    pd.testing.assert_frame_equal(results, reference, check_exact=False)
+    print(f'points={len(ais)} days={len(update_times)} clusters={(results.index >= 0).sum()} (full run {(polygons.cluster_id >= 0).sum()})')
+    print(f'full run:           {full_time:.2f}s')
+    print('incremental, daily: ' + ' '.join(f'{seconds:.2f}s' for seconds in update_times))
+    print('result tables equal')
@@ -0,0 +1,54 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import tempfile
+import time
+import numpy as np
+import shapely
+from polygon_index import PolygonIndex, write_index, load_index
+from bench_labelling import make_data
+
+
+def query_label_points(lon, lat, polygons, ids, default=-999):
+    # Unprepared STRtree query that the polygon index replaced, kept as reference
+    labels = np.full(len(lon), default, dtype=np.result_type(ids, np.asarray(default)))
+    tree = shapely.STRtree(polygons)
+    point_idx, poly_idx = tree.query(shapely.points(lon, lat), predicate='intersects')
+    order = np.lexsort((poly_idx, point_idx))
+    point_idx, poly_idx = point_idx[order], poly_idx[order]
+    last = np.r_[point_idx[1:] != point_idx[:-1], True]
+    labels[point_idx[last]] = ids[poly_idx[last]]
+    return labels
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time loading and batch lookups of the polygon index')
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--clusters', type=int, default=300)
+    parser.add_argument('--batches', type=int, nargs='+', default=[1, 100, 10000])
+    args = parser.parse_args()
+    points, polygons = make_data(args.points, args.clusters)
+    lon, lat = points.lon.values, points.lat.values
+    index, build_time = timed(PolygonIndex.from_polygons, polygons)
+    path = os.path.join(tempfile.mkdtemp(prefix='bench_index_'), 'polygons.index')
+    write_index(index, path)
+    index, load_time = timed(load_index, path)
+    labels, lookup_time = timed(index.lookup, lon, lat)
+    reference, query_time = timed(query_label_points, lon, lat, polygons.geometry.values, polygons.cluster_id.values)
+    assert (labels == reference).all(), 'labels differ from the STRtree query'
+    print(f'points={args.points} polygons={len(index)}')
+    print(f'build: {build_time*1000:.1f}ms  load: {load_time*1000:.1f}ms')
+    print(f'index lookup: {lookup_time:.2f}s ({lookup_time/args.points*1e6:.2f}us/point)')
+    print(f'tree query:   {query_time:.2f}s ({query_time/lookup_time:.1f}x)')
+    for batch in args.batches:
+        n = min(args.points, max(batch, 1000))
+        start = time.perf_counter()
+        for i in range(0, n, batch):
+            index.lookup(lon[i:i+batch], lat[i:i+batch])
+        per_point = (time.perf_counter() - start) / n
+        print(f'batch {batch}: {per_point*1e6:.2f}us/point')
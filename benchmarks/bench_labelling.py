@@ -0,0 +1,49 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import time
+import numpy as np
+import geopandas as gpd
+from analysis import add_clusters_to_data
+
+
+def loop_add_clusters_to_data(gdf, polygons):
+    # Per-polygon loop that add_clusters_to_data replaced, kept as reference
+    gdf['cluster'] = -999
+    for i, cluster in polygons[polygons.cluster_id >= 0].iterrows():
+        geom = cluster.geometry
+        sindex = gdf.sindex
+        possible_matches_index = list(sindex.intersection(geom.bounds))
+        possible_matches = gdf.iloc[possible_matches_index]
+        precise_matches = possible_matches[possible_matches.intersects(geom)]
+        gdf.loc[precise_matches.index, 'cluster'] = cluster.cluster_id
+    return gdf
+
+def make_data(n_points, n_clusters, seed=0):
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(-4.6, -4.4, n_points)
+    lat = rng.uniform(48.3, 48.4, n_points)
+    points = gpd.GeoDataFrame({'t': np.arange(n_points), 'lon': lon, 'lat': lat}, geometry=gpd.points_from_xy(lon, lat), crs='epsg:4326')
+    centers = gpd.points_from_xy(rng.uniform(-4.6, -4.4, n_clusters), rng.uniform(48.3, 48.4, n_clusters))
+    # Radius is large enough that some polygons overlap to exercise the tie-break
+    polygons = gpd.GeoDataFrame({'cluster_id': np.arange(n_clusters)}, geometry=centers.buffer(0.003), crs='epsg:4326')
+    return points, polygons
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare STRtree labelling against the per-polygon loop')
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--clusters', type=int, default=300)
+    args = parser.parse_args()
+    points, polygons = make_data(args.points, args.clusters)
+    loop, loop_time = timed(loop_add_clusters_to_data, points.copy(), polygons)
+    bulk, bulk_time = timed(add_clusters_to_data, points.copy(), polygons)
+    assert (loop.cluster.values == bulk.cluster.values).all(), 'labels differ from the loop implementation'
+    print(f'points={args.points} clusters={args.clusters}')
+    print(f'loop:  {loop_time:.2f}s')
+    print(f'bulk:  {bulk_time:.2f}s ({loop_time/bulk_time:.1f}x)')
@@ -0,0 +1,53 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import tempfile
+import time
+import pandas as pd
+import config as cfg
+from preprocess import load_ais, preprocess_data, include_static_data
+from dbscan import dbscan_clusters
+from analysis import add_clusters_to_data, analysis_arrays, cluster_results
+from outofcore import run_out_of_core
+from synthetic import generate_ais, generate_static, START_T
+
+# Runs the pipeline on synthetic AIS in memory and per MMSI bucket, and checks
+# that both give the same cluster polygons and result table.
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def in_memory(filepath, static, bounds):
+    df = include_static_data(preprocess_data(load_ais(filepath, bounds)), static=static, bounds=bounds)
+    polygons = dbscan_clusters(df)
+    return polygons, cluster_results(analysis_arrays(add_clusters_to_data(df, polygons)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the out-of-core run with the in-memory pipeline')
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--vessels', type=int, default=500)
+    parser.add_argument('--buckets', type=int, default=cfg.MMSI_BUCKETS)
+    args = parser.parse_args()
+    cfg.USE_CACHE = False
+    cfg.MMSI_BUCKETS = args.buckets
+    workdir = tempfile.mkdtemp(prefix='bench_outofcore_')
+    cfg.STAGE_DIR = os.path.join(workdir, 'stages')
+    cfg.FILE_PREFIX = os.path.join(workdir, 'synthetic')
+    # The rollups are written to the working directory
+    os.chdir(workdir)
+    bounds = (-180, -90, 180, 90)
+    ais, _ = generate_ais(args.points, args.vessels)
+    static = generate_static(args.vessels, span=int(ais.t.max()) - START_T)
+    filepath = os.path.join(workdir, 'ais.csv')
+    ais.to_csv(filepath, index=False)
+    (polygons, reference), memory_time = timed(in_memory, filepath, static, bounds)
+    (ooc_polygons, results), ooc_time = timed(run_out_of_core, filepath, static=static, bounds=bounds)
+    assert len(polygons) == len(ooc_polygons) and polygons.geometry.geom_equals(ooc_polygons.geometry).all(), 'polygons differ'
+    pd.testing.assert_frame_equal(results, reference, check_exact=False)
+    print(f'points={len(ais)} buckets={args.buckets} clusters={(results.index >= 0).sum()}')
+    print(f'in memory:    {memory_time:.2f}s (without the report files)')
+    print(f'out-of-core:  {ooc_time:.2f}s')
+    print('polygons and result tables equal')
@@ -0,0 +1,77 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import tempfile
+import numpy as np
+import config as cfg
+import profiling
+from preprocess import AIS_DTYPES, load_ais, preprocess_data, include_static_data
+from dbscan import dbscan_clusters
+from analysis import add_clusters_to_data, arrival_departing_analysis, ship_type_analysis, analysis_dataframe
+from synthetic import generate_ais, generate_static, berth_recovery, cycle_points, START_T
+
+# Times every pipeline stage on synthetic data of growing size and checks
+# that the planted berths are found. Each size writes a profiling report,
+# compare two runs with `python profiling.py old.json new.json`.
+
+def run_pipeline(ais, static, from_csv=None, analysis=True):
+    if from_csv:
+        ais.to_csv(from_csv, index=False)
+        ais = load_ais(from_csv)
+    else:
+        # The columns load_ais would read
+        ais = ais[list(AIS_DTYPES)]
+    df = preprocess_data(ais)
+    df = include_static_data(df, static=static, bounds=(-180, -90, 180, 90))
+    polygons = dbscan_clusters(df)
+    df = add_clusters_to_data(df, polygons)
+    if analysis:
+        arrival_departing_analysis(df)
+        ship_type_analysis(df)
+        analysis_dataframe(df)
+    return polygons
+
+def print_stages(stages):
+    print(f"{'stage':<30} {'rows in':>12} {'wall s':>8} {'cpu s':>8} {'M rows/s':>9} {'peak RSS MB':>12}")
+    for record in stages:
+        rows = record['rows_in'] or record['rows_out'] or 0
+        throughput = rows / record['wall_s'] / 1e6 if record['wall_s'] else float('nan')
+        name = '  ' * record['depth'] + record['stage']
+        print(f"{name:<30} {rows:>12} {record['wall_s']:>8.2f} {record['cpu_s']:>8.2f} {throughput:>9.2f} {record['peak_rss_mb']:>12.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the pipeline stages on synthetic AIS data')
+    parser.add_argument('--points', type=int, nargs='+', default=[1000000, 10000000, 50000000])
+    parser.add_argument('--vessels', type=int, nargs='+', default=None, help='ships per size, default one per 2000 points')
+    parser.add_argument('--berths', type=int, default=None,
+                        help='planted berths per size, default one per --visits-per-berth visits and at most 40')
+    parser.add_argument('--visits-per-berth', type=int, default=20,
+                        help='with fewer visits a berth can get less than MIN_SAMPLES of them and is not found')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv', action='store_true', help='also time writing and loading the AIS CSV')
+    parser.add_argument('--skip-analysis', action='store_true')
+    parser.add_argument('--min-recall', type=float, default=0.95)
+    parser.add_argument('--out', default='bench_pipeline', help='prefix of the per-size JSON reports')
+    args = parser.parse_args()
+    # Cached centers and polygons would hide the clustering cost
+    cfg.USE_CACHE = False
+    workdir = tempfile.mkdtemp(prefix='bench_pipeline_')
+    cfg.FILE_PREFIX = os.path.join(workdir, 'synthetic')
+    for i, n_points in enumerate(args.points):
+        n_vessels = args.vessels[i] if args.vessels else max(n_points // 2000, 10)
+        # The visits are spread over the berths at random, small sizes plant fewer berths so each is visited often enough
+        n_berths = args.berths or int(np.clip(n_points / cycle_points() / args.visits_per_berth, 1, 40))
+        ais, berths = generate_ais(n_points, n_vessels, n_berths, args.seed)
+        static = generate_static(n_vessels, args.seed, span=int(ais.t.max()) - START_T)
+        profiling.start_profiling()
+        polygons = run_pipeline(ais, static, os.path.join(workdir, 'ais.csv') if args.csv else None, not args.skip_analysis)
+        stages = profiling.stop_profiling()
+        recall, precision = berth_recovery(polygons, berths)
+        print(f'\npoints={len(ais)} vessels={n_vessels} berths={n_berths}')
+        print_stages(stages)
+        print(f'berth recall {recall:.2f}, precision {precision:.2f}')
+        profiling.write_profile(f'{args.out}_{n_points}.json')
+        del ais
+        assert recall >= args.min_recall, f'only {recall:.0%} of the planted berths were recovered'
+    print(f'\nplots and result tables are in {workdir}')
@@ -0,0 +1,60 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from preprocess import preprocess_data
+
+
+def apply_preprocess_data(df):
+    # Per-row apply and repeated groupby version that preprocess_data replaced
+    df = df.sort_values('t')
+    df['Date'] = pd.to_datetime(df.t, unit='s')
+    df['hours'] = df.Date.apply(lambda x: x.hour)
+    df['weekday'] = df.Date.apply(lambda x: x.weekday())
+    dt = df.groupby('sourcemmsi')['t'].diff().values
+    lon_prev = np.radians((df.groupby('sourcemmsi')['lon'].shift()).values)
+    lat_prev = np.radians((df.groupby('sourcemmsi')['lat'].shift()).values)
+    lonrad = np.radians(df['lon'])
+    latrad = np.radians(df['lat'])
+    dlon = lon_prev - lonrad
+    dlat = lat_prev - latrad
+    a = np.sin(dlat/2)**2 + np.cos(latrad) * np.cos(lat_prev) * np.sin(dlon/2)**2
+    df['speed'] = (2 * np.arctan2(np.sqrt(a), np.sqrt(1-a)))*6371000/dt
+    df.drop(df[(df.speed>1) & (df.navigationalstatus==5)].index, inplace=True)
+    df.reset_index(inplace=True)
+    return df
+
+def make_points(n_rows, n_vessels, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'sourcemmsi': (200000000 + rng.integers(0, n_vessels, n_rows)).astype(str),
+        't': rng.integers(1443650400, 1443650400 + 180*86400, n_rows),
+        'lon': rng.normal(-4.5, 0.02, n_rows).astype('float32'),
+        'lat': rng.normal(48.35, 0.02, n_rows).astype('float32'),
+        'navigationalstatus': rng.choice([0, 5], n_rows).astype('float32')})
+    # Points of a ship with the same timestamp have no defined order
+    return df.drop_duplicates(['sourcemmsi', 't'], ignore_index=True)
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time preprocess_data against the per-row apply version')
+    parser.add_argument('--rows', type=int, default=50000000)
+    parser.add_argument('--vessels', type=int, default=5000)
+    parser.add_argument('--skip-apply-above', type=int, default=5000000, help='row count above which the slow version is not run')
+    args = parser.parse_args()
+    df = make_points(args.rows, args.vessels)
+    result, kernel_time = timed(preprocess_data, df)
+    print(f'rows={len(df)} vessels={args.vessels}')
+    print(f'vectorized: {kernel_time:.2f}s ({len(df)/kernel_time/1e6:.1f}M rows/s)')
+    if len(df) <= args.skip_apply_above:
+        reference, apply_time = timed(apply_preprocess_data, df)
+        # Speeds right at the 1 m/s threshold can round differently
+        assert abs(len(reference) - len(result)) <= len(df) * 1e-5, 'different rows dropped'
+        print(f'apply:      {apply_time:.2f}s ({apply_time/kernel_time:.1f}x)')
@@ -0,0 +1,68 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import config as cfg
+from analysis import transition_hours
+from rollups import build_rollups, write_rollups, read_rollups, query_occupancy
+from bench_analysis import labelled_points
+
+# Times time-window occupancy queries on the rollups against answering the same
+# question from the labelled points, and checks the rollup answers against a
+# loop over the hours of every visit.
+
+def point_query(gdf, start, end, cluster):
+    # What a question cost before the rollups: selecting the points and rerunning the analysis
+    selected = gdf[(gdf.t >= start) & (gdf.t < end) & (gdf.cluster == cluster)]
+    return transition_hours(selected)
+
+def loop_occupancy(visits, start, end, cluster, weekdays):
+    # Ships present per hour of day, counting every hour of every visit once per ship
+    seen = set()
+    for visit in visits[visits.cluster == cluster].itertuples():
+        for hour in range(visit.arrival // 3600, visit.departure // 3600 + 1):
+            if start // 3600 <= hour < -(-end // 3600) and (hour // 24 + 3) % 7 in weekdays:
+                seen.add((visit.sourcemmsi, hour))
+    return pd.Series([hour % 24 for _, hour in seen], dtype='int64').value_counts().sort_index()
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time occupancy queries on the rollups against the labelled points')
+    parser.add_argument('--points', type=int, default=10000000)
+    parser.add_argument('--vessels', type=int, default=None, help='default one per 2000 points')
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--window-hours', type=int, default=48)
+    args = parser.parse_args()
+    cfg.USE_CACHE = False
+    out = tempfile.mkdtemp(prefix='bench_rollups_')
+    cfg.FILE_PREFIX = os.path.join(out, 'synthetic')
+    df = labelled_points(args.points, args.vessels or max(args.points // 2000, 10))
+    rollups, build_time = timed(build_rollups, df)
+    write_rollups(rollups, out)
+    rollups, read_time = timed(read_rollups, out)
+    rng = np.random.default_rng(0)
+    clusters = rollups['visits'].cluster.unique()
+    t_min, t_max = int(df.t.min()), int(df.t.max())
+    rollup_time = point_time = 0
+    for _ in range(args.queries):
+        start = int(rng.integers(t_min, max(t_max - args.window_hours * 3600, t_min + 1)))
+        end = start + args.window_hours * 3600
+        cluster = int(rng.choice(clusters))
+        weekdays = sorted(rng.choice(7, 4, replace=False).tolist())
+        ship_hours, seconds = timed(query_occupancy, rollups['occupancy'], start, end, clusters=[cluster], weekdays=weekdays, by=['hours'])
+        rollup_time += seconds
+        point_time += timed(point_query, df, start, end, cluster)[1]
+        reference = loop_occupancy(rollups['visits'], start, end, cluster, weekdays)
+        assert ship_hours.index.tolist() == reference.index.tolist() and ship_hours.tolist() == reference.tolist(), 'occupancy differs'
+    print(f'rows={len(df)} visits={len(rollups["visits"])} occupancy rows={len(rollups["occupancy"])}')
+    print(f'build rollups: {build_time:.2f}s, read: {read_time*1000:.1f}ms')
+    print(f'point queries:  {point_time/args.queries*1000:.1f}ms per query')
+    print(f'rollup queries: {rollup_time/args.queries*1000:.2f}ms per query ({point_time/rollup_time:.0f}x)')
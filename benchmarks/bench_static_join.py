@@ -0,0 +1,68 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from preprocess import merge_static_data
+
+
+def loop_merge_static_data(df, static):
+    # Per-MMSI merge that merge_static_data replaced, kept as reference
+    dfs = []
+    df = df.sort_values('t')
+    static = static.sort_values('t')
+    intersection = list(set(df.sourcemmsi.unique()) & set(static.sourcemmsi.unique()))
+    static_groups = static.groupby('sourcemmsi')
+    dynamic_groups = df.groupby('sourcemmsi')
+    for mmsi in intersection:
+        a = dynamic_groups.get_group(mmsi)
+        b = static_groups.get_group(mmsi)
+        c = pd.merge_asof(a, b, on='t', direction='nearest')
+        dfs.append(c)
+    df = pd.concat(dfs)
+    df.drop(columns = 'sourcemmsi_y', inplace=True)
+    df.rename(columns = {'sourcemmsi_x': 'sourcemmsi'}, inplace = True)
+    return df
+
+def make_fleet(n_vessels, points_per_vessel=50, static_per_vessel=3, seed=0):
+    rng = np.random.default_rng(seed)
+    # One in ten ships never sends a static report
+    mmsis = (200000000 + np.arange(n_vessels)).astype(str)
+    dynamic = pd.DataFrame({
+        'sourcemmsi': np.repeat(mmsis, points_per_vessel),
+        't': rng.integers(0, 30*86400, n_vessels*points_per_vessel),
+        'lon': rng.uniform(-4.6, -4.4, n_vessels*points_per_vessel).astype('float32'),
+        'lat': rng.uniform(48.3, 48.4, n_vessels*points_per_vessel).astype('float32')})
+    static_mmsis = mmsis[rng.random(n_vessels) > 0.1]
+    n_static = len(static_mmsis)*static_per_vessel
+    static = pd.DataFrame({
+        'sourcemmsi': np.repeat(static_mmsis, static_per_vessel),
+        't': rng.integers(0, 30*86400, n_static),
+        'shiptype': rng.integers(30, 90, n_static).astype('float32'),
+        'draught': rng.uniform(2, 15, n_static).astype('float32')})
+    return dynamic, static
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def normalize(df):
+    return df.sort_values(['sourcemmsi', 't', 'lon', 'lat']).reset_index(drop=True)[['sourcemmsi', 't', 'lon', 'lat', 'shiptype', 'draught']]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the grouped merge_asof against the per-MMSI loop')
+    parser.add_argument('--fleets', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--skip-loop-above', type=int, default=10000, help='fleet size above which the slow loop is not run')
+    args = parser.parse_args()
+    for n_vessels in args.fleets:
+        dynamic, static = make_fleet(n_vessels)
+        merged, merged_time = timed(merge_static_data, dynamic, static)
+        line = f'vessels={n_vessels:>6} rows={len(dynamic):>8} grouped: {merged_time:.2f}s'
+        if n_vessels <= args.skip_loop_above:
+            loop, loop_time = timed(loop_merge_static_data, dynamic, static)
+            pd.testing.assert_frame_equal(normalize(loop), normalize(merged))
+            line += f' loop: {loop_time:.2f}s ({loop_time/merged_time:.1f}x)'
+        print(line)
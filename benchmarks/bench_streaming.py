@@ -0,0 +1,48 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import time
+import numpy as np
+from preprocess import preprocess_data, include_static_data
+from dbscan import berth_visit_centers
+from streaming import BerthVisitDetector, stream_visits, visits_frame
+from synthetic import generate_ais, generate_static, START_T, METERS_PER_DEGREE
+
+
+def batch_visits(ais, static):
+    # Visits of the batch pipeline, the reference for the streamed ones
+    bounds = (-180, -90, 180, 90)
+    df = include_static_data(preprocess_data(ais), static=static, bounds=bounds)
+    return berth_visit_centers(df).drop(columns='berth_num')
+
+def messages(ais):
+    return zip(ais.sourcemmsi.tolist(), ais.t.tolist(), ais.lon.tolist(), ais.lat.tolist(),
+               ais.navigationalstatus.astype('float64').fillna(-1).astype(int).tolist())
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare streamed berth visits with the batch pipeline')
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--vessels', type=int, default=500)
+    parser.add_argument('--median-sample', type=int, default=1024)
+    args = parser.parse_args()
+    ais, _ = generate_ais(args.points, args.vessels)
+    static = generate_static(args.vessels, span=int(ais.t.max()) - START_T)
+    reference, batch_time = timed(batch_visits, ais, static)
+    detector = BerthVisitDetector(median_sample=args.median_sample)
+    visits, stream_time = timed(lambda: visits_frame(stream_visits(messages(ais), detector)))
+    visits = visits.sort_values(['sourcemmsi', 'start']).reset_index(drop=True)
+    reference = reference.sort_values(['sourcemmsi', 'start']).reset_index(drop=True)
+    assert len(visits) == len(reference), 'visit counts differ'
+    assert (visits[['sourcemmsi', 'start', 'end']].values == reference[['sourcemmsi', 'start', 'end']].values).all(), 'visits differ'
+    lat_m = np.abs(visits.lat.values - reference.lat.values) * METERS_PER_DEGREE
+    lon_m = np.abs(visits.lon.values - reference.lon.values) * METERS_PER_DEGREE * np.cos(np.radians(reference.lat.values))
+    print(f'points={len(ais)} visits={len(visits)}')
+    print(f'batch:  {batch_time:.2f}s')
+    print(f'stream: {stream_time:.2f}s ({stream_time/len(ais)*1e6:.1f}us/message)')
+    print(f'center error: max {max(lat_m.max(), lon_m.max()):.2f} m')
@@ -0,0 +1,43 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import time
+import numpy as np
+from dbscan import fit_dbscan, neighbourhood_graph, restrict_graph, dbscan_from_graph, EARTH_RADIUS_KM
+
+
+def make_centers(n_centers, n_berths=200, seed=0):
+    # Berth visit centers scattered around berths plus uniform noise
+    rng = np.random.default_rng(seed)
+    berths = rng.uniform([48.3, -4.6], [48.4, -4.4], (n_berths, 2))
+    clustered = berths[rng.integers(n_berths, size=n_centers*3//4)] + rng.normal(0, 0.0002, (n_centers*3//4, 2))
+    noise = rng.uniform([48.3, -4.6], [48.4, -4.4], (n_centers - len(clustered), 2))
+    return np.vstack([clustered, noise])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare a DBSCAN sweep over one neighbourhood graph against separate fits')
+    parser.add_argument('--centers', type=int, default=50000)
+    args = parser.parse_args()
+    coords = make_centers(args.centers)
+    grid = [(eps/EARTH_RADIUS_KM, min_samples) for eps in np.linspace(0.01, 0.1, 10) for min_samples in (3, 5)]
+    start = time.perf_counter()
+    separate = [fit_dbscan(coords, eps, min_samples).labels_ for eps, min_samples in grid]
+    separate_time = time.perf_counter() - start
+    start = time.perf_counter()
+    graph = neighbourhood_graph(coords, max(eps for eps, _ in grid))
+    swept = {}
+    for eps, min_samples in sorted(grid, reverse=True):
+        if graph.data.max() > eps:
+            graph = restrict_graph(graph, eps)
+        swept[(eps, min_samples)] = dbscan_from_graph(graph, eps, min_samples)
+    swept = [swept[setting] for setting in grid]
+    sweep_time = time.perf_counter() - start
+    start = time.perf_counter()
+    fit_dbscan(coords, grid[-1][0], grid[-1][1])
+    one_fit = time.perf_counter() - start
+    assert all((a == b).all() for a, b in zip(separate, swept)), 'sweep labels differ from separate fits'
+    print(f'centers={args.centers} settings={len(grid)}')
+    print(f'one fit:        {one_fit:.2f}s')
+    print(f'separate fits:  {separate_time:.2f}s')
+    print(f'sweep:          {sweep_time:.2f}s')
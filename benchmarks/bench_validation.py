@@ -0,0 +1,72 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import time
+import numpy as np
+import geopandas as gpd
+import shapely
+import config as cfg
+from validation import QuayReference
+from synthetic import planted_berths, BERTHS_PER_QUAY, METERS_PER_DEGREE, QUAY_ORIGIN, SEA_POINT
+
+
+def make_quays(n_berths, n_extra, seed=0):
+    # A line along every row of planted berths, plus short quay segments spread over the port
+    rng = np.random.default_rng(seed)
+    berths = planted_berths(n_berths)
+    rows = [shapely.LineString(list(zip(quay.lon, quay.lat))) for _, quay in berths.groupby(berths.berth // BERTHS_PER_QUAY) if len(quay) > 1]
+    lon, lat = rng.uniform(SEA_POINT[0], QUAY_ORIGIN[0], n_extra), rng.uniform(SEA_POINT[1], QUAY_ORIGIN[1], n_extra)
+    angle, length = rng.uniform(0, np.pi, n_extra), rng.uniform(50, 300, n_extra) / METERS_PER_DEGREE
+    extra = shapely.linestrings(np.stack([np.c_[lon, lat], np.c_[lon + length * np.cos(angle), lat + length * np.sin(angle)]], axis=1))
+    return gpd.GeoDataFrame(geometry=list(rows) + list(extra), crs='epsg:4326'), berths
+
+def make_polygons(berths, n_polygons, seed=0):
+    # Polygons around the berths and around random points of the port
+    rng = np.random.default_rng(seed)
+    n_random = max(n_polygons - len(berths), 0)
+    lon = np.r_[berths.lon.values, rng.uniform(SEA_POINT[0], QUAY_ORIGIN[0] + 0.03, n_random)]
+    lat = np.r_[berths.lat.values, rng.uniform(SEA_POINT[1], QUAY_ORIGIN[1] + 0.03, n_random)]
+    hulls = shapely.buffer(shapely.points(lon, lat), rng.uniform(20, 80, len(lon)) / METERS_PER_DEGREE)
+    return gpd.GeoDataFrame({'cluster_id': np.arange(len(lon))}, geometry=hulls, crs='epsg:4326')
+
+def loop_validation(polygons, quays, tolerance):
+    # The pairwise loop of the old validate_polygons, with the match flags kept instead of asserted
+    polygon_matched = np.zeros(len(polygons), dtype=bool)
+    quay_matched = np.zeros(len(quays), dtype=bool)
+    pieces = [[] for _ in quays]
+    for i, polygon in enumerate(polygons):
+        for j, quay in enumerate(quays):
+            if polygon.distance(quay) <= tolerance:
+                polygon_matched[i] = quay_matched[j] = True
+                pieces[j].append(shapely.intersection(quay, shapely.buffer(polygon, tolerance)))
+    matched_length = sum(shapely.union_all(p).length for p in pieces if p)
+    return polygon_matched, quay_matched, matched_length
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the STRtree validation against the pairwise loop')
+    parser.add_argument('--polygons', type=int, default=500)
+    parser.add_argument('--quays', type=int, default=2000, help='quay segments besides the planted quays')
+    parser.add_argument('--berths', type=int, default=40)
+    parser.add_argument('--tolerance', type=float, default=cfg.VALIDATION_TOLERANCE_M)
+    args = parser.parse_args()
+    quays, berths = make_quays(args.berths, args.quays)
+    polygons = make_polygons(berths, args.polygons)
+    reference, build_time = timed(QuayReference, quays)
+    (summary, per_polygon), score_time = timed(reference.score, polygons, args.tolerance)
+    (polygon_matched, quay_matched, matched_length), loop_time = timed(loop_validation, reference.project(polygons), reference.quays, args.tolerance)
+    assert ((per_polygon.nearest_quay_m <= args.tolerance).values == polygon_matched).all(), 'matched polygons differ'
+    assert summary['recall'] == quay_matched.mean(), 'matched quays differ'
+    assert np.isclose(summary['matched_length_m'], matched_length), 'matched quay lengths differ'
+    assert (per_polygon.quays.values[berths.berth.values] > 0).all(), 'a planted berth is not matched'
+    print(f'polygons={summary["polygons"]} quays={summary["quays"]} tolerance={args.tolerance}m')
+    print(f'precision {summary["precision"]:.3f} recall {summary["recall"]:.3f} '
+          f'matched length {summary["matched_length_m"]:.0f} of {summary["quay_length_m"]:.0f}m')
+    print(f'pairwise loop:   {loop_time:.2f}s')
+    print(f'reference build: {build_time*1000:.1f}ms')
+    print(f'STRtree scoring: {score_time*1000:.1f}ms ({loop_time/score_time:.0f}x)')
@@ -0,0 +1,168 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import argparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+# Synthetic AIS and static data in the schema of the Brest data. Every ship
+# alternates between moored visits (navigationalstatus 5) at one of a set of
+# planted berths and transits (status 0) out to sea and back to the next
+# berth. The berths are returned too, so a benchmark can check that the
+# pipeline finds them again.
+
+START_T = 1443650400
+METERS_PER_DEGREE = 111320
+# Berths are laid out along parallel quays in the inner harbour of Brest
+QUAY_ORIGIN = (-4.49, 48.375)
+BERTH_SPACING_M = 250
+QUAY_SPACING_M = 450
+BERTHS_PER_QUAY = 10
+# Ships leave and enter the harbour through the roadstead
+SEA_POINT = (-4.56, 48.33)
+CARGO_TYPES = (70, 89)
+OTHER_TYPES = [30, 37, 52, 60]
+
+def planted_berths(n_berths):
+    # Berth centers, far enough apart that DBSCAN never merges two of them
+    quay, slot = np.divmod(np.arange(n_berths), BERTHS_PER_QUAY)
+    lat = QUAY_ORIGIN[1] + quay * QUAY_SPACING_M / METERS_PER_DEGREE
+    lon = QUAY_ORIGIN[0] + slot * BERTH_SPACING_M / (METERS_PER_DEGREE * np.cos(np.radians(lat)))
+    return pd.DataFrame({'berth': np.arange(n_berths), 'lon': lon, 'lat': lat})
+
+def cycle_points(dwell_hours=(6, 48), transit_hours=(1, 4), moored_interval=180, transit_interval=30):
+    # Mean number of points of a moored visit and the transit to the next berth
+    return np.mean(dwell_hours) * 3600 / moored_interval + np.mean(transit_hours) * 3600 / transit_interval
+
+def generate_ais(n_points, n_vessels=500, n_berths=40, seed=0, dwell_hours=(6, 48), transit_hours=(1, 4),
+                 moored_interval=180, transit_interval=30, gps_noise_m=10, outlier_share=1e-4):
+    """
+    AIS points of `n_vessels` ships, truncated to the first `n_points` in
+    time. Moored ships report every `moored_interval` seconds with
+    `gps_noise_m` of position noise, ships in transit every
+    `transit_interval` seconds. A share `outlier_share` of the moored points
+    jumps about a kilometer away, as GPS glitches do.
+    Returns the AIS frame and the planted berths.
+    """
+    rng = np.random.default_rng(seed)
+    berths = planted_berths(n_berths)
+    # Enough moored/transit cycles per ship to reach n_points
+    n_cycles = int(np.ceil(n_points / n_vessels / cycle_points(dwell_hours, transit_hours, moored_interval, transit_interval))) + 1
+    per_vessel = 2 * n_cycles
+    n_segments = n_vessels * per_vessel
+    vessel = np.repeat(np.arange(n_vessels), per_vessel)
+    moored = np.tile([True, False], n_vessels * n_cycles)
+    duration = np.where(moored, rng.uniform(*dwell_hours, n_segments), rng.uniform(*transit_hours, n_segments)) * 3600
+    duration = duration.astype(np.int64)
+    interval = np.where(moored, moored_interval, transit_interval)
+    # Segment start times, every ship starts at a random time on the first day
+    ends = np.cumsum(duration)
+    vessel_start = np.repeat(ends[::per_vessel] - duration[::per_vessel], per_vessel)
+    seg_start = START_T + np.repeat(rng.integers(0, 86400, n_vessels), per_vessel) + ends - duration - vessel_start
+    # Transits run from the previous berth out to sea and on to the next berth
+    berth = rng.integers(0, n_berths, n_segments)
+    berth_from = np.r_[berth[:1], berth[:-1]]
+    berth_to = np.r_[berth[1:], berth[-1:]]
+    sea_lon = SEA_POINT[0] + rng.normal(0, 0.005, n_segments)
+    sea_lat = SEA_POINT[1] + rng.normal(0, 0.005, n_segments)
+
+    # One row per point, k is the index of the point within its segment
+    counts = np.maximum(duration // interval, 1)
+    seg = np.repeat(np.arange(n_segments), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    t = seg_start[seg] + k * interval[seg] + rng.integers(0, interval[seg] // 2)
+    progress = 2 * k / counts[seg]
+    out = progress < 1
+    a_lon, a_lat = berths.lon.values[berth_from[seg]], berths.lat.values[berth_from[seg]]
+    b_lon, b_lat = berths.lon.values[berth_to[seg]], berths.lat.values[berth_to[seg]]
+    s_lon, s_lat = sea_lon[seg], sea_lat[seg]
+    lon = np.where(out, a_lon + (s_lon - a_lon) * progress, s_lon + (b_lon - s_lon) * (progress - 1))
+    lat = np.where(out, a_lat + (s_lat - a_lat) * progress, s_lat + (b_lat - s_lat) * (progress - 1))
+    is_moored = moored[seg]
+    lon = np.where(is_moored, berths.lon.values[berth[seg]], lon)
+    lat = np.where(is_moored, berths.lat.values[berth[seg]], lat)
+
+    # Course and speed of the transit leg, measured in a local flat projection
+    to_lon, to_lat = np.where(out, s_lon, b_lon), np.where(out, s_lat, b_lat)
+    from_lon, from_lat = np.where(out, a_lon, s_lon), np.where(out, a_lat, s_lat)
+    dx = (to_lon - from_lon) * METERS_PER_DEGREE * np.cos(np.radians(lat))
+    dy = (to_lat - from_lat) * METERS_PER_DEGREE
+    leg_seconds = duration[seg] / 2
+    course = np.degrees(np.arctan2(dx, dy)) % 360
+    sog = np.hypot(dx, dy) / leg_seconds * 1.94384
+    n = len(seg)
+    sog = np.where(is_moored, np.abs(rng.normal(0, 0.1, n)), sog)
+    course = np.where(is_moored, rng.uniform(0, 360, n), course)
+
+    # GPS noise in meters, and glitches of the moored points
+    lat = lat + rng.normal(0, gps_noise_m, n) / METERS_PER_DEGREE
+    lon = lon + rng.normal(0, gps_noise_m, n) / (METERS_PER_DEGREE * np.cos(np.radians(lat)))
+    glitch = is_moored & (rng.random(n) < outlier_share)
+    lon[glitch] += 0.015
+    lat[glitch] += 0.01
+
+    df = pd.DataFrame({
+        'sourcemmsi': (227000000 + vessel[seg]).astype('int32'),
+        'navigationalstatus': np.where(is_moored, 5, 0).astype('float32'),
+        'rateofturn': np.zeros(n, dtype='float32'),
+        'speedoverground': sog.astype('float32'),
+        'courseoverground': course.astype('float32'),
+        'trueheading': course.astype('float32'),
+        'lon': lon.astype('float32'),
+        'lat': lat.astype('float32'),
+        't': t})
+    order = np.argsort(t, kind='stable')[:n_points]
+    return df.iloc[order].reset_index(drop=True), berths
+
+def generate_static(n_vessels=500, seed=0, cargo_share=0.8, span=30*86400):
+    """
+    Two static reports per ship, at the start and halfway through `span`,
+    with a different draught. A share `cargo_share` of the ships has a
+    ship type within CARGO_TYPES, the rest other types.
+    """
+    rng = np.random.default_rng(seed + 1)
+    cargo = rng.random(n_vessels) < cargo_share
+    shiptype = np.where(cargo, rng.integers(CARGO_TYPES[0], CARGO_TYPES[1] + 1, n_vessels), rng.choice(OTHER_TYPES, n_vessels))
+    length = rng.uniform(60, 300, n_vessels)
+    beam = length / rng.uniform(5.5, 7.5, n_vessels)
+    draught = np.round(length / 25, 1)
+    static = pd.DataFrame({
+        'sourcemmsi': (227000000 + np.arange(n_vessels)).astype('int32'),
+        'shiptype': shiptype.astype('float32'),
+        'tobow': (length * 0.6).round().astype('float32'),
+        'tostern': (length * 0.4).round().astype('float32'),
+        'tostarboard': (beam / 2).round().astype('float32'),
+        'toport': (beam / 2).round().astype('float32'),
+        'draught': draught.astype('float32'),
+        't': np.full(n_vessels, START_T)})
+    later = static.assign(draught=(draught * rng.uniform(0.7, 1.0, n_vessels)).round(1).astype('float32'), t=START_T + span // 2)
+    return pd.concat([static, later], ignore_index=True)
+
+def berth_recovery(polygons, berths):
+    """
+    Share of the planted berths inside a cluster polygon (recall) and share
+    of the cluster polygons holding a planted berth (precision). The noise
+    polygon (cluster -1) is left out.
+    """
+    polygons = polygons[polygons.cluster_id >= 0]
+    points = gpd.GeoSeries(gpd.points_from_xy(berths.lon, berths.lat), crs='epsg:4326')
+    berth_idx, polygon_idx = polygons.sindex.query(points, predicate='within')
+    recall = len(np.unique(berth_idx)) / len(berths) if len(berths) else np.nan
+    precision = len(np.unique(polygon_idx)) / len(polygons) if len(polygons) else np.nan
+    return recall, precision
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write synthetic AIS, static and berth CSV files')
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--vessels', type=int, default=500)
+    parser.add_argument('--berths', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out-dir', default='synthetic')
+    args = parser.parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+    ais, berths = generate_ais(args.points, args.vessels, args.berths, args.seed)
+    ais.to_csv(os.path.join(args.out_dir, 'ais.csv'), index=False)
+    generate_static(args.vessels, args.seed).to_csv(os.path.join(args.out_dir, 'static.csv'), index=False)
+    berths.to_csv(os.path.join(args.out_dir, 'berths.csv'), index=False)
+    print(f'{len(ais)} AIS points of {args.vessels} ships at {args.berths} berths written to {args.out_dir}')
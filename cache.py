@@ -0,0 +1,91 @@
+import pandas as pd
+import numpy as np
+import sys, os
+import hashlib
+import pickle
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
+import config as cfg
+
+# Content-addressed on-disk cache for intermediate results. Entries are pickle
+# files named by a key built from fingerprints of their inputs, so a changed
+# input or parameter simply misses. The least recently used entries are
+# removed when the cache grows over cfg.CACHE_MAX_BYTES.
+
+def _update(h, part):
+    if isinstance(part, pd.DataFrame):
+        h.update(pd.util.hash_pandas_object(part, index=False).values.tobytes())
+    elif isinstance(part, (np.ndarray, list)) and len(part) and not isinstance(part[0], str):
+        h.update(np.ascontiguousarray(part).tobytes())
+    else:
+        h.update(repr(part).encode())
+    h.update(b'|')
+
+def make_key(*parts):
+    # Fingerprint of a mix of frames, arrays and plain values
+    h = hashlib.sha1()
+    for part in parts:
+        _update(h, part)
+    return h.hexdigest()
+
+def frame_fingerprint(df, columns):
+    # Hashes the values of `columns`, which costs one pass over the frame
+    return make_key(df[[c for c in columns if c in df]])
+
+def path_fingerprint(path):
+    # Cheap fingerprint of a file or directory tree from file sizes and mtimes
+    stats = []
+    paths = [path] if os.path.isfile(path) else sorted(os.path.join(root, f) for root, _, files in os.walk(path) for f in files)
+    for p in paths:
+        stat = os.stat(p)
+        stats.append((os.path.relpath(p, path), stat.st_size, stat.st_mtime_ns))
+    return make_key(os.path.abspath(path), stats)
+
+def _entry(key, cache_dir):
+    return os.path.join(cache_dir, key + '.pkl')
+
+def cache_load(key, cache_dir=cfg.CACHE_DIR):
+    filepath = _entry(key, cache_dir)
+    if not os.path.exists(filepath):
+        return None
+    # Touch the entry so eviction sees it as recently used
+    os.utime(filepath)
+    with open(filepath, 'rb') as f:
+        return pickle.load(f)
+
+def cache_store(key, value, cache_dir=cfg.CACHE_DIR, max_bytes=cfg.CACHE_MAX_BYTES):
+    os.makedirs(cache_dir, exist_ok=True)
+    filepath = _entry(key, cache_dir)
+    tmp = filepath + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, filepath)
+    evict(max_bytes, cache_dir)
+
+def evict(max_bytes, cache_dir=cfg.CACHE_DIR):
+    # Remove least recently used entries until the cache fits in max_bytes
+    entries = []
+    for f in os.listdir(cache_dir):
+        if f.endswith('.pkl'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, f))
+            except FileNotFoundError:
+                # Removed by another process in the meantime
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, os.path.join(cache_dir, f)))
+    total = sum(size for _, size, _ in entries)
+    for _, size, p in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def cached(key, compute):
+    # Return the cached value of `key`, computing and storing it on a miss
+    value = cache_load(key)
+    if value is None:
+        value = compute()
+        cache_store(key, value)
+    return value
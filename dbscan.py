@@ -1,58 +1,209 @@
 import pandas as pd
 import geopandas as gpd
 from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 import numpy as np
 import sys, os
 sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
 import config as cfg
-from shapely import geometry, wkt
+import shapely
+from storage import read_stage, write_polygons, stage_path
+from cache import cached, make_key, frame_fingerprint, path_fingerprint
+from profiling import profiled
+from validation import reference_available, validate_polygons, print_scores
 
+EARTH_RADIUS_KM = 6371.0088
+# Columns calculate_centers depends on
+CENTER_COLUMNS = ['sourcemmsi', 't', 'lon', 'lat', 'navigationalstatus', 'shiptype', 'berth_num']
 
+
+def berth_visit_centers(df):
+    # Ship, time span and median position of every moored berth visit
+    berth_visits = df[df.navigationalstatus==5].groupby('berth_num')
+    return pd.DataFrame({'sourcemmsi': berth_visits.sourcemmsi.first(), 'start': berth_visits.t.min(), 'end': berth_visits.t.max(),
+                         'lat': berth_visits.lat.median(), 'lon': berth_visits.lon.median()}).reset_index()
+
+@profiled
 def calculate_centers(df):
     df = select_ship_types(df)
-    df.sort_values(['sourcemmsi', 't'], inplace=True)
-    berth_visits = df[df.navigationalstatus==5].groupby('berth_num')
-    lon = berth_visits.lon.apply(pd.Series.median).values
-    lat = berth_visits.lat.apply(pd.Series.median).values
-    center_coords = list(zip(lat,lon))
+    centers = berth_visit_centers(df)
+    center_coords = list(zip(centers.lat.values, centers.lon.values))
     return center_coords
 
-def dbscan_clusters(gdf):
-    coords = calculate_centers(gdf)
-    epsilon = cfg.MAX_EPS_KM
-    db = DBSCAN(eps=epsilon, min_samples=3, algorithm='ball_tree', metric='haversine').fit(np.radians(coords))
+def project_coords(coords, crs=None):
+    # (lat, lon) centers as x/y meters in `crs`, the UTM zone of the centers by default
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    crs = metric_crs(coords) if crs is None else crs
+    points = gpd.GeoSeries(gpd.points_from_xy(coords[:, 1], coords[:, 0]), crs='epsg:4326').to_crs(crs)
+    return np.column_stack([points.x.values, points.y.values])
+
+def fit_dbscan(coords, eps=None, min_samples=None, metric=None, crs=None, n_jobs=None):
+    """
+    Fit DBSCAN to the (lat, lon) centers in degrees. `eps` is in radians in
+    both metrics; with the 'projected' metric the centers are projected to
+    `crs` and clustered with a KD-tree, eps becoming meters on the Earth's
+    mean radius. Parameters default to the config.
+    """
+    epsilon = cfg.MAX_EPS_KM if eps is None else eps
+    min_samples = cfg.MIN_SAMPLES if min_samples is None else min_samples
+    metric = cfg.DBSCAN_METRIC if metric is None else metric
+    n_jobs = cfg.DBSCAN_N_JOBS if n_jobs is None else n_jobs
+    if metric == 'haversine':
+        return DBSCAN(eps=epsilon, min_samples=min_samples, algorithm='ball_tree', metric='haversine', n_jobs=n_jobs).fit(np.radians(coords))
+    if metric == 'projected':
+        return DBSCAN(eps=epsilon*EARTH_RADIUS_KM*1000, min_samples=min_samples, algorithm='kd_tree', metric='euclidean',
+                      n_jobs=n_jobs).fit(project_coords(coords, crs))
+    raise ValueError(f'Unknown DBSCAN metric: {metric}')
+
+def polygons_from_centers(coords, eps=None, min_samples=None, crs=None):
+    crs = metric_crs(coords) if crs is None and len(coords) else crs
+    db = fit_dbscan(coords, eps, min_samples, crs=crs)
     clusters = pd.DataFrame.from_dict({'lat':  [c[0] for c in coords], 'lon':[c[1] for c in coords], 'cluster': db.labels_})
-    poly = make_polygons(clusters)
+    poly = make_polygons(clusters, crs=crs)
     return poly
 
-def make_polygons(clusters):
-    clusters.sort_values(by=['cluster'], ascending=[True], inplace=True)
-    clusters.reset_index(drop=True, inplace=True)
-    clusters['geometry'] = [geometry.Point(xy) for xy in zip(clusters['lon'], clusters['lat'])]
-    poly_clusters = gpd.GeoDataFrame()
-    gb = clusters.groupby('cluster')
-    for y in gb.groups:
-        df0 = gb.get_group(y).copy()
-        point_collection = geometry.MultiPoint(list(df0['geometry']))
-        # point_collection.envelope
-        convex_hull_polygon = point_collection.convex_hull
-        poly_clusters = poly_clusters.append(pd.DataFrame(data={'cluster_id':[y],'geometry':[convex_hull_polygon]}))
-    poly_clusters.reset_index(inplace=True)
-    #poly_clusters.geometry = gpd.GeoSeries.from_wkt(poly_clusters['geometry'])
-    poly_clusters.crs = 'epsg:4326'
-    
-    return poly_clusters
+def cached_centers(source_key, load):
+    """
+    Berth visit centers of the data returned by `load`, cached under the
+    fingerprint `source_key` of that data and the vessel type filter.
+    `load` is only called on a cache miss.
+    """
+    key = make_key('centers', source_key, cfg.VESSEL_TYPES)
+    return cached(key, lambda: calculate_centers(load()))
+
+def cached_polygons(coords, eps=None, min_samples=None, crs=None):
+    # Cluster polygons cached under the centers and the DBSCAN parameters
+    eps = cfg.MAX_EPS_KM if eps is None else eps
+    min_samples = cfg.MIN_SAMPLES if min_samples is None else min_samples
+    key = make_key('polygons', coords, eps, min_samples, cfg.DBSCAN_METRIC, str(crs), cfg.BUFFER_TO_CLUSTERS, cfg.CONCAVE_HULL_RATIO)
+    return cached(key, lambda: polygons_from_centers(coords, eps, min_samples, crs))
 
-def validate_polygons(polygons):
-    validation_data = cfg.VALIDATION_DATA
-    print(polygons.dtypes)
-    polygons.geometry = polygons.geometry.buffer(0.0005)
-    for poly in polygons.geometry:
-        intersect = False
-        for line in validation_data.geometry:
-            if poly.intersects(line):
-                intersect= True
-        assert intersect
+@profiled
+def dbscan_clusters(gdf, crs=None):
+    # `crs` is the metric CRS for the projected metric and the polygons, the UTM zone of the centers by default
+    if cfg.USE_CACHE:
+        coords = cached_centers(frame_fingerprint(gdf, CENTER_COLUMNS), lambda: gdf)
+        return cached_polygons(coords, crs=crs)
+    coords = calculate_centers(gdf)
+    return polygons_from_centers(coords, crs=crs)
+
+def neighbourhood_graph(coords, max_eps):
+    # Sparse haversine distances between all centers closer than max_eps
+    X = np.radians(coords)
+    nn = NearestNeighbors(radius=max_eps, algorithm='ball_tree', metric='haversine').fit(X)
+    return nn.radius_neighbors_graph(X, mode='distance')
+
+def restrict_graph(graph, eps):
+    # Drop the edges of the distance graph that are longer than eps
+    n = graph.shape[0]
+    rows = np.repeat(np.arange(n), np.diff(graph.indptr))
+    keep = graph.data <= eps
+    indptr = np.r_[0, np.cumsum(np.bincount(rows[keep], minlength=n))]
+    return csr_matrix((graph.data[keep], graph.indices[keep], indptr), shape=graph.shape)
+
+def dbscan_from_graph(graph, eps, min_samples):
+    """
+    DBSCAN labels from a sparse distance graph built for an eps at least
+    as large as `eps`. Gives the same labels as DBSCAN.fit: clusters are
+    numbered by their first core point and a border point reachable from
+    several clusters takes the lowest numbered one.
+    """
+    n = graph.shape[0]
+    rows = np.repeat(np.arange(n), np.diff(graph.indptr))
+    cols = graph.indices
+    within = (graph.data <= eps) & (rows != cols)
+    # Every point is its own neighbour
+    core = np.bincount(rows[within], minlength=n) + 1 >= min_samples
+    # Reuse the sparsity structure of the graph, dropped edges become zeros
+    edges = within & core[rows] & core[cols]
+    # Copied, eliminate_zeros would otherwise edit the arrays of `graph`
+    core_graph = csr_matrix((edges.astype(np.float64), cols, graph.indptr), shape=(n, n), copy=True)
+    core_graph.eliminate_zeros()
+    # The graph is symmetric, so strong components are the connected ones
+    # and are found without building the transpose
+    _, components = connected_components(core_graph, directed=True, connection='strong')
+    labels = np.full(n, -1)
+    core_index = np.flatnonzero(core)
+    if len(core_index) == 0:
+        return labels
+    core_components = components[core_index]
+    found, first = np.unique(core_components, return_index=True)
+    cluster_of = np.empty(components.max()+1, dtype=int)
+    cluster_of[found[np.argsort(first)]] = np.arange(len(found))
+    labels[core_index] = cluster_of[core_components]
+    border = within & ~core[rows] & core[cols]
+    border_labels = np.full(n, n)
+    np.minimum.at(border_labels, rows[border], labels[cols[border]])
+    reached = border_labels < n
+    labels[reached] = border_labels[reached]
+    return labels
+
+def metric_crs(coords):
+    # UTM zone of the (lat, lon) centers, for lengths and areas in meters
+    coords = np.asarray(coords)
+    return gpd.GeoSeries(gpd.points_from_xy(coords[:, 1], coords[:, 0]), crs='epsg:4326').estimate_utm_crs()
+
+def polygon_areas(polygons, crs):
+    # Areas of the cluster polygons in square meters
+    polygons = gpd.GeoDataFrame(polygons, crs='epsg:4326')
+    return polygons.to_crs(crs).area.values
+
+def dbscan_sweep(coords, eps_values, min_samples_values, reference=None):
+    """
+    Fit DBSCAN for every combination of eps (radians) and min_samples. The
+    neighbourhood graph is built once for the largest eps and the labels of
+    every setting are derived from it with dbscan_from_graph. Returns one row of cluster
+    statistics per setting and the labels of every setting. With a
+    validation.QuayReference `reference` the rows also hold the scores
+    of the polygons against it.
+    """
+    graph = neighbourhood_graph(coords, max(eps_values))
+    crs = metric_crs(coords)
+    rows, labels = [], {}
+    # Going from the largest eps down, every graph is a subset of the previous
+    for eps in sorted(eps_values, reverse=True):
+        graph = restrict_graph(graph, eps)
+        for min_samples in sorted(min_samples_values):
+            cluster_labels = dbscan_from_graph(graph, eps, min_samples)
+            clusters = pd.DataFrame.from_dict({'lat': [c[0] for c in coords], 'lon': [c[1] for c in coords], 'cluster': cluster_labels})
+            polygons = make_polygons(clusters, crs=crs)
+            areas = polygon_areas(polygons[polygons.cluster_id >= 0], crs)
+            labels[(eps, min_samples)] = cluster_labels
+            rows.append({'eps_m': eps*EARTH_RADIUS_KM*1000, 'min_samples': min_samples,
+                         'clusters': len(set(cluster_labels) - {-1}), 'noise_ratio': (cluster_labels == -1).mean(),
+                         'mean_area_m2': areas.mean() if len(areas) else np.nan,
+                         'max_area_m2': areas.max() if len(areas) else np.nan})
+            if reference is not None:
+                scores, _ = reference.score(polygons)
+                rows[-1].update({k: scores[k] for k in ['precision', 'recall', 'matched_length_m']})
+    return pd.DataFrame(rows).sort_values(['eps_m', 'min_samples'], ignore_index=True), labels
+
+@profiled
+def make_polygons(clusters, buffer=None, concave_ratio=None, crs=None):
+    """
+    Polygons around the points of each DBSCAN cluster. The hulls of all
+    clusters are built in one vectorized pass in a metric projection (the
+    UTM zone of the points unless `crs` is given), buffered by `buffer`
+    meters and returned in WGS84. With `concave_ratio` set, concave hulls
+    with that ratio replace the convex hulls.
+    """
+    buffer = cfg.BUFFER_TO_CLUSTERS if buffer is None else buffer
+    concave_ratio = cfg.CONCAVE_HULL_RATIO if concave_ratio is None else concave_ratio
+    clusters = clusters.sort_values('cluster', kind='stable')
+    ids, group = np.unique(clusters.cluster.values, return_inverse=True)
+    crs = metric_crs(list(zip(clusters.lat, clusters.lon))) if crs is None else crs
+    points = gpd.GeoSeries(gpd.points_from_xy(clusters.lon, clusters.lat), crs='epsg:4326').to_crs(crs)
+    multipoints = shapely.multipoints(points.values, indices=group)
+    if concave_ratio is None:
+        hulls = shapely.convex_hull(multipoints)
+    else:
+        hulls = shapely.concave_hull(multipoints, ratio=concave_ratio)
+    if buffer:
+        hulls = shapely.buffer(hulls, buffer)
+    poly_clusters = gpd.GeoDataFrame({'cluster_id': ids}, geometry=gpd.GeoSeries(hulls, crs=crs).to_crs('epsg:4326'))
+    return poly_clusters
 
 def select_ship_types(df):
     vessel_types = []
@@ -61,14 +212,18 @@ def select_ship_types(df):
     return df[df.shiptype.isin(vessel_types)]
 
 if __name__ == "__main__":
-    df = pd.read_csv('processed_ais.csv')
-    df['geometry'] = df['geometry'].apply(wkt.loads)
-    gdf = gpd.GeoDataFrame(df, crs='epsg:4326')
+    load = lambda: read_stage(cfg.PROCESSED_AIS, columns=CENTER_COLUMNS, geometry=False)
     print('[Stage 2 - Selecting ship types for clustering] Filtering ship types...')
     
     print('[Stage 3 - Data Clustering] Clustering with DBSCAN...')
     print('[Stage 4 - Cluster polygon creation] Create Polygons from Convex Hulls of DBSCAN Clusters...')
 
-    polygons = make_polygons(gdf)
-    #validate_polygons(polygons)
-    polygons.to_csv(cfg.POLYGON_CSV_OUT)
\ No newline at end of file
+    if cfg.USE_CACHE:
+        # The stage is only read when its centers are not cached yet
+        coords = cached_centers(path_fingerprint(stage_path(cfg.PROCESSED_AIS)), load)
+        polygons = cached_polygons(coords)
+    else:
+        polygons = dbscan_clusters(load())
+    write_polygons(polygons)
+    if reference_available():
+        print_scores(validate_polygons(polygons)[0])
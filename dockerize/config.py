@@ -3,15 +3,46 @@ import logging
 CFG_BASEPATH = os.path.dirname(__file__)
 CFG_CSV_OUTPUT_DIR = os.path.join(CFG_BASEPATH, 'data')
 AIS_CSV_IN = os.path.join(CFG_CSV_OUTPUT_DIR, 'shipdata.rds')
+# Parquet conversion of AIS_CSV_IN, rebuilt when the RDS file is newer
+RDS_CACHE = os.path.join(CFG_CSV_OUTPUT_DIR, 'shipdata.parquet')
+# Columns of the RDS data used by the pipeline, other columns are not read
+SHIP_DATA_COLUMNS = ['mmsiserial', 'position_timestamp', 'longitude', 'latitude', 'sog', 'navigational_status', 'ship_type']
+# Ships with at most this many messages are dropped
+MIN_SHIP_MESSAGES = 1000
 
 PORT_FILE = os.path.join(CFG_CSV_OUTPUT_DIR, 'shape' ,'WPI.shp')
 PORT_NAMES = []
 INCLUSION_ZONE = 0.1
 
 MIN_SAMPLES = 5
-MAX_EPS_KM = 0.1/6371.0088
+# DBSCAN epsilon in meters, MAX_EPS_KM is the same distance in radians for the haversine metric
+MAX_EPS_M = 100
+MAX_EPS_KM = MAX_EPS_M/1000/6371.0088
 
 MAPBOX_RESOLUTION = '300x200'
-#MAPBOX_TOKEN = os.environ['MAPBOX_TOKEN']
-BUFFER_TO_CLUSTERS = 0.0005
-LOGGING_LEVEL = logging.DEBUG
\ No newline at end of file
+MAPBOX_TOKEN = os.environ.get('MAPBOX_TOKEN')
+# Static image API, a local stand-in server can be used by changing the base URL
+IMAGE_URL = os.environ.get('IMAGE_BASE_URL', 'https://api.mapbox.com') + '/styles/v1/mapbox/satellite-v9/static/{bounds}/{resolution}?access_token={token}'
+# Cluster images cover this many meters around the cluster centroid
+IMAGE_RADIUS_M = 200
+IMAGE_DIR = os.path.join(CFG_CSV_OUTPUT_DIR, 'img')
+# Downloaded images by bounds and resolution, reruns skip the cached ones
+IMAGE_CACHE_DIR = os.path.join(CFG_CSV_OUTPUT_DIR, 'img', 'cache')
+# Concurrent image requests, retries and timeout in seconds per request
+IMAGE_WORKERS = 8
+IMAGE_RETRIES = 3
+IMAGE_TIMEOUT = 30
+# Buffer around the cluster hulls in meters
+BUFFER_TO_CLUSTERS = 20
+# Concave hull ratio between 0 and 1 for the cluster polygons, None for convex hulls
+CONCAVE_HULL_RATIO = None
+# Number of AIS points labelled per STRtree query, None labels all at once
+LABEL_CHUNK_SIZE = 1000000
+LOGGING_LEVEL = logging.DEBUG
+# JSON file for the per-stage wall/CPU time, peak RSS and row counts, None disables profiling
+PROFILE_OUT = 'data/results/profile.json'
+# Also write a cProfile dump per top-level stage and record tracemalloc peaks
+PROFILE_CPROFILE = False
+PROFILE_TRACEMALLOC = False
+# Smallest increases reported as regressions by profiling.py, below these it is noise
+PROFILE_MIN_DIFFERENCE = {'wall_s': 0.5, 'cpu_s': 0.5, 'peak_rss_increase_mb': 50}
\ No newline at end of file
@@ -1,64 +1,101 @@
 import pandas as pd
+import sys, os
 import numpy as np
 import geopandas as gpd
 import config as cfg
+# Modules shared with the pipeline in the repository root (copied next to this file in the image)
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import datetime
 from sklearn.cluster import DBSCAN
 import pyreadr
-from shapely import geometry, wkt
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
 import pyproj
-from shapely.geometry import Point
-from functools import partial
-from shapely.ops import transform
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import shutil
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+from profiling import profiled, start_profiling, stop_profiling, print_summary, write_profile
+from polygon_index import PolygonIndex
 
-## For logging purposes
-class TimeFilter(logging.Filter):
-    def filter(self, record):
-        try:
-          last = self.last
-        except AttributeError:
-          last = record.relativeCreated
-        delta = datetime.datetime.fromtimestamp(record.relativeCreated/1000.0) - datetime.datetime.fromtimestamp(last/1000.0)
-        record.relative = '{0:.2f}'.format(delta.seconds + delta.microseconds/1000000.0)
-        self.last = record.relativeCreated
-        return True
+def convert_rds(rds_path=cfg.AIS_CSV_IN, cache_path=cfg.RDS_CACHE):
+    """
+    Convert the RDS file once to Parquet, which can be read by column.
+    String columns with few distinct values are stored dictionary encoded
+    and read back as categoricals.
+    """
+    logging.info('[Converting RDS to Parquet]')
+    table = pa.Table.from_pandas(pyreadr.read_r(rds_path)[None], preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if (pa.types.is_string(field.type) or pa.types.is_large_string(field.type)) and 2 * len(table.column(i).unique()) < len(table):
+            table = table.set_column(i, field.name, table.column(i).dictionary_encode())
+    # Written under a temporary name so an interrupted conversion is not used as cache
+    pq.write_table(table, cache_path + '.tmp')
+    os.replace(cache_path + '.tmp', cache_path)
+
+def port_boxes():
+    # Bounding boxes of the inclusion zones around cfg.PORT_NAMES
+    ports = gpd.read_file(cfg.PORT_FILE)
+    port_points = ports[ports.PORT_NAME.isin(cfg.PORT_NAMES)].geometry.values
+    return [port.buffer(cfg.INCLUSION_ZONE).envelope.bounds for port in port_points]
 
+@profiled
+def load_ship_data(rds_path=cfg.AIS_CSV_IN, cache_path=cfg.RDS_CACHE, columns=cfg.SHIP_DATA_COLUMNS, boxes=None):
+    """
+    Read the AIS messages from the Parquet conversion of the RDS file,
+    converting it first if it is missing or older than the RDS file. Only
+    `columns` are read. Duplicates, moored messages with sog over 1,
+    messages outside all `boxes` (xmin, ymin, xmax, ymax) and ships with at
+    most cfg.MIN_SHIP_MESSAGES messages are dropped through one combined
+    mask, and the rows are returned sorted by ship and time.
+    """
+    if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(rds_path):
+        convert_rds(rds_path, cache_path)
+    names = pq.read_schema(cache_path).names
+    df = pq.read_table(cache_path, columns=[c for c in columns if c in names]).to_pandas(self_destruct=True, split_blocks=True)
+    # Sort once by ship and time; the sort is stable so the first of duplicate messages is kept
+    codes, ships = pd.factorize(df.mmsiserial, sort=True)
+    t = df.position_timestamp.values.view('int64') if df.position_timestamp.dtype.kind == 'M' else df.position_timestamp.values
+    span = int(t.max()) - int(t.min()) + 1 if len(t) else 1
+    if (len(ships) + 1) * span < np.iinfo(np.int64).max:
+        order = np.argsort((codes.astype(np.int64) + 1) * span + (t - t.min()), kind='stable')
+    else:
+        order = np.lexsort((t, codes))
+    codes, t = codes[order], t[order]
+    keep = np.r_[True, (codes[1:] != codes[:-1]) | (t[1:] != t[:-1])] & (codes >= 0)
+    keep &= ~((df.sog.values > 1) & (df.navigational_status == 'Moored').values)[order]
+    if boxes:
+        lon, lat = df.longitude.values[order], df.latitude.values[order]
+        in_box = np.zeros(len(df), dtype=bool)
+        for xmin, ymin, xmax, ymax in boxes:
+            in_box |= (lon >= xmin) & (lon <= xmax) & (lat >= ymin) & (lat <= ymax)
+        keep &= in_box
+    # Drop ships with too few messages left
+    counts = np.bincount(codes[keep], minlength=len(ships))
+    keep &= counts[codes] > cfg.MIN_SHIP_MESSAGES
+    rows = order[keep]
+    return df.take(rows).reset_index(drop=True)
 
+@profiled
 def preprocess_dry_docks(df):
     logging.info('[Start preprocessing]')
-    df.drop_duplicates(['mmsiserial', 'position_timestamp'], inplace=True)
-    df.sort_values('position_timestamp', inplace=True)
-    df.drop(df[(df.sog>1) & (df.navigational_status=='Moored')].index, inplace=True)
-    # Drop ships with less than 1000 messages
-    mmsis = (df.groupby('mmsiserial').size()>1000)
-    mmsis = mmsis[mmsis==True]
-    df = df[df.MMSI.isin(list(mmsis[mmsis==True].index))]
+    # Rows come filtered and sorted by ship and time from load_ship_data
     gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.longitude, df.latitude), crs ='epsg:4326')
     logging.info('[Made geodataframe]')
     gdf['mmsiserial'] = gdf['mmsiserial'].astype('category')
     gdf['nav_num'] = pd.factorize(gdf.navigational_status)[0]
-    gdf.sort_values(['mmsiserial','position_timestamp'], inplace=True)
     gdf['prev_mmsi'] = gdf.mmsiserial.shift()
     gdf['new_berth'] = ((gdf.nav_num.diff()!=0) | (gdf.mmsiserial!=gdf.prev_mmsi))
     gdf['berth_num'] = gdf.new_berth.cumsum()
     logging.info('[Preprocess complete]')
     return gdf
 
-def select_ports(df):
-    dfs = []
-    ports = gpd.read_file(cfg.PORT_FILE)
-    port_points = ports[ports.PORT_NAME.isin(cfg.PORT_NAMES)].geometry.values
-    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.LON, df.LAT), crs = 'epsg:4326')
-    distance = cfg.INCLUSION_ZONE
-    for port in port_points:
-        circle_buffer = port.buffer(distance)
-        xmin, ymin, xmax, ymax = circle_buffer.envelope.bounds
-        dfs.append(gdf.cx[xmin:xmax, ymin:ymax])
-    df = pd.concat(dfs, ignore_index=True)
-    return df
-
+@profiled
 def calculate_centers(df):
     logging.info('[Calculate centers for mooring places]')
     df.sort_values(['mmsiserial', 'position_timestamp'], inplace=True)
@@ -69,37 +106,56 @@ def calculate_centers(df):
     logging.info('[Center calculation complete]')
     return center_coords
 
+@profiled
 def dbscan_clusters(gdf):
     logging.info('[Run DBSCAN algorithm]')
     coords = calculate_centers(gdf)
     db = DBSCAN(eps=cfg.MAX_EPS_KM, min_samples=cfg.MIN_SAMPLES, algorithm='ball_tree', metric='haversine').fit(np.radians(coords))
     clusters = pd.DataFrame.from_dict({'lat':  [c[0] for c in coords], 'lon':[c[1] for c in coords], 'cluster': db.labels_})
     poly = make_polygons(clusters)
-    polygons = gpd.GeoDataFrame(polygons)
-    polygons.geometry= polygons.geometry.buffer(0.0002)
     logging.info('[Clustering complete]')
     return poly
 
-def make_polygons(clusters):
-    clusters.sort_values(by=['cluster'], ascending=[True], inplace=True)
-    clusters.reset_index(drop=True, inplace=True)
-    clusters['geometry'] = [geometry.Point(xy) for xy in zip(clusters['lon'], clusters['lat'])]
-    poly_clusters = gpd.GeoDataFrame()
-    gb = clusters.groupby('cluster')
-    for y in gb.groups:
-        df0 = gb.get_group(y).copy()
-        point_collection = geometry.MultiPoint(list(df0['geometry']))
-        # point_collection.envelope
-        convex_hull_polygon = point_collection.convex_hull
-        poly_clusters = poly_clusters.append(pd.DataFrame(data={'anchorage_id':[y],'geometry':[convex_hull_polygon]}))
-    poly_clusters.reset_index(inplace=True)
-    #poly_clusters.geometry = gpd.GeoSeries.from_wkt(poly_clusters['geometry'])
-    poly_clusters.crs = 'epsg:4326'
-    poly_clusters['size'] = poly_clusters.anchorage_id.map(clusters.cluster.value_counts())
-    poly_clusters['center'] = poly_clusters.geometry.apply(lambda x: x.centroid)
-    
+def utm_zones(lon, lat):
+    # EPSG codes of the UTM zones of the positions
+    zone = np.clip(np.floor((np.asarray(lon) + 180) / 6).astype(int) + 1, 1, 60)
+    return np.where(np.asarray(lat) >= 0, 32600, 32700) + zone
+
+@profiled
+def make_polygons(clusters, buffer=cfg.BUFFER_TO_CLUSTERS, concave_ratio=cfg.CONCAVE_HULL_RATIO):
+    """
+    Polygons around the points of each DBSCAN cluster, buffered by
+    `buffer` meters. Every cluster is built in the UTM zone of its first
+    point; the clusters of one zone are built in one vectorized pass.
+    `concave_ratio` switches to concave hulls.
+    """
+    clusters = clusters.sort_values('cluster', kind='stable')
+    ids, first, group, size = np.unique(clusters.cluster.values, return_index=True, return_inverse=True, return_counts=True)
+    lon, lat = clusters.lon.values, clusters.lat.values
+    # The points of a cluster are within a few epsilons of each other, so any of
+    # them gives its zone, and unlike a mean it does not wrap at the antimeridian
+    zones = utm_zones(lon[first], lat[first])
+    hulls = np.empty(len(ids), dtype=object)
+    centers = np.empty(len(ids), dtype=object)
+    for zone in np.unique(zones):
+        in_zone = zones == zone
+        members = in_zone[group]
+        x, y = transformer('epsg:4326', f'epsg:{zone}').transform(lon[members], lat[members])
+        # Groups of the zone numbered from 0 in cluster order
+        multipoints = shapely.multipoints(shapely.points(x, y), indices=np.cumsum(in_zone)[group[members]] - 1)
+        if concave_ratio is None:
+            zone_hulls = shapely.convex_hull(multipoints)
+        else:
+            zone_hulls = shapely.concave_hull(multipoints, ratio=concave_ratio)
+        centers[in_zone] = gpd.GeoSeries(shapely.centroid(zone_hulls), crs=f'epsg:{zone}').to_crs('epsg:4326').values
+        if buffer:
+            zone_hulls = shapely.buffer(zone_hulls, buffer)
+        hulls[in_zone] = gpd.GeoSeries(zone_hulls, crs=f'epsg:{zone}').to_crs('epsg:4326').values
+    poly_clusters = gpd.GeoDataFrame({'anchorage_id': ids, 'size': size, 'center': gpd.GeoSeries(centers, crs='epsg:4326').values},
+                                     geometry=gpd.GeoSeries(hulls, crs='epsg:4326'))
     return poly_clusters
 
+@profiled
 def ship_duration_analysis(gdf):
     logging.info('[Start duration analysis]')
     gdf.sort_values(['mmsiserial', 'position_timestamp'], inplace=True)
@@ -118,6 +174,7 @@ def ship_duration_analysis(gdf):
     result.to_csv('data/results/ship_durations.csv')
     logging.info('[Duration analysis complete]')
 
+@profiled
 def ship_type_analysis(gdf):
     logging.info('[Start ship type analysis]')
     ship_percentage = (gdf.groupby('cluster').ship_type.value_counts()/gdf.groupby('cluster').size()*100).drop(index=-1).reset_index(level=[1])
@@ -126,16 +183,12 @@ def ship_type_analysis(gdf):
     ship_percentage.to_csv('data/results/ship_types.csv')
     logging.info('[Ship type analysis complete]')
 
+@profiled
 def add_clusters_to_data(gdf, polygons):
     logging.info('[Adding clusters to data]')
-    gdf['cluster'] = -1
-    for i, cluster in polygons[1:].iterrows():
-        geom = cluster.geometry
-        sindex = gdf.sindex
-        possible_matches_index = list(sindex.intersection(geom.bounds))
-        possible_matches = gdf.iloc[possible_matches_index]
-        precise_matches = possible_matches[possible_matches.intersects(geom)]
-        gdf.loc[precise_matches.index, 'cluster'] = cluster.anchorage_id
+    points = gdf.geometry.values
+    index = PolygonIndex.from_polygons(polygons, 'anchorage_id', default=-1)
+    gdf['cluster'] = index.lookup(shapely.get_x(points), shapely.get_y(points), cfg.LABEL_CHUNK_SIZE)
     gdf.sort_values(['mmsiserial', 'position_timestamp'], inplace=True)
     logging.info('[Adding clusters to data done]')
     gdf['enters_cluster'] = (((gdf.cluster.diff() != 0) & (gdf.cluster>-1)) | (gdf.mmsiserial!=gdf.prev_mmsi))
@@ -149,47 +202,94 @@ def add_clusters_to_data(gdf, polygons):
     logging.info('[Calculated changes in clusters]')
     return gdf
 
-def buffer_in_meters(coords, radius):
-    lng = coords.geometry.centroid.xy[0][0]
-    lat = coords.geometry.centroid.xy[1][0]
-    proj_meters = pyproj.Proj('epsg:3857')
-    proj_latlng = pyproj.Proj('epsg:4326')
-    project_to_meters = partial(pyproj.transform, proj_latlng, proj_meters)
-    project_to_latlng = partial(pyproj.transform, proj_meters, proj_latlng)
-    pt_latlng = Point(lng, lat)
-    pt_meters = transform(project_to_meters, pt_latlng)
-    buffer_meters = pt_meters.buffer(radius)
-    buffer_latlng = transform(project_to_latlng, buffer_meters)
-    return buffer_latlng
-
-def download_image(polygon):
-    centroid = buffer_in_meters(polygon, 200)
-    resolution = cfg.MAPBOX_RESOLUTION
-    token = cfg.MAPBOX_TOKEN
-    bounds = '[' + ','.join([str(x) for x in centroid.bounds]) + ']'
-    url = f'https://api.mapbox.com/styles/v1/mapbox/satellite-v9/static/{bounds}/{resolution}?access_token={token}'
-    r = requests.get(url)
-    filename = f'data/img/cluster{polygon.anchorage_id}.jpeg'
-    if r.status_code == 200:
-        with open(filename, 'wb') as f:
+@lru_cache(maxsize=None)
+def transformer(crs_from, crs_to):
+    # Transformers are expensive to create, one is kept per pair of CRSs
+    return pyproj.Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+def image_bounds(polygons, radius=cfg.IMAGE_RADIUS_M):
+    """
+    Bounds (xmin, ymin, xmax, ymax) in degrees of the square `radius`
+    meters around the centroid of every cluster polygon, measured in Web
+    Mercator like the map tiles. All clusters are projected at once.
+    """
+    centroids = shapely.centroid(np.asarray(polygons.geometry.values))
+    x, y = transformer('epsg:4326', 'epsg:3857').transform(shapely.get_x(centroids), shapely.get_y(centroids))
+    xmin, ymin = transformer('epsg:3857', 'epsg:4326').transform(x - radius, y - radius)
+    xmax, ymax = transformer('epsg:3857', 'epsg:4326').transform(x + radius, y + radius)
+    return np.column_stack([xmin, ymin, xmax, ymax])
+
+def image_session(max_workers=cfg.IMAGE_WORKERS, retries=cfg.IMAGE_RETRIES):
+    # Pooled connections for all workers, retrying throttled and failed requests with backoff
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def _fetch_image(session, url, cache_file, filename):
+    if not os.path.exists(cache_file):
+        try:
+            r = session.get(url, timeout=cfg.IMAGE_TIMEOUT)
+        except requests.RequestException:
+            # Retries used up, timeouts and dropped connections fail only this cluster
+            return None
+        if r.status_code != 200:
+            return r.status_code
+        # Written under a temporary name so a failed write is not taken as cached
+        with open(cache_file + '.tmp', 'wb') as f:
             f.write(r.content)
-    return r
+        os.replace(cache_file + '.tmp', cache_file)
+    shutil.copyfile(cache_file, filename)
+    return 200
+
+@profiled
+def fetch_images(polygons, url_template=cfg.IMAGE_URL, resolution=cfg.MAPBOX_RESOLUTION, image_dir=cfg.IMAGE_DIR,
+                 cache_dir=cfg.IMAGE_CACHE_DIR, max_workers=cfg.IMAGE_WORKERS, session=None):
+    """
+    Download a satellite image of every cluster polygon to
+    `image_dir`/cluster<anchorage_id>.jpeg, with at most `max_workers`
+    requests at a time. Images are cached in `cache_dir` under their
+    bounds and resolution, so reruns only download changed clusters.
+    Returns the HTTP status of every cluster, 200 for cached images and
+    None when no response was received after the retries.
+    """
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    session = session or image_session(max_workers)
+    jobs = []
+    for anchorage_id, bounds in zip(polygons.anchorage_id.values, image_bounds(polygons)):
+        bounds = '[' + ','.join([str(x) for x in bounds]) + ']'
+        url = url_template.format(bounds=bounds, resolution=resolution, token=cfg.MAPBOX_TOKEN)
+        # The token is left out of the key, it does not change the image
+        key = hashlib.sha1(url_template.format(bounds=bounds, resolution=resolution, token='').encode()).hexdigest()
+        jobs.append((anchorage_id, url, os.path.join(cache_dir, key + '.jpeg'), os.path.join(image_dir, f'cluster{anchorage_id}.jpeg')))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {anchorage_id: pool.submit(_fetch_image, session, url, cache_file, filename)
+                   for anchorage_id, url, cache_file, filename in jobs}
+        status = {anchorage_id: future.result() for anchorage_id, future in futures.items()}
+    failed = [anchorage_id for anchorage_id, code in status.items() if code != 200]
+    if failed:
+        logging.warning(f'[Image download failed for clusters {failed}]')
+    return status
 
 if __name__ == "__main__":
     logging.basicConfig(filename='app.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=cfg.LOGGING_LEVEL)
-    fmt = logging.Formatter(fmt="%(asctime)s (%(relative)ss) %(message)s")
+    fmt = logging.Formatter(fmt="%(asctime)s %(message)s")
     log = logging.getLogger()
-    [hndl.addFilter(TimeFilter()) for hndl in log.handlers]
     [hndl.setFormatter(fmt) for hndl in log.handlers]
-    rdf = pyreadr.read_r(cfg.AIS_CSV_IN)
-    df = rdf[None].copy()
-    if cfg.PORT_NAMES:
-        df = select_ports(df)
+    start_profiling(prefix=os.path.splitext(cfg.PROFILE_OUT)[0] if cfg.PROFILE_OUT else None)
+    df = load_ship_data(boxes=port_boxes() if cfg.PORT_NAMES else None)
     df = preprocess_dry_docks(df)
     polygons = dbscan_clusters(df)
 
-    #polygons[1:].apply(lambda x: download_image(x), axis=1)
+    #fetch_images(polygons[polygons.anchorage_id >= 0])
     df = add_clusters_to_data(df, polygons)
     ship_duration_analysis(df)
     ship_type_analysis(df)
-    polygons.to_csv('data/results/clusters.csv')
\ No newline at end of file
+    polygons.to_csv('data/results/clusters.csv')
+    stop_profiling()
+    print_summary()
+    if cfg.PROFILE_OUT:
+        write_profile(cfg.PROFILE_OUT)
\ No newline at end of file
@@ -0,0 +1,260 @@
+import pandas as pd
+import numpy as np
+import sys, os
+import json
+import shutil
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
+import config as cfg
+from sklearn.neighbors import BallTree
+from preprocess import AIS_DTYPES, load_ais, port_bounds, preprocess_data, include_static_data, sparse_columns
+from dbscan import berth_visit_centers, select_ship_types, fit_dbscan, make_polygons
+from analysis import (add_clusters_to_data, label_points, analysis_arrays, result_aggregates, merge_result_aggregates,
+                      aggregate_results, RESULT_AGGREGATES, DIMENSION_COLUMNS)
+from reporting import write_table
+from schema import compact_frame
+from storage import write_stage, read_stage, stage_exists, stage_path, write_polygons, read_polygons
+
+# Incremental mode keeps the state of the previous run in cfg.STATE_DIR so a new
+# day of AIS can be added without preprocessing the history again:
+#
+#   centers     closed berth visits with their DBSCAN label and core flag
+#   carry       raw AIS rows carried to the next run: the last row of every
+#               ship and the rows of berth visits still open at the end
+#   runs        runs of points of a ship with the same cluster label
+#   dimensions  per cluster value counts of length, beam and draft
+#   drafts      per cluster number and sum of draft changes
+#   last_drafts last reported draft of every ship
+#
+# runs, dimensions and drafts are the result aggregates of analysis.py, so the
+# result table is the one of a full run over the same data. Carried rows are
+# flagged with `carried` (1 = last row of a ship, 2 = row of an open berth
+# visit) and are not counted again in the aggregates.
+
+STATE_TABLES = {
+    'centers': {'sourcemmsi': 'int32', 'start': 'int64', 'end': 'int64', 'lat': 'float64', 'lon': 'float64', 'cluster': 'int64', 'core': 'bool'},
+    'carry': dict(AIS_DTYPES, carried='int8'),
+    **RESULT_AGGREGATES,
+    'last_drafts': {'sourcemmsi': 'int32', 'draft': 'float32'},
+}
+POLYGON_FILE = 'polygons.parquet'
+META_FILE = 'meta.json'
+
+def current_parameters():
+    # Changing any of these invalidates the stored clusters
+    return {'eps': cfg.MAX_EPS_KM, 'min_samples': cfg.MIN_SAMPLES, 'metric': cfg.DBSCAN_METRIC, 'buffer': cfg.BUFFER_TO_CLUSTERS,
+            'concave_ratio': cfg.CONCAVE_HULL_RATIO, 'vessel_types': [list(types) for types in cfg.VESSEL_TYPES]}
+
+def empty_state():
+    state = {name: pd.DataFrame({c: pd.Series(dtype=d) for c, d in dtypes.items()}) for name, dtypes in STATE_TABLES.items()}
+    state['polygons'] = None
+    state['meta'] = {'parameters': current_parameters(), 'last_t': None, 'sparse': []}
+    return state
+
+def load_state(state_dir=cfg.STATE_DIR):
+    paths = {name: os.path.join(state_dir, name + '.parquet') for name in STATE_TABLES}
+    # A state written before a table was added is not used, the run starts from scratch
+    if not os.path.exists(os.path.join(state_dir, META_FILE)) or not all(map(os.path.exists, paths.values())):
+        return None
+    state = {name: compact_frame(pd.read_parquet(path)) for name, path in paths.items()}
+    polygon_file = os.path.join(state_dir, POLYGON_FILE)
+    state['polygons'] = read_polygons(polygon_file) if os.path.exists(polygon_file) else None
+    with open(os.path.join(state_dir, META_FILE)) as f:
+        state['meta'] = json.load(f)
+    return state
+
+def save_state(state, state_dir=cfg.STATE_DIR):
+    os.makedirs(state_dir, exist_ok=True)
+    for name, dtypes in STATE_TABLES.items():
+        state[name][list(dtypes)].to_parquet(os.path.join(state_dir, name + '.parquet'), index=False)
+    if state['polygons'] is not None:
+        write_polygons(state['polygons'], os.path.join(state_dir, POLYGON_FILE))
+    # meta is written last so an interrupted save is not picked up as a state
+    with open(os.path.join(state_dir, META_FILE), 'w') as f:
+        json.dump(state['meta'], f)
+
+def split_carry(df, end_t):
+    """
+    Return the raw rows to carry to the next run and the berth numbers of
+    the visits that are still open at `end_t`. A moored visit is open when
+    it is the last segment of the ship and the ship has reported within
+    cfg.INCREMENTAL_MAX_GAP seconds.
+    """
+    last = df.groupby('sourcemmsi').tail(1)
+    is_open = (last.navigationalstatus==5) & (last.t > end_t - cfg.INCREMENTAL_MAX_GAP)
+    open_berths = last.berth_num[is_open].values
+    open_rows = df.berth_num.isin(open_berths)
+    carry = df[open_rows | df.index.isin(last.index)].copy()
+    carry['carried'] = np.where(open_rows.loc[carry.index], 2, 1).astype('int8')
+    return carry[list(STATE_TABLES['carry'])], open_berths
+
+def closed_centers(df, open_berths):
+    # Centers of the berth visits closed in this run
+    df = select_ship_types(df)
+    centers = berth_visit_centers(df)
+    # Skip visits made up only of the last rows carried from a closed visit
+    new_rows = df[df.carried!=1].berth_num.unique()
+    centers = centers[~centers.berth_num.isin(open_berths) & centers.berth_num.isin(new_rows)]
+    return centers.drop(columns='berth_num').reset_index(drop=True)
+
+def assign_centers(old, new, polygons):
+    """
+    Label new berth visit centers with the existing clusters. Returns the
+    labels, the core flags of the old and new centers and whether the new centers change the cluster structure, in
+    which case DBSCAN has to be fitted again. The structure is kept when
+    every new or promoted core point only reaches points of one existing
+    cluster and every labelled center lies inside its cluster polygon.
+    """
+    labels = np.full(len(new), -1)
+    if len(new) == 0:
+        return labels, old.core.values, False
+    if polygons is None or len(old) == 0:
+        return labels, None, True
+    n_old = len(old)
+    coords = np.radians(np.vstack([old[['lat', 'lon']].values, new[['lat', 'lon']].values]))
+    tree = BallTree(coords, metric='haversine')
+    all_labels = np.r_[old.cluster.values, labels]
+    core = np.r_[old.core.values, np.zeros(len(new), dtype=bool)]
+    neighbours = dict(zip(range(n_old, len(coords)), tree.query_radius(coords[n_old:], cfg.MAX_EPS_KM)))
+    for i, n in list(neighbours.items()):
+        core[i] = len(n) >= cfg.MIN_SAMPLES
+    # Old points that gain enough neighbours become core points
+    touched = np.unique(np.concatenate(list(neighbours.values())))
+    touched = touched[touched < n_old]
+    touched = touched[~core[touched]]
+    promoted = []
+    if len(touched):
+        for i, n in zip(touched, tree.query_radius(coords[touched], cfg.MAX_EPS_KM)):
+            if len(n) >= cfg.MIN_SAMPLES:
+                core[i] = True
+                neighbours[i] = n
+                promoted.append(i)
+    new_core = [i for i in range(n_old, len(coords)) if core[i]]
+    # A new core point joins the cluster of its old core neighbours
+    for i in new_core:
+        n = neighbours[i]
+        clusters = np.unique(all_labels[n[(n < n_old) & core[n]]])
+        if len(clusters) != 1 or clusters[0] < 0:
+            return labels, None, True
+        all_labels[i] = clusters[0]
+    # The remaining new points are border points of any core neighbour
+    for i in range(n_old, len(coords)):
+        if not core[i]:
+            n = neighbours[i]
+            n = n[core[n] & (all_labels[n] >= 0)]
+            if len(n):
+                all_labels[i] = all_labels[n[0]]
+    for i in new_core + promoted:
+        if all_labels[i] < 0 or (all_labels[neighbours[i]] != all_labels[i]).any():
+            return labels, None, True
+    labels = all_labels[n_old:]
+    cluster_polygons = polygons[polygons.cluster_id >= 0]
+    inside = label_points(new.lon.values, new.lat.values, cluster_polygons.geometry.values, cluster_polygons.cluster_id.values, default=-1)
+    changed = ((labels >= 0) & (inside != labels)).any()
+    return labels, core, changed
+
+def cluster_all(centers):
+    # Full DBSCAN over every berth visit center, in the order of a full run so the cluster ids match it
+    centers = centers.sort_values(['sourcemmsi', 'start'], kind='stable', ignore_index=True)
+    if len(centers) == 0:
+        return centers, None
+    db = fit_dbscan(list(zip(centers.lat, centers.lon)))
+    centers['cluster'] = db.labels_
+    centers['core'] = False
+    centers.loc[db.core_sample_indices_, 'core'] = True
+    polygons = make_polygons(pd.DataFrame({'lat': centers.lat, 'lon': centers.lon, 'cluster': centers.cluster}))
+    return centers, polygons
+
+def aggregate(gdf, previous_drafts=None):
+    """
+    Result aggregates of a labelled frame and the last reported draft of
+    every ship. Carried rows are already counted in the state and are left
+    out; the runs of the new rows are joined to the stored ones when they
+    are merged. `previous_drafts` are the stored last drafts by MMSI, so
+    draft changes over the run boundary are counted.
+    """
+    new = gdf[gdf.carried==0] if 'carried' in gdf else gdf
+    arrays = analysis_arrays(new)
+    aggregates = result_aggregates(arrays, previous_drafts)
+    reported = arrays['draft'] != 0
+    drafts = pd.DataFrame({'sourcemmsi': arrays['ship_ids'][arrays['ship'][reported]], 'draft': arrays['draft'][reported]})
+    aggregates['last_drafts'] = drafts.drop_duplicates('sourcemmsi', keep='last').astype(STATE_TABLES['last_drafts'])
+    return aggregates
+
+def previous_drafts(state):
+    return state['last_drafts'].set_index('sourcemmsi').draft
+
+def merge_aggregates(state, new):
+    state.update(merge_result_aggregates([state, new]))
+    drafts = pd.concat([state['last_drafts'], new['last_drafts']], ignore_index=True)
+    state['last_drafts'] = drafts.drop_duplicates('sourcemmsi', keep='last').reset_index(drop=True)
+    return state
+
+def results_table(state):
+    # The result table of the full pipeline (cluster_results) from the merged aggregates
+    return aggregate_results(state)
+
+def recompute_from_history(state):
+    # Relabel the whole history with new polygons and rebuild the aggregates
+    history = read_stage(cfg.HISTORY_AIS, columns=['sourcemmsi', 't', 'lon', 'lat'] + DIMENSION_COLUMNS)
+    # The history keeps every column, the sparse ones are decided over all of it as in a full run
+    state['meta']['sparse'] = sparse_columns(history[DIMENSION_COLUMNS].notna().sum(), len(history))
+    history = add_clusters_to_data(history.drop(columns=state['meta']['sparse']), state['polygons'])
+    for name in ['runs', 'dimensions', 'drafts', 'last_drafts']:
+        state[name] = empty_state()[name]
+    return merge_aggregates(state, aggregate(history))
+
+def update(filepath, state_dir=cfg.STATE_DIR, static=None, bounds=None):
+    """
+    Add the AIS rows in `filepath` to the clusters and aggregates kept in
+    `state_dir`. Without a stored state (or after the clustering parameters
+    changed) the run starts from scratch. The clusters are fitted again
+    only when the new berth visits change the cluster structure. `static`
+    and `bounds` default to the configured static data and port.
+    """
+    if bounds is None:
+        bounds = port_bounds()
+    state = load_state(state_dir)
+    if state is None or state['meta']['parameters'] != current_parameters():
+        state = empty_state()
+        if stage_exists(cfg.HISTORY_AIS):
+            shutil.rmtree(stage_path(cfg.HISTORY_AIS))
+    new = load_ais(filepath, bounds)
+    if state['meta']['last_t'] is not None:
+        new = new[new.t > state['meta']['last_t']]
+    new['carried'] = np.int8(0)
+    df = pd.concat([state['carry'], new], ignore_index=True)
+    df = preprocess_data(df)
+    # Every day is written to the history with the same columns
+    df = include_static_data(df, static=static, bounds=bounds, drop_missing=False)
+    df = df.sort_values(['sourcemmsi', 't']).reset_index(drop=True)
+    if len(df) == 0:
+        return state
+    state['carry'], open_berths = split_carry(df, df.t.max())
+    write_stage(df[df.carried==0].drop(columns='carried'), cfg.HISTORY_AIS, append=True)
+    centers = closed_centers(df, open_berths)
+    labels, core_flags, changed = assign_centers(state['centers'], centers, state['polygons'])
+    if changed:
+        centers = pd.concat([state['centers'], centers], ignore_index=True)
+        state['centers'], state['polygons'] = cluster_all(centers)
+        if state['polygons'] is not None:
+            state = recompute_from_history(state)
+    else:
+        state['centers']['core'] = core_flags[:len(state['centers'])]
+        centers['cluster'] = labels
+        centers['core'] = core_flags[len(state['centers']):]
+        state['centers'] = pd.concat([state['centers'], centers], ignore_index=True)
+        if state['polygons'] is not None:
+            # New rows leave out the columns found sparse at the last pass over the history
+            df = add_clusters_to_data(df.drop(columns=state['meta'].get('sparse', [])), state['polygons'])
+            state = merge_aggregates(state, aggregate(df, previous_drafts(state)))
+    state['meta']['last_t'] = int(max(df.t.max(), state['meta']['last_t'] or 0))
+    save_state(state, state_dir)
+    return state
+
+if __name__ == "__main__":
+    filepath = sys.argv[1] if len(sys.argv) > 1 else cfg.AIS_CSV_IN
+    print('[Incremental update] Adding ' + filepath + ' to the stored clusters...')
+    state = update(filepath)
+    if state['polygons'] is not None:
+        write_polygons(state['polygons'])
+        write_table(results_table(state), str(cfg.FILE_PREFIX + '_results.html'))
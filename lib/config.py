@@ -5,12 +5,82 @@ CFG_CSV_OUTPUT_DIR = os.path.join(CFG_BASEPATH, 'data')
 AIS_CSV_IN = os.path.join(CFG_CSV_OUTPUT_DIR,'csv', 'brest_ais.csv')
 STATIC_CSV_IN = os.path.join(CFG_CSV_OUTPUT_DIR, 'csv', 'static_data.csv')
 AIS_CSV_OUT = 'dbscan_clusters.csv'
-POLYGON_CSV_OUT = 'brest_all_small2.csv'
+POLYGON_OUT = 'brest_all_small2.parquet'
+### MULTI-PORT RUNS
+# Ports from the WPI file processed in parallel by multiport.py
+MULTI_PORT_NAMES = ['RADE DE BREST']
+# Worker processes, None uses one per CPU
+N_WORKERS = None
+
+### STAGE OUTPUT
+# Directory for the Parquet datasets passed between the pipeline stages
+STAGE_DIR = 'stages'
+PROCESSED_AIS = 'processed_ais'
+# AIS with cluster labels, written by 'mooring.py label' and read by 'mooring.py analyze'
+LABELLED_AIS = 'labelled_ais'
+# Partition stage output by 'day', by 'sourcemmsi' (hashed to MMSI_BUCKETS) or None
+STAGE_PARTITION = 'day'
+MMSI_BUCKETS = 64
+
+### OUT-OF-CORE RUNS
+# Local Dask scheduler for outofcore.py, 'threads', 'processes' or 'synchronous'.
+# Every MMSI bucket (see MMSI_BUCKETS) has to fit in memory, raise the bucket
+# count for larger inputs.
+DASK_SCHEDULER = 'threads'
+
+### CACHE
+# Cache berth visit centers and DBSCAN polygons between runs
+USE_CACHE = True
+CACHE_DIR = 'cache'
+CACHE_MAX_BYTES = 1024**3
+
+### INCREMENTAL MODE
+# State kept between incremental runs and the stage holding all processed AIS
+STATE_DIR = 'state'
+HISTORY_AIS = 'history_ais'
+# Seconds after which a silent moored ship is considered to have left its berth
+INCREMENTAL_MAX_GAP = 2*86400
+
+### STREAMING VISITS
+# Ships silent for this many seconds are evicted, closing their open berth visit
+STREAM_IDLE_TIMEOUT = 86400
+# Ships tracked at once, the least recently seen ship is evicted beyond this
+STREAM_MAX_VESSELS = 100000
+# Positions kept per open visit for its median center; longer visits use a
+# uniform sample of this size, so their center is approximate
+STREAM_MEDIAN_SAMPLE = 1024
+
+### ROLLUPS
+# Directory of the visit and occupancy rollups written after labelling
+ROLLUP_DIR = 'rollups'
+
+### REPORT
+# Also render the timeline of all cluster visits, slow for many visits
+REPORT_GANTT = False
+
+### PROFILING
+# JSON file for the per-stage wall/CPU time, peak RSS and row counts, None disables profiling
+PROFILE_OUT = None
+# Also write a cProfile dump per top-level stage and record tracemalloc peaks
+PROFILE_CPROFILE = False
+PROFILE_TRACEMALLOC = False
+# Smallest increases reported as regressions by profiling.py, below these it is noise
+PROFILE_MIN_DIFFERENCE = {'wall_s': 0.5, 'cpu_s': 0.5, 'peak_rss_increase_mb': 50}
 FILE_PREFIX = 'all_small'
 ### DBSCAN PARAMETERS
 MIN_SAMPLES = 3
-MAX_EPS_KM = 0.05
-MAX_EPS_KM = MAX_EPS_KM/6371.0088
+# DBSCAN epsilon in meters, MAX_EPS_KM is the same distance in radians for the haversine metric
+MAX_EPS_M = 50
+MAX_EPS_KM = MAX_EPS_M/1000/6371.0088
+# 'haversine' clusters the centers on the sphere with a ball tree, 'projected'
+# projects them to meters in a local metric CRS (the UTM zone of the centers)
+# and uses a KD-tree. The clusters match up to border points near eps, and the
+# projection only pays off for large numbers of centers (about 2-3x faster at
+# 200k centers, about 5x slower at a few thousand), so 'haversine' is the
+# default for single ports
+DBSCAN_METRIC = 'haversine'
+# Processes for the DBSCAN neighbour queries, -1 uses all CPUs
+DBSCAN_N_JOBS = -1
 
 ### DATA WRANGLING
 USE_NAVIGATIONAL_STATUS = True
@@ -21,11 +91,25 @@ PORT_NAME = ['RADE DE BREST']
 VESSEL_TYPES = [(70,89)]
 # Inclusion zone in degrees (0.01 degree is about 1.1 km)
 INCLUSION_ZONE = 0.1
+# Number of AIS CSV rows read at a time when loading
+CSV_CHUNK_SIZE = 1000000
+# Drop ships outside VESSEL_TYPES already when loading. This speeds up loading
+# but the analysis then only covers the clustered vessel types.
+FILTER_VESSEL_TYPES_ON_LOAD = False
 
 ### CLUSTER PARAMETERS
 
-BUFFER_TO_CLUSTERS = 0.0005
+# Buffer around the cluster hulls in meters
+BUFFER_TO_CLUSTERS = 30
+# Concave hull ratio between 0 and 1 for the cluster polygons, None for convex hulls
+CONCAVE_HULL_RATIO = None
+# Number of AIS points labelled per STRtree query, None labels all at once
+LABEL_CHUNK_SIZE = 1000000
+# Reference quay lines the cluster polygons are scored against after clustering,
+# scoring is skipped when the file does not exist or this is None
 VALIDATION_DATA = os.path.join(CFG_CSV_OUTPUT_DIR, 'test', 'test.shp')
+# Meters within which a cluster polygon and a quay line match
+VALIDATION_TOLERANCE_M = 50
 
 
 CSV_FILE_FOR_READ_anchs = os.path.join(CFG_CSV_OUTPUT_DIR, 'ports-to-csv.csv')
@@ -1,32 +1,53 @@
-import pandas as pd
-import numpy as np
-import geopandas as gpd
-from preprocess import preprocess_data, include_static_data
+import sys, os
+import argparse
+import ast
+import importlib
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
 import config as cfg
-from dbscan import dbscan_clusters
-from analysis import add_clusters_to_data, arrival_departing_analysis, analysis_dataframe, ship_type_analysis
-from datetime import datetime
-from shapely import wkt
-import dask.dataframe as dd
+
+# Command line entry point of the pipeline:
+#
+#   python mooring.py [run]                  the whole pipeline in memory
+#   python mooring.py preprocess|cluster|label|analyze
+#                                            one stage, passing Parquet stages
+#   python mooring.py -c MAX_EPS_M=80 -c USE_CACHE=False cluster
+#
+# The pipeline modules, and with them pandas, geopandas, scikit-learn and the
+# plotting libraries, are only imported by the commands that need them, after
+# the config overrides are applied. With --profile-startup a command only
+# imports its modules and prints the import times.
+
+# Modules imported by every command
+COMMAND_MODULES = {
+    'preprocess': ['preprocess', 'storage'],
+    'cluster': ['dbscan', 'validation', 'storage', 'cache'],
+    'label': ['analysis', 'rollups', 'storage'],
+    'analyze': ['analysis', 'reporting', 'storage'],
+    'run': ['preprocess', 'dbscan', 'validation', 'analysis', 'rollups', 'reporting', 'storage'],
+}
+# Config values derived from other values, recomputed after the overrides
+DERIVED_CONFIG = {'MAX_EPS_KM': lambda: cfg.MAX_EPS_M/1000/6371.0088}
+# Columns of the processed AIS used by the analysis
+ANALYSIS_COLUMNS = ['sourcemmsi', 't', 'hours', 'lon', 'lat', 'shiptype', 'length', 'beam', 'draft']
 
 
 class mooring_dbscan:
-    def __init__(self, filepath, proj='epsg:3857'):
+    def __init__(self, filepath, proj=None):
         """
         Constructor for creating a mooring DBSCAN Instance.
         Parameters
 
-        geodf: GeoPandas dataframe
+        filepath: AIS CSV file
+        proj: metric CRS for clustering and the cluster polygons, None
+            uses the UTM zone of the berth visit centers
         ----------
         """
-        dtypes={'sourcemmsi': 'str', 'navigationalstatus': 'float32', 'rateofturn': 'float32', 'speedoverground': 'float32', 'courseoverground': 'float32', 
-                'trueheading': 'float32', 'lon':'float32', 'lat': 'float32', 't':'int64'}
-
-        df = pd.read_csv(filepath, dtype=dtypes)
-        #df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.lon, df.lat), crs='epsg:4326')
+        from preprocess import load_ais, port_bounds, vessel_type_mmsis
+        mmsis = vessel_type_mmsis() if cfg.FILTER_VESSEL_TYPES_ON_LOAD else None
+        df = load_ais(filepath, port_bounds(), mmsis)
         self.proj = proj
         self.data = df
-        self.data_dd = None
         self.clusters = None
 
 
@@ -34,41 +55,145 @@ class mooring_dbscan:
         self.data = data
 
     def set_clusters(self, clusters):
-        clusters = gpd.GeoDataFrame(clusters, crs='epsg:4326')
-        clusters.geometry = clusters.geometry.buffer(0.0003)
-        self.clusters = clusters
+        import geopandas as gpd
+        self.clusters = gpd.GeoDataFrame(clusters, crs='epsg:4326')
 
     def make_gdf(self):
+        import geopandas as gpd
         df = self.data
         self.set_data(gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.lon, df.lat), crs='epsg:4326'))
 
-if __name__ == "__main__":
-    start = datetime.now()
+def parse_override(text):
+    # KEY=VALUE with a Python literal value, other values are taken as strings
+    key, sep, value = text.partition('=')
+    if not sep or not hasattr(cfg, key):
+        raise argparse.ArgumentTypeError(f'expected KEY=VALUE with a key of lib/config.py, got {text!r}')
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return key, value
+
+def apply_overrides(overrides):
+    for key, value in overrides:
+        setattr(cfg, key, value)
+    keys = {key for key, _ in overrides}
+    for key, derive in DERIVED_CONFIG.items():
+        if key not in keys:
+            setattr(cfg, key, derive())
+
+def import_modules(names):
+    # Import the modules in order, returning the seconds each added
+    times = {}
+    for name in names:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        times[name] = time.perf_counter() - start
+    return times
+
+def print_import_times(command, times):
+    print(f'[{command}] imports: {sum(times.values()):.3f}s')
+    for name, seconds in times.items():
+        print(f'  {name:<12} {seconds:.3f}s')
+
+def preprocess_command(args):
+    from preprocess import load_ais, port_bounds, vessel_type_mmsis, preprocess_data, include_static_data
+    from storage import write_stage
+    print('[Stage 1 - Load/preprocess data] Preprocessing Input AIS...')
+    mmsis = vessel_type_mmsis() if cfg.FILTER_VESSEL_TYPES_ON_LOAD else None
+    df = load_ais(args.input, port_bounds(), mmsis)
+    df = preprocess_data(df)
+    df = include_static_data(df)
+    write_stage(df, cfg.PROCESSED_AIS)
+
+def cluster_command(args):
+    from dbscan import cached_centers, cached_polygons, dbscan_clusters, CENTER_COLUMNS
+    from storage import read_stage, write_polygons, stage_path
+    from cache import path_fingerprint
+    from validation import reference_available, validate_polygons, print_scores
+    print('[Stage 2 - Data Clustering] Clustering with DBSCAN...')
+    load = lambda: read_stage(cfg.PROCESSED_AIS, columns=CENTER_COLUMNS)
+    if cfg.USE_CACHE:
+        # The stage is only read when its centers are not cached yet
+        coords = cached_centers(path_fingerprint(stage_path(cfg.PROCESSED_AIS)), load)
+        polygons = cached_polygons(coords)
+    else:
+        polygons = dbscan_clusters(load())
+    write_polygons(polygons)
+    if reference_available():
+        print_scores(validate_polygons(polygons)[0])
+
+def label_command(args):
+    from analysis import add_clusters_to_data
+    from rollups import build_rollups, write_rollups
+    from storage import read_stage, read_polygons, write_stage
+    print('[Stage 3 - Adding cluster labels to AIS data] Adding cluster labels...')
+    df = add_clusters_to_data(read_stage(cfg.PROCESSED_AIS, columns=ANALYSIS_COLUMNS), read_polygons())
+    write_stage(df, cfg.LABELLED_AIS)
+    write_rollups(build_rollups(df))
+
+def analyze_command(args):
+    from analysis import report_aggregates
+    from reporting import render_report
+    from storage import read_stage
+    print('[Stage 4 - Analysis of AIS data] Running analysis steps on AIS data...')
+    render_report(report_aggregates(read_stage(cfg.LABELLED_AIS)))
+
+def run_command(args):
+    from preprocess import preprocess_data, include_static_data
+    from dbscan import dbscan_clusters
+    from validation import reference_available, validate_polygons, print_scores
+    from analysis import add_clusters_to_data, report_aggregates
+    from rollups import build_rollups, write_rollups
+    from reporting import render_report
+    from storage import write_polygons
     print('[Stage 1 - Load data] Loading Input AIS...')
-    moor = mooring_dbscan(cfg.AIS_CSV_IN)
-    interval1 = datetime.now()
-    print('[Time taken]:'+str(interval1-start))
+    moor = mooring_dbscan(args.input)
     print('[Stage 2 - Preprocess data] Preprocessing Input AIS...')
     moor.set_data(preprocess_data(moor.data))
     print('preprocess done...')
     moor.set_data(include_static_data(moor.data))
-    interval2 = datetime.now()
-    print('[Time taken]:'+str(interval2-interval1))
     print('[Stage 3 - Data Clustering] Clustering with DBSCAN...')
-    moor.set_clusters(dbscan_clusters(moor.data))
+    moor.set_clusters(dbscan_clusters(moor.data, crs=moor.proj))
 
-    moor.clusters.to_csv(cfg.POLYGON_CSV_OUT)
-    interval3 = datetime.now()
-    print('[Time taken]:'+str(interval3-interval2))
+    write_polygons(moor.clusters)
+    if reference_available():
+        print_scores(validate_polygons(moor.clusters)[0])
     print('[Stage 4 - Adding cluster labels to AIS data] Adding cluster labels...')
     moor.set_data(add_clusters_to_data(moor.data, moor.clusters))
-    interval4 = datetime.now()
-    print('[Time taken]:'+str(interval4-interval3))
+    write_rollups(build_rollups(moor.data))
     print('[Stage 5 - Analysis of AIS data] Running analysis steps on AIS data...')
-    
-    arrival_departing_analysis(moor.data)
-    ship_type_analysis(moor.data)
-    analysis_dataframe(moor.data)
-    interval5 = datetime.now()
-    print('[Time taken]:'+str(interval5-interval4))
-    print('[Total time]:'+str(interval5-start))
\ No newline at end of file
+    render_report(report_aggregates(moor.data))
+
+COMMANDS = {'preprocess': preprocess_command, 'cluster': cluster_command, 'label': label_command,
+            'analyze': analyze_command, 'run': run_command}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='mooring', description='Detect and analyze mooring clusters in AIS data')
+    parser.add_argument('command', nargs='?', default='run', choices=list(COMMANDS),
+                        help='stage to run, run (the default) runs the whole pipeline in memory')
+    parser.add_argument('-i', '--input', default=None, help='AIS CSV file, AIS_CSV_IN by default')
+    parser.add_argument('-c', '--config', dest='overrides', action='append', type=parse_override, default=[],
+                        metavar='KEY=VALUE', help='override a value of lib/config.py, can be repeated')
+    parser.add_argument('--profile-startup', action='store_true', help='only import the modules of the command and print the import times')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    apply_overrides(args.overrides)
+    args.input = args.input or cfg.AIS_CSV_IN
+    times = import_modules(COMMAND_MODULES[args.command])
+    if args.profile_startup:
+        print_import_times(args.command, times)
+        return
+    from profiling import start_profiling, stop_profiling, print_summary, write_profile
+    # Stage timings are always printed, the JSON report is written when cfg.PROFILE_OUT is set
+    start_profiling(prefix=os.path.splitext(cfg.PROFILE_OUT)[0] if cfg.PROFILE_OUT else None)
+    COMMANDS[args.command](args)
+    stop_profiling()
+    print_summary()
+    if cfg.PROFILE_OUT:
+        write_profile(cfg.PROFILE_OUT)
+
+if __name__ == "__main__":
+    main()
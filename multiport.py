@@ -0,0 +1,93 @@
+import pandas as pd
+import geopandas as gpd
+import sys, os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
+import config as cfg
+from preprocess import iter_ais, port_zones, preprocess_data, include_static_data
+from dbscan import dbscan_clusters
+from analysis import add_clusters_to_data, report_aggregates
+from reporting import render_report
+from storage import write_stage, read_stage, stage_exists, stage_path, write_polygons
+
+# Runs the pipeline for several ports in parallel. The AIS file is read once
+# and split into one Parquet stage per port inclusion zone, so every worker
+# reads only the rows of its own port instead of a copy of the whole input.
+
+PORT_STAGE = 'ports'
+
+def port_stage(port_name):
+    return os.path.join(PORT_STAGE, re.sub(r'\W+', '_', port_name).strip('_'))
+
+def split_ais_by_port(filepath, zones, chunksize=cfg.CSV_CHUNK_SIZE):
+    """
+    Stream the AIS CSV once and append the rows inside each port zone to the
+    stage of that port. Rows in overlapping zones go to every such port.
+    """
+    if stage_exists(PORT_STAGE):
+        shutil.rmtree(stage_path(PORT_STAGE))
+    counts = dict.fromkeys(zones, 0)
+    for chunk in iter_ais(filepath, chunksize=chunksize):
+        for port_name, (xmin, ymin, xmax, ymax) in zones.items():
+            port_rows = chunk[chunk.lon.between(xmin, xmax) & chunk.lat.between(ymin, ymax)]
+            if len(port_rows):
+                write_stage(port_rows, port_stage(port_name), partition_by=None, append=True)
+                counts[port_name] += len(port_rows)
+    return counts
+
+def run_port(port_name, bounds):
+    """
+    Preprocess, cluster, label and analyze one port. Runs in a worker
+    process, output files are prefixed with the port name.
+    """
+    # Workers are reused across ports, so the config is left untouched
+    prefix = str(cfg.FILE_PREFIX + '_' + os.path.basename(port_stage(port_name)))
+    df = read_stage(port_stage(port_name), geometry=False)
+    df = preprocess_data(df)
+    df = include_static_data(df, bounds=bounds)
+    polygons = dbscan_clusters(df)
+    df = add_clusters_to_data(df, polygons)
+    aggregates = report_aggregates(df)
+    # The ports already run in parallel, each renders its report in its own process
+    render_report(aggregates, prefix=prefix, max_workers=1)
+    return polygons, aggregates['results']
+
+def merge_port_results(port_results):
+    """
+    Combine the per-port polygons and result tables. Cluster ids are offset
+    port by port so they are unique over all ports, noise stays -1.
+    """
+    polygons, results = [], []
+    offset = 0
+    for port_name in sorted(port_results):
+        port_polygons, port_table = port_results[port_name]
+        port_polygons = port_polygons.copy()
+        port_table = port_table[port_table.index >= 0].copy()
+        clustered = port_polygons.cluster_id >= 0
+        port_polygons.loc[clustered, 'cluster_id'] += offset
+        port_polygons['port'] = port_name
+        port_table.index = port_table.index + offset
+        port_table.insert(0, 'Port', port_name)
+        polygons.append(port_polygons)
+        results.append(port_table)
+        offset += clustered.sum()
+    polygons = gpd.GeoDataFrame(pd.concat(polygons, ignore_index=True), crs='epsg:4326')
+    return polygons, pd.concat(results)
+
+def run_ports(filepath, port_names=cfg.MULTI_PORT_NAMES, max_workers=cfg.N_WORKERS):
+    zones = port_zones(port_names)
+    counts = split_ais_by_port(filepath, zones)
+    # Ports without AIS rows are skipped
+    zones = {port_name: bounds for port_name, bounds in zones.items() if counts[port_name]}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {port_name: pool.submit(run_port, port_name, bounds) for port_name, bounds in zones.items()}
+        port_results = {port_name: future.result() for port_name, future in futures.items()}
+    return merge_port_results(port_results)
+
+if __name__ == "__main__":
+    print('[Multi-port run] Running the pipeline for ' + str(len(cfg.MULTI_PORT_NAMES)) + ' ports...')
+    polygons, results = run_ports(cfg.AIS_CSV_IN)
+    write_polygons(polygons)
+    results.to_html(str(cfg.FILE_PREFIX + '_ports_results.html'))
@@ -0,0 +1,112 @@
+import pandas as pd
+import sys, os
+import shutil
+import dask
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
+import config as cfg
+from preprocess import iter_ais, port_bounds, vessel_type_mmsis, preprocess_data, include_static_data, load_static_data, sparse_columns
+from dbscan import berth_visit_centers, select_ship_types, polygons_from_centers, cached_polygons
+from analysis import (add_clusters_to_data, transition_hours, ship_type_counts, ship_type_table, analysis_arrays,
+                      result_aggregates, merge_result_aggregates, aggregate_results)
+from reporting import hour_matrix, render_report
+from rollups import build_rollups, merge_rollups, write_rollups
+from storage import write_stage, read_stage, stage_exists, stage_path, stage_buckets, write_polygons
+
+# Out-of-core mode for inputs larger than memory. The AIS CSV is streamed once
+# into a Parquet stage partitioned by MMSI bucket, so every ship is entirely
+# within one bucket and the per ship steps (speed, berth visits, visit
+# aggregates) stay partition local. The buckets are processed as Dask tasks on
+# the local scheduler in two passes:
+#
+#   1. preprocess a bucket, write it to the processed stage and return its
+#      berth visit centers; the centers of all buckets are clustered together
+#   2. label a bucket with the cluster polygons and return its aggregates;
+#      the buckets hold disjoint ships, so the merged result aggregates give
+#      the result table of the in-memory run
+#
+# Only the centers, the polygons and the aggregates are held by the driver.
+
+RAW_STAGE = 'ooc_raw'
+PROCESSED_STAGE = 'ooc_processed'
+
+def _clear_stage(name):
+    if stage_exists(name):
+        shutil.rmtree(stage_path(name))
+
+def partition_by_mmsi(filepath, bounds=None, mmsis=None, chunksize=cfg.CSV_CHUNK_SIZE):
+    # Stream the AIS CSV into the raw stage, one partition per MMSI bucket
+    _clear_stage(RAW_STAGE)
+    rows = 0
+    for chunk in iter_ais(filepath, bounds, mmsis, chunksize):
+        if len(chunk):
+            write_stage(chunk, RAW_STAGE, partition_by='sourcemmsi', append=True)
+            rows += len(chunk)
+    return rows
+
+def preprocess_bucket(bucket, static, bounds):
+    """
+    Preprocess the ships of one MMSI bucket, append them to the processed
+    stage and return their berth visit centers, the non-null counts of the
+    columns and the number of rows. Every bucket is written with all
+    columns so the stage has one schema; the columns with too many missing
+    values are dropped on read, decided over all buckets.
+    """
+    df = read_stage(RAW_STAGE, bucket=bucket)
+    df = preprocess_data(df)
+    df = include_static_data(df, static=static, bounds=bounds, drop_missing=False)
+    if len(df):
+        write_stage(df, PROCESSED_STAGE, partition_by='sourcemmsi', append=True)
+    return berth_visit_centers(select_ship_types(df)), df.notna().sum(), len(df)
+
+def label_bucket(bucket, polygons, columns):
+    # Cluster labels of one bucket reduced to the aggregates of the result tables and the rollups
+    df = read_stage(PROCESSED_STAGE, columns=columns, bucket=bucket)
+    df = add_clusters_to_data(df, polygons)
+    return result_aggregates(analysis_arrays(df)), transition_hours(df), ship_type_counts(df), build_rollups(df)
+
+def compute(tasks, scheduler=cfg.DASK_SCHEDULER, num_workers=cfg.N_WORKERS):
+    return dask.compute(*tasks, scheduler=scheduler, num_workers=num_workers)
+
+def cluster_centers(centers):
+    # Centers in the order of the in-memory run, so the cluster ids match it
+    centers = centers.sort_values(['sourcemmsi', 'start'], kind='stable')
+    coords = list(zip(centers.lat.values, centers.lon.values))
+    return cached_polygons(coords) if cfg.USE_CACHE else polygons_from_centers(coords)
+
+def _sum_counts(parts):
+    parts = [p for p in parts if len(p)]
+    return pd.concat(parts).groupby(level=list(range(parts[0].index.nlevels))).sum() if parts else pd.Series(dtype='int64')
+
+def run_out_of_core(filepath, static=None, bounds=None, mmsis=None):
+    """
+    Run the pipeline over `filepath` one MMSI bucket at a time. Renders the
+    report files, writes the rollups and returns the cluster polygons and the result table.
+    """
+    if static is None:
+        static = load_static_data()
+    if bounds is None:
+        bounds = port_bounds()
+    partition_by_mmsi(filepath, bounds, mmsis)
+    buckets = stage_buckets(RAW_STAGE)
+    _clear_stage(PROCESSED_STAGE)
+    processed = compute([dask.delayed(preprocess_bucket)(b, static, bounds) for b in buckets])
+    polygons = cluster_centers(pd.concat([p[0] for p in processed], ignore_index=True))
+    non_null = pd.concat([p[1] for p in processed], axis=1).sum(axis=1)
+    sparse = sparse_columns(non_null, sum(p[2] for p in processed))
+    columns = [c for c in non_null.index if c not in sparse]
+    parts = compute([dask.delayed(label_bucket)(b, polygons, columns) for b in stage_buckets(PROCESSED_STAGE)])
+    counts = _sum_counts([p[2][0] for p in parts])
+    counts = counts.sort_values(ascending=False, kind='stable').sort_index(level=0, kind='stable', sort_remaining=False)
+    results = aggregate_results(merge_result_aggregates([p[0] for p in parts]))
+    render_report({'arrivals': hour_matrix(_sum_counts([p[1][0] for p in parts])),
+                   'departures': hour_matrix(_sum_counts([p[1][1] for p in parts])),
+                   'ship_types': ship_type_table(counts, _sum_counts([p[2][1] for p in parts])),
+                   'results': results})
+    write_rollups(merge_rollups([p[3] for p in parts]))
+    return polygons, results
+
+if __name__ == "__main__":
+    print('[Out-of-core run] Running the pipeline per MMSI bucket with the ' + cfg.DASK_SCHEDULER + ' scheduler...')
+    mmsis = vessel_type_mmsis() if cfg.FILTER_VESSEL_TYPES_ON_LOAD else None
+    polygons, results = run_out_of_core(cfg.AIS_CSV_IN, mmsis=mmsis)
+    write_polygons(polygons)
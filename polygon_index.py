@@ -0,0 +1,90 @@
+import numpy as np
+import sys, os
+import pickle
+import shapely
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
+import config as cfg
+
+# Spatial index of the cluster polygons for labelling positions, e.g. live AIS
+# in a long running service. The polygons go into an STRtree and are prepared,
+# a lookup only builds the query points and tests the few candidate polygons
+# whose bounding box holds a point. The index file stores the polygons as WKB
+# with their ids; the tree and the prepared geometries cannot be pickled by
+# shapely and are rebuilt on load, which takes milliseconds for the few
+# hundred polygons of a port.
+
+INDEX_VERSION = 1
+
+class PolygonIndex:
+    def __init__(self, polygons, ids, default=-999):
+        self.polygons = np.asarray(polygons)
+        self.ids = np.asarray(ids)
+        self.default = default
+        self._build()
+
+    def _build(self):
+        shapely.prepare(self.polygons)
+        self.tree = shapely.STRtree(self.polygons)
+
+    @classmethod
+    def from_polygons(cls, polygons, id_column=None, default=-999):
+        # Index of a make_polygons frame, the noise polygon is left out
+        if id_column is None:
+            id_column = 'anchorage_id' if 'anchorage_id' in polygons else 'cluster_id'
+        polygons = polygons[polygons[id_column] >= 0]
+        return cls(polygons.geometry.values, polygons[id_column].values, default)
+
+    def lookup(self, lon, lat, chunk_size=None):
+        """
+        Return the id of the polygon each lon/lat position falls in (points
+        on an edge included), or the default id. When a point lies in
+        several polygons, the polygon that comes last wins. Point geometries
+        are only built for `chunk_size` points at a time (all at once when
+        None).
+        """
+        lon, lat = np.asarray(lon, dtype='float64'), np.asarray(lat, dtype='float64')
+        labels = np.full(len(lon), self.default, dtype=np.result_type(self.ids, np.asarray(self.default)))
+        if len(lon) == 0 or len(self.polygons) == 0:
+            return labels
+        chunk_size = chunk_size or len(lon)
+        for start in range(0, len(lon), chunk_size):
+            x, y = lon[start:start+chunk_size], lat[start:start+chunk_size]
+            # Bounding box candidates, then the exact test on the prepared polygons
+            point_idx, poly_idx = self.tree.query(shapely.points(x, y))
+            inside = shapely.intersects_xy(self.polygons[poly_idx], x[point_idx], y[point_idx])
+            point_idx, poly_idx = point_idx[inside], poly_idx[inside]
+            if len(point_idx) == 0:
+                continue
+            # Sort hits by point, then polygon, and keep the last polygon per point
+            order = np.lexsort((poly_idx, point_idx))
+            point_idx, poly_idx = point_idx[order], poly_idx[order]
+            last = np.r_[point_idx[1:] != point_idx[:-1], True]
+            labels[start + point_idx[last]] = self.ids[poly_idx[last]]
+        return labels
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def __getstate__(self):
+        return {'version': INDEX_VERSION, 'wkb': shapely.to_wkb(self.polygons), 'ids': self.ids, 'default': self.default}
+
+    def __setstate__(self, state):
+        if state.get('version') != INDEX_VERSION:
+            raise ValueError(f'Unsupported polygon index version: {state.get("version")}')
+        self.polygons = shapely.from_wkb(state['wkb'])
+        self.ids = state['ids']
+        self.default = state['default']
+        self._build()
+
+def index_path(polygon_path=None):
+    # The index is kept next to the polygon file it was built from
+    polygon_path = cfg.POLYGON_OUT if polygon_path is None else polygon_path
+    return os.path.splitext(polygon_path)[0] + '.index'
+
+def write_index(index, filepath=None):
+    with open(filepath or index_path(), 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_index(filepath=None):
+    with open(filepath or index_path(), 'rb') as f:
+        return pickle.load(f)
@@ -4,91 +4,157 @@ import numpy as np
 import sys, os
 sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
 import config as cfg
-from shapely import geometry
+from storage import write_stage
+from profiling import profiled
+from schema import AIS_DTYPES, STATIC_DTYPES, csv_dtypes, compact_frame
 
+def port_zones(port_names):
+    # Bounding boxes of the inclusion zones around the given ports
+    ports = gpd.read_file(cfg.PORT_FILE)
+    ports = ports[ports.PORT_NAME.isin(port_names)]
+    return {name: point.buffer(cfg.INCLUSION_ZONE).envelope.bounds for name, point in zip(ports.PORT_NAME, ports.geometry)}
+
+def port_bounds():
+    # Bounding box of the inclusion zone around the configured port
+    ports = gpd.read_file(cfg.PORT_FILE)
+    port_point = ports[ports.PORT_NAME.isin(cfg.PORT_NAME)].geometry.values[0]
+    circle_buffer = port_point.buffer(cfg.INCLUSION_ZONE)
+    return circle_buffer.envelope.bounds
+
+def vessel_type_mmsis(filepath=cfg.STATIC_CSV_IN):
+    # MMSIs that have reported a ship type within cfg.VESSEL_TYPES
+    static = pd.read_csv(filepath, usecols=['sourcemmsi', 'shiptype'], dtype={'sourcemmsi': 'int32', 'shiptype': 'float32'})
+    selected = np.zeros(len(static), dtype=bool)
+    for types in cfg.VESSEL_TYPES:
+        selected |= static.shiptype.between(types[0], types[1]).values
+    return set(static.sourcemmsi[selected].unique())
+
+def iter_ais(filepath, bounds=None, mmsis=None, chunksize=cfg.CSV_CHUNK_SIZE):
+    # Chunks of the AIS CSV in the compact schema, filtered like in load_ais
+    for chunk in pd.read_csv(filepath, dtype=csv_dtypes(AIS_DTYPES), usecols=list(AIS_DTYPES), chunksize=chunksize):
+        chunk = compact_frame(chunk)
+        if bounds is not None:
+            xmin, ymin, xmax, ymax = bounds
+            chunk = chunk[chunk.lon.between(xmin, xmax) & chunk.lat.between(ymin, ymax)]
+        if mmsis is not None:
+            chunk = chunk[chunk.sourcemmsi.isin(mmsis)]
+        yield chunk
+
+@profiled
+def load_ais(filepath, bounds=None, mmsis=None, chunksize=cfg.CSV_CHUNK_SIZE):
+    """
+    Read the AIS CSV in chunks and keep only rows inside `bounds` 
+    (xmin, ymin, xmax, ymax) and, if given, rows of the ships in `mmsis`.
+    Only the columns of AIS_DTYPES are read. Memory use is bounded by the
+    filtered output plus one chunk.
+    """
+    chunks = list(iter_ais(filepath, bounds, mmsis, chunksize))
+    if not chunks:
+        return pd.DataFrame({c: pd.Series(dtype=d) for c, d in AIS_DTYPES.items()})
+    return pd.concat(chunks, ignore_index=True)
+
+EARTH_RADIUS_M = 6371000
+
+def calculate_speed(codes, t, lon, lat):
+    """
+    Distance in meters and speed in m/s from the previous point of the same
+    ship. The arrays must be sorted by ship `codes` and then by `t`; the
+    first point of every ship gets NaN. Coordinates are differenced before
+    converting to radians, so float32 inputs keep sub-meter precision.
+    """
+    first = np.r_[True, codes[1:] != codes[:-1]]
+    dt = np.diff(t, prepend=t[:1]).astype(np.float32)
+    dlat = np.radians(np.diff(lat, prepend=lat[:1]))
+    dlon = np.radians(np.diff(lon, prepend=lon[:1]))
+    latrad = np.radians(lat)
+    lat_prev = np.r_[latrad[:1], latrad[:-1]]
+    a = np.sin(dlat/2)**2 + np.cos(latrad) * np.cos(lat_prev) * np.sin(dlon/2)**2
+    dist_m = (2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))) * np.float32(EARTH_RADIUS_M)
+    dist_m[first] = np.nan
+    dt[first] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = dist_m/dt
+    return dist_m, speed
+
+def ship_time_order(codes, t):
+    # Order by ship and time, through a single int64 key when it fits. Both sorts
+    # are stable, so rows with the same ship and time keep their input order
+    if len(t) == 0:
+        return np.arange(0)
+    t_min = t.min()
+    span = int(t.max() - t_min) + 1
+    if (int(codes.max()) + 1) * span < np.iinfo(np.int64).max:
+        return np.argsort(codes.astype(np.int64) * span + (t - t_min), kind='stable')
+    return np.lexsort((t, codes))
+
+@profiled
 def preprocess_data(df):
     #df.drop_duplicates(['sourcemmsi', 't'], inplace=True).compute()
-    # Filter out points outside port area
-    #df = df.copy()
-    df = df.sort_values('t')
-    # Time preprocessing
-    df['Date'] = pd.to_datetime(df.t, unit='s')
-    df['hours'] = df.Date.apply(lambda x: x.hour)
-    df['weekday'] = df.Date.apply(lambda x: x.weekday())
-    
-    def calculate_speed(df):
-        dt = df.groupby('sourcemmsi')['t'].diff().values
-        lon_prev = np.radians((df.groupby('sourcemmsi')['lon'].shift()).values)
-        lat_prev = np.radians((df.groupby('sourcemmsi')['lat'].shift()).values)
-        lonrad = np.radians(df['lon'])
-        latrad = np.radians(df['lat'])
-        dlon = lon_prev - lonrad 
-        dlat = lat_prev - latrad
-        a = np.sin(dlat/2)**2 + np.cos(latrad) * np.cos(lat_prev) * np.sin(dlon/2)**2
-        dist_m = (2 * np.arctan2(np.sqrt(a), np.sqrt(1-a)))*6371000
-        return dist_m/dt
-    df['speed'] = calculate_speed(df)
+    df = compact_frame(df)
+    # Sort once by ship and time, all per ship differences are taken on this order
+    codes = pd.factorize(df.sourcemmsi)[0]
+    order = ship_time_order(codes, df.t.values)
+    df = df.iloc[order].reset_index(drop=True)
+    codes = codes[order]
+    # Time preprocessing, straight from the epoch seconds (1970-01-01 was a Thursday)
+    df['hours'] = (df.t // 3600 % 24).astype('int8')
+    df['weekday'] = ((df.t // 86400 + 3) % 7).astype('int8')
+    _, speed = calculate_speed(codes, df.t.values, df.lon.values.astype(np.float32), df.lat.values.astype(np.float32))
     # Drop values where speed is significant and nav status 5
-    df.drop(df[(df.speed>1) & (df.navigationalstatus==5)].index, inplace=True)
-    df.reset_index(inplace=True)
+    df = df[~((speed>1) & (df.navigationalstatus==5).values)].reset_index(drop=True)
     return df
 
-def include_static_data(df):
-    # include dimensions
-    #df = df.copy()
-    dtypes = {'sourcemmsi': 'str', 'imonumber': 'float32', 'callsign':'str', 'shipname':'str', 
-        'shiptype': 'float32','tobow': 'float32', 'tostern': 'float32', 'tostarboard': 'float32', 'toport': 'float32', 'eta': 'str', 'draught': 'float32',
-        'destination': 'str', 'mothershipmmsi': 'str', 't': 'int64'}
-    static = pd.read_csv('lib/data/csv/static_data.csv', dtype=dtypes)
-    dfs = []
-    df = df.sort_values('t')
+def load_static_data(filepath=cfg.STATIC_CSV_IN):
+    # Only the static columns used by the pipeline are read
+    return compact_frame(pd.read_csv(filepath, dtype=csv_dtypes(STATIC_DTYPES), usecols=list(STATIC_DTYPES)))
+
+def merge_static_data(df, static):
+    """
+    Attach to every AIS point the static report of the same ship that is
+    nearest in time. Ships without static reports are dropped.
+    """
+    df = df[df.sourcemmsi.isin(static.sourcemmsi.unique())].sort_values('t')
     static = static.sort_values('t')
-    intersection = list(set(df.sourcemmsi.unique()) & set(static.sourcemmsi.unique()))
-    static_groups = static.groupby('sourcemmsi')
-    dynamic_groups = df.groupby('sourcemmsi')
-    for mmsi in intersection:
-        a = dynamic_groups.get_group(mmsi)
-        b = static_groups.get_group(mmsi)
-        c = pd.merge_asof(a, b, on='t', direction='nearest')
-        dfs.append(c)
-    df = pd.concat(dfs)
-    df.drop(columns = 'sourcemmsi_y', inplace=True)
-    df.rename(columns = {'sourcemmsi_x': 'sourcemmsi'}, inplace = True)
-    df.shiptype.fillna(0, inplace=True)
+    return pd.merge_asof(df, static, on='t', by='sourcemmsi', direction='nearest')
+
+def sparse_columns(non_null, rows):
+    # Columns with values in fewer than 80% of the rows, from the per column non-null counts
+    return list(non_null.index[non_null < rows * .80])
+
+@profiled
+def include_static_data(df, static=None, bounds=None, drop_missing=True):
+    # Without drop_missing every column is kept, e.g. when the sparse columns are decided over several parts
+    # include dimensions
+    if static is None:
+        static = load_static_data()
+    if bounds is None:
+        bounds = port_bounds()
+    df = merge_static_data(compact_frame(df), compact_frame(static))
+    df['shiptype'] = df.shiptype.fillna(0)
     df['length'] = df.tobow + df.tostern
     df['beam'] = df.tostarboard + df.toport
-    df = df.rename(columns = {'draught':'draft'})
-    df.sort_values('t', inplace=True)
+    df = df.drop(columns=['tobow', 'tostern', 'tostarboard', 'toport']).rename(columns = {'draught':'draft'})
     # Remove columns with m ore than 80% missing values
-    limitPer = len(df) * .80
-    df = df.dropna(thresh=limitPer, axis=1)
+    if drop_missing:
+        df = df.drop(columns=sparse_columns(df.notna().sum(), len(df)))
     df = df.drop_duplicates(['sourcemmsi', 't'])
     df = df.sort_values(['sourcemmsi', 't'])
-    df['prev_mmsi'] = df.sourcemmsi.shift()
-    df['new_berth'] = ((df.navigationalstatus.diff()!=0) | (df.sourcemmsi!=df.prev_mmsi))
-    df['berth_num'] = df.new_berth.cumsum()
-    df.reset_index(inplace=True)
-    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.lon, df.lat), crs='epsg:4326')
-    ports = gpd.read_file(cfg.PORT_FILE)
-    port_point = ports[ports.PORT_NAME.isin(cfg.PORT_NAME)].geometry.values[0]
-    # Create circle buffer from port points
-    distance = cfg.INCLUSION_ZONE
-    circle_buffer = port_point.buffer(distance)
-    xmin, ymin, xmax, ymax = circle_buffer.envelope.bounds
-    gdf = gdf.cx[xmin:xmax, ymin:ymax]
-    return gdf
+    # A berth visit is a run of rows of one ship with the same status, a missing status always starts a new one
+    mmsi = df.sourcemmsi.values
+    status = df.navigationalstatus.cat.codes.values
+    new_berth = np.r_[True, (mmsi[1:] != mmsi[:-1]) | (status[1:] != status[:-1])] | (status == -1) | np.r_[False, status[:-1] == -1]
+    df['berth_num'] = np.cumsum(new_berth).astype('int32')
+    xmin, ymin, xmax, ymax = bounds
+    df = df[df.lon.between(xmin, xmax) & df.lat.between(ymin, ymax)]
+    return df.reset_index(drop=True)
     
 if __name__ == "__main__":
     print('[Stage 1 - Load/preprocess data] Preprocessing Input AIS...')
-    dtypes={'sourcemmsi': 'str', 'navigationalstatus': 'float32', 'rateofturn': 'float32', 'speedoverground': 'float32', 'courseoverground': 'float32', 
-                'trueheading': 'float32', 'lon':'float32', 'lat': 'float32', 't':'int64'}
-
-    df = pd.read_csv(cfg.AIS_CSV_IN, dtype=dtypes)
+    mmsis = vessel_type_mmsis() if cfg.FILTER_VESSEL_TYPES_ON_LOAD else None
+    df = load_ais(cfg.AIS_CSV_IN, port_bounds(), mmsis)
     #df = df[df[' SHIPTYPE'] == 'CONTAINER SHIP']
     #df.rename(columns={' LON':'lon', ' LAT':'lat', 'MMSI':'sourcemmsi', ' TIMESTAMP_UTC': 't', ' STATUS': 'navigationalstatus'}, inplace=True)
     #df.t = df.t.astype('int')/(10**9)
     df = preprocess_data(df)
     df = include_static_data(df)
-    df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.lon, df.lat), crs='epsg:4326')
-    
-    #df.to_csv('processed_ais.csv')
+    write_stage(df, cfg.PROCESSED_AIS)
@@ -0,0 +1,137 @@
+import sys, os
+import json
+import time
+import resource
+import functools
+import cProfile
+import tracemalloc
+import threading
+from datetime import datetime
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
+import config as cfg
+
+# Per-stage instrumentation for the pipeline functions. Functions decorated
+# with @profiled record wall time, CPU time, peak RSS and rows in/out while
+# profiling is started, and are a plain call otherwise. Stages called from
+# other stages are recorded too, with their nesting depth. The depth is kept
+# per thread, stages run by the threaded Dask scheduler nest independently.
+
+_profile = {'active': False, 'cprofile': False, 'tracemalloc': False, 'prefix': None, 'stages': []}
+_local = threading.local()
+
+def start_profiling(use_cprofile=cfg.PROFILE_CPROFILE, use_tracemalloc=cfg.PROFILE_TRACEMALLOC, prefix=None):
+    """
+    Start recording stages. With `use_cprofile` every top-level stage is
+    profiled with cProfile and written to `<prefix>_<stage>.prof`, with
+    `use_tracemalloc` the peak Python allocation of top-level stages is
+    recorded.
+    """
+    _profile.update(active=True, cprofile=use_cprofile, tracemalloc=use_tracemalloc, prefix=prefix, stages=[])
+    if use_tracemalloc and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def stop_profiling():
+    _profile['active'] = False
+    if _profile['tracemalloc'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return _profile['stages']
+
+def _rows(value):
+    # Row count of frames, arrays and lists, None for anything else
+    if hasattr(value, 'shape') and len(getattr(value, 'shape')):
+        return int(value.shape[0])
+    if isinstance(value, list):
+        return len(value)
+    return None
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+def profiled(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _profile['active']:
+            return func(*args, **kwargs)
+        depth = getattr(_local, 'depth', 0)
+        top_level = depth == 0
+        record = {'stage': func.__name__, 'depth': depth, 'rows_in': _rows(args[0]) if args else None}
+        profiler = cProfile.Profile() if _profile['cprofile'] and _profile['prefix'] and top_level else None
+        if _profile['tracemalloc'] and top_level:
+            # reset_peak is new in Python 3.9, older versions restart tracing
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.stop()
+                tracemalloc.start()
+        rss_before = _peak_rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+        _local.depth = depth + 1
+        try:
+            if profiler is not None:
+                result = profiler.runcall(func, *args, **kwargs)
+            else:
+                result = func(*args, **kwargs)
+        finally:
+            _local.depth = depth
+        record['wall_s'] = time.perf_counter() - wall
+        record['cpu_s'] = time.process_time() - cpu
+        record['peak_rss_mb'] = _peak_rss_mb()
+        record['peak_rss_increase_mb'] = record['peak_rss_mb'] - rss_before
+        record['rows_out'] = _rows(result)
+        if _profile['tracemalloc'] and top_level:
+            record['tracemalloc_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024**2
+        if profiler is not None:
+            record['cprofile'] = str(_profile['prefix'] + '_' + func.__name__ + '.prof')
+            profiler.dump_stats(record['cprofile'])
+        _profile['stages'].append(record)
+        return result
+    return wrapper
+
+def print_summary():
+    # One line per top-level stage, nested stages are only in the JSON
+    for record in _profile['stages']:
+        if record['depth'] == 0:
+            print(f"[{record['stage']}] wall {record['wall_s']:.2f}s, cpu {record['cpu_s']:.2f}s, "
+                f"peak RSS {record['peak_rss_mb']:.0f} MB, rows {record['rows_in']} -> {record['rows_out']}")
+
+def write_profile(filepath=cfg.PROFILE_OUT):
+    # Stages in the order they finished, nested stages before their caller
+    report = {'created': datetime.now().isoformat(), 'input': cfg.AIS_CSV_IN, 'stages': _profile['stages']}
+    with open(filepath, 'w') as f:
+        json.dump(report, f, indent=2)
+
+def stage_totals(report):
+    totals = {}
+    for record in report['stages']:
+        total = totals.setdefault(record['stage'], {'wall_s': 0, 'cpu_s': 0, 'peak_rss_increase_mb': 0})
+        for key in total:
+            total[key] += record[key]
+    return totals
+
+def compare_profiles(baseline, current, threshold=0.2):
+    """
+    Compare two profile reports stage by stage. Returns the rows of stages
+    whose wall time, CPU time or RSS growth went up by more than
+    `threshold` (a fraction) from the baseline.
+    """
+    regressions = []
+    before, after = stage_totals(baseline), stage_totals(current)
+    for stage in sorted(set(before) & set(after)):
+        for key in ('wall_s', 'cpu_s', 'peak_rss_increase_mb'):
+            old, new = before[stage][key], after[stage][key]
+            if new > old * (1 + threshold) and new - old > cfg.PROFILE_MIN_DIFFERENCE[key]:
+                regressions.append({'stage': stage, 'metric': key, 'baseline': old, 'current': new})
+    return regressions
+
+if __name__ == "__main__":
+    # python profiling.py baseline.json current.json
+    with open(sys.argv[1]) as f:
+        baseline = json.load(f)
+    with open(sys.argv[2]) as f:
+        current = json.load(f)
+    regressions = compare_profiles(baseline, current)
+    for r in regressions:
+        print(f"{r['stage']:<30} {r['metric']:<22} {r['baseline']:10.2f} -> {r['current']:10.2f}")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,119 @@
+import pandas as pd
+import numpy as np
+import sys, os
+import json
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
+import config as cfg
+from cache import make_key
+from profiling import profiled
+
+# Rendering of the report files. The analysis reduces the labelled points to
+# small per-cluster aggregates (hour x cluster count matrices, tables of a row
+# per cluster), and every output file is rendered from one aggregate in a
+# worker process. The fingerprint of the aggregate each file was rendered
+# from is kept in a manifest next to the files, a file whose aggregate has not
+# changed since the last run is not rendered again.
+
+HOURS = 24
+
+def hour_matrix(counts):
+    # Cluster x hour count matrix of a (cluster, hours) indexed count Series
+    counts = counts[counts > 0]
+    if len(counts) == 0:
+        return pd.DataFrame(np.zeros((0, HOURS), dtype=np.int64), index=pd.Index([], name='cluster'), columns=pd.RangeIndex(HOURS, name='hours'))
+    clusters, rows = np.unique(counts.index.get_level_values(0).values, return_inverse=True)
+    matrix = np.zeros((len(clusters), HOURS), dtype=np.int64)
+    np.add.at(matrix, (rows, counts.index.get_level_values(1).values.astype(np.int64)), counts.values)
+    return pd.DataFrame(matrix, index=pd.Index(clusters, name='cluster'), columns=pd.RangeIndex(HOURS, name='hours'))
+
+def draw_hour_plot(matrix, title, filename):
+    # Plotting libraries are only imported when a plot is drawn. Reports are
+    # rendered without a display, also in worker processes.
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as plticker
+    fig, ax = plt.subplots()
+    loc = plticker.MultipleLocator(base=1.0)
+    ax.set_xlim(0,23)
+    ax.set_ylim(0,matrix.values.max(initial=0)+1)
+    ax.set_ylabel('count')
+    ax.set_xlabel('hour')
+    ax.xaxis.set_major_locator(loc)
+    # One line per cluster through the hours it has transitions in
+    for cluster, counts in zip(matrix.index, matrix.values):
+        hours = np.flatnonzero(counts)
+        line, = ax.plot(hours, counts[hours])
+        line.set_label(str('Cluster ' + str(cluster)))
+    ax.set_title(title, size=32)
+    lgd = ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.1),
+          fancybox=True, shadow=True, ncol=4)
+    fig.savefig(filename, bbox_extra_artists=(lgd,), bbox_inches='tight')
+    plt.close(fig)
+
+def write_table(table, filename):
+    table.to_html(filename)
+
+def draw_gantt_chart(visits, filename):
+    # Timeline of the visits, a row per cluster
+    import plotly.express as px
+    visits = visits.assign(date_min=pd.to_datetime(visits.start, unit='s'), date_max=pd.to_datetime(visits.end, unit='s'))
+    fig = px.timeline(visits, x_start='date_min', x_end='date_max', y='cluster', color='sourcemmsi')
+    fig.write_html(filename)
+
+# Output file suffix, renderer and arguments after the aggregate for every report aggregate
+RENDERERS = {
+    'arrivals': ('_arrival-plot.png', draw_hour_plot, ('Arrival hours',)),
+    'departures': ('_departure-plot.png', draw_hour_plot, ('Departure hours',)),
+    'ship_types': ('_ship_types.html', write_table, ()),
+    'results': ('_results.html', write_table, ()),
+    'visits': ('_gantt.html', draw_gantt_chart, ()),
+}
+
+def fingerprint(name, aggregate):
+    # Index and column names are part of the rendered output, so they are hashed too
+    frame = aggregate.reset_index() if isinstance(aggregate, pd.DataFrame) else aggregate
+    return make_key(name, RENDERERS[name][2], list(frame.columns.astype(str)), frame.dtypes.astype(str).tolist(), frame)
+
+def _render(name, aggregate, filename):
+    _, render, args = RENDERERS[name]
+    render(aggregate, *args, filename)
+    return name
+
+def _load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+@profiled
+def render_report(aggregates, prefix=None, max_workers=cfg.N_WORKERS):
+    """
+    Render the output file of every aggregate in `aggregates` (a dict with
+    keys of RENDERERS) to `prefix` + its suffix, in up to `max_workers`
+    processes (rendered in this process when 1). Files whose aggregate has
+    the same fingerprint as in the last run are skipped. Returns the names
+    of the rendered aggregates.
+    """
+    prefix = str(cfg.FILE_PREFIX if prefix is None else prefix)
+    manifest_path = prefix + '_report.json'
+    manifest = _load_manifest(manifest_path)
+    jobs = []
+    for name, aggregate in aggregates.items():
+        filename = prefix + RENDERERS[name][0]
+        key = fingerprint(name, aggregate)
+        if manifest.get(filename) == key and os.path.exists(filename):
+            continue
+        manifest.pop(filename, None)
+        jobs.append((name, aggregate, filename, key))
+    if max_workers == 1 or len(jobs) <= 1:
+        rendered = [_render(name, aggregate, filename) for name, aggregate, filename, _ in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(_render, name, aggregate, filename) for name, aggregate, filename, _ in jobs]
+            rendered = [future.result() for future in futures]
+    manifest.update({filename: key for _, _, filename, key in jobs})
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return rendered
@@ -0,0 +1,154 @@
+import pandas as pd
+import numpy as np
+import sys, os
+import argparse
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
+import config as cfg
+from schema import SHIP_TYPE
+from profiling import profiled
+from analysis import analysis_arrays, group_starts
+
+# Rollups of the labelled AIS, materialized after labelling so questions about
+# cluster use are answered without the AIS points:
+#
+#   visits     one row per stay of a ship in a cluster, with its arrival and
+#              departure time, ship type and dimensions
+#   occupancy  number of ships in a cluster per hour (epoch hour, so any time
+#              window can be selected) and ship type, with the hour of day
+#              and weekday of the hour
+#
+# A ship is counted in every hour between the arrival and departure of its
+# visit, also when it did not report in that hour, and once per hour when it
+# visits the same cluster several times within the hour.
+
+ROLLUP_TABLES = {
+    'visits': {'cluster': 'int32', 'sourcemmsi': 'int32', 'arrival': 'int64', 'departure': 'int64', 'shiptype': SHIP_TYPE,
+               'length': 'float32', 'beam': 'float32', 'draft': 'float32'},
+    'occupancy': {'hour': 'int32', 'cluster': 'int32', 'shiptype': SHIP_TYPE, 'hours': 'int8', 'weekday': 'int8', 'ships': 'int32'},
+}
+OCCUPANCY_KEYS = ['hour', 'cluster', 'shiptype']
+
+def empty_rollups():
+    return {name: pd.DataFrame({c: pd.Series(dtype=d) for c, d in dtypes.items()}) for name, dtypes in ROLLUP_TABLES.items()}
+
+def visit_table(arrays):
+    """
+    Visits of the ship and time ordered `arrays` of analysis_arrays. A
+    visit is a run of consecutive points of a ship in the same cluster, its
+    draft is the largest reported during it.
+    """
+    ships, clusters = arrays['ship'], arrays['cluster']
+    inside = clusters >= 0
+    new = np.r_[True, (ships[1:] != ships[:-1]) | (clusters[1:] != clusters[:-1])]
+    keys = np.cumsum(new)[inside]
+    if len(keys) == 0:
+        return empty_rollups()['visits']
+    starts = group_starts(keys)
+    t = arrays['t'][inside].astype(np.int64)
+    first = np.flatnonzero(inside)[starts]
+    visits = pd.DataFrame({'cluster': clusters[first], 'sourcemmsi': arrays['ship_ids'][ships[first]],
+                           'arrival': np.minimum.reduceat(t, starts), 'departure': np.maximum.reduceat(t, starts),
+                           'shiptype': arrays['shiptype'][first], 'length': arrays['length'][first], 'beam': arrays['beam'][first],
+                           'draft': np.fmax.reduceat(arrays['draft'][inside], starts)})
+    return visits.astype(ROLLUP_TABLES['visits'])
+
+def occupancy_table(visits):
+    # Ships per epoch hour, cluster and ship type from the hours every visit spans
+    first, last = visits.arrival.values // 3600, visits.departure.values // 3600
+    n_hours = last - first + 1
+    rows = np.repeat(np.arange(len(visits)), n_hours)
+    hour = first[rows] + np.arange(len(rows)) - np.repeat(np.cumsum(n_hours) - n_hours, n_hours)
+    hours = pd.DataFrame({'hour': hour.astype(np.int32), 'cluster': visits.cluster.values[rows],
+                          'sourcemmsi': visits.sourcemmsi.values[rows], 'shiptype': visits.shiptype.values.take(rows)})
+    hours = hours.drop_duplicates(['hour', 'cluster', 'sourcemmsi'])
+    occupancy = hours.groupby(OCCUPANCY_KEYS, observed=True, dropna=False).size().rename('ships').reset_index()
+    return with_calendar(occupancy)
+
+def with_calendar(occupancy):
+    # Hour of day and weekday (Monday is 0) of the epoch hours, in UTC like the hours column
+    occupancy = occupancy.sort_values(OCCUPANCY_KEYS, ignore_index=True)
+    occupancy['hours'] = occupancy.hour % 24
+    # 1 January 1970 was a Thursday
+    occupancy['weekday'] = (occupancy.hour // 24 + 3) % 7
+    return occupancy[list(ROLLUP_TABLES['occupancy'])].astype(ROLLUP_TABLES['occupancy'])
+
+@profiled
+def build_rollups(gdf):
+    # Visit and occupancy rollups of a labelled frame
+    visits = visit_table(analysis_arrays(gdf))
+    return {'visits': visits, 'occupancy': occupancy_table(visits)}
+
+def merge_rollups(parts):
+    """
+    Rollups of several parts with disjoint ships, e.g. the MMSI buckets of
+    an out-of-core run.
+    """
+    visits = pd.concat([p['visits'] for p in parts], ignore_index=True)
+    occupancy = pd.concat([p['occupancy'] for p in parts], ignore_index=True)
+    occupancy = occupancy.groupby(OCCUPANCY_KEYS, observed=True, dropna=False).ships.sum().reset_index()
+    return {'visits': visits.sort_values(['arrival', 'sourcemmsi'], ignore_index=True), 'occupancy': with_calendar(occupancy)}
+
+def write_rollups(rollups, rollup_dir=cfg.ROLLUP_DIR):
+    os.makedirs(rollup_dir, exist_ok=True)
+    for name, dtypes in ROLLUP_TABLES.items():
+        rollups[name][list(dtypes)].to_parquet(os.path.join(rollup_dir, name + '.parquet'), index=False)
+
+def read_rollups(rollup_dir=cfg.ROLLUP_DIR):
+    return {name: pd.read_parquet(os.path.join(rollup_dir, name + '.parquet')).astype(dtypes) for name, dtypes in ROLLUP_TABLES.items()}
+
+def epoch_seconds(value):
+    # Epoch seconds of a time given as seconds or as anything pd.Timestamp reads, naive times are UTC
+    if value is None or isinstance(value, (int, np.integer)):
+        return value
+    t = pd.Timestamp(value)
+    return int((t if t.tzinfo else t.tz_localize('UTC')).timestamp())
+
+def _selected(values, selection):
+    return np.ones(len(values), dtype=bool) if selection is None else np.isin(np.asarray(values), list(selection))
+
+def query_visits(visits, start=None, end=None, clusters=None, ship_types=None):
+    """
+    Visits overlapping the time window [`start`, `end`) to `clusters` by
+    ships of `ship_types` (None selects all).
+    """
+    start, end = epoch_seconds(start), epoch_seconds(end)
+    selected = _selected(visits.cluster.values, clusters) & _selected(visits.shiptype.values, ship_types)
+    if start is not None:
+        selected &= visits.departure.values >= start
+    if end is not None:
+        selected &= visits.arrival.values < end
+    return visits[selected]
+
+def query_occupancy(occupancy, start=None, end=None, clusters=None, ship_types=None, weekdays=None, hours=None, by=('cluster',)):
+    """
+    Ship hours spent in the clusters in the hours of the window [`start`,
+    `end`) that are on `weekdays` (Monday is 0) and `hours` of the day,
+    summed per `by` columns of the occupancy table. Divided by the number
+    of selected hours this is the mean number of ships present.
+    """
+    start, end = epoch_seconds(start), epoch_seconds(end)
+    # The table is sorted by hour, so the window is a slice of it
+    hour = occupancy.hour.values
+    lo = 0 if start is None else np.searchsorted(hour, start // 3600)
+    hi = len(hour) if end is None else np.searchsorted(hour, -(-end // 3600))
+    window = occupancy.iloc[lo:hi]
+    selected = (_selected(window.cluster.values, clusters) & _selected(window.shiptype.values, ship_types)
+                & _selected(window.weekday.values, weekdays) & _selected(window.hours.values, hours))
+    return window[selected].groupby(list(by), observed=True).ships.sum()
+
+if __name__ == "__main__":
+    # e.g. python rollups.py --start 2015-10-01 --end 2015-11-01 --clusters 12 --weekdays 0 1 2 3 4 --by hours
+    parser = argparse.ArgumentParser(description='Query the occupancy rollups of the last labelling run')
+    parser.add_argument('--start', default=None, help='window start, e.g. 2015-10-01')
+    parser.add_argument('--end', default=None, help='window end (excluded)')
+    parser.add_argument('--clusters', type=int, nargs='+', default=None)
+    parser.add_argument('--ship-types', type=int, nargs='+', default=None)
+    parser.add_argument('--weekdays', type=int, nargs='+', default=None, help='0 is Monday')
+    parser.add_argument('--hours', type=int, nargs='+', default=None, help='hours of the day')
+    parser.add_argument('--by', nargs='+', default=['cluster'], choices=['cluster', 'shiptype', 'hours', 'weekday', 'hour'])
+    args = parser.parse_args()
+    rollups = read_rollups()
+    ship_hours = query_occupancy(rollups['occupancy'], args.start, args.end, args.clusters, args.ship_types, args.weekdays, args.hours, args.by)
+    visits = query_visits(rollups['visits'], args.start, args.end, args.clusters, args.ship_types)
+    print(ship_hours.to_string())
+    print(f'{len(visits)} visits by {visits.sourcemmsi.nunique()} ships')
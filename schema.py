@@ -0,0 +1,41 @@
+import pandas as pd
+
+# Compact in-memory schema of the AIS frames. MMSIs are 9 digit numbers and
+# fit in int32, navigational statuses and ship types are small code lists kept
+# as categoricals (one byte per row) and coordinates are float32. Times stay
+# int64 seconds since the Unix epoch, as they are kept in stored stages and the
+# incremental history. Flags derived from these columns are computed where they
+# are used instead of being stored.
+
+# AIS navigational status codes 0-15, other values become NaN
+NAV_STATUS = pd.CategoricalDtype(categories=range(16))
+# Ordered so ranges of ship types can be selected with between()
+SHIP_TYPE = pd.CategoricalDtype(categories=range(100), ordered=True)
+
+AIS_DTYPES = {'sourcemmsi': 'int32', 'navigationalstatus': NAV_STATUS, 'lon': 'float32', 'lat': 'float32', 't': 'int64'}
+STATIC_DTYPES = {'sourcemmsi': 'int32', 'shiptype': SHIP_TYPE, 'tobow': 'float32', 'tostern': 'float32',
+    'tostarboard': 'float32', 'toport': 'float32', 'draught': 'float32', 't': 'int64'}
+# Columns added by the pipeline stages
+DERIVED_DTYPES = {'hours': 'int8', 'weekday': 'int8', 'berth_num': 'int32', 'length': 'float32', 'beam': 'float32',
+    'draft': 'float32', 'cluster': 'int32'}
+FRAME_DTYPES = dict(STATIC_DTYPES, **AIS_DTYPES, **DERIVED_DTYPES)
+
+def csv_dtypes(dtypes):
+    # Categoricals are read as numbers and cast by compact_frame, which drops unknown codes
+    return {c: 'float32' if isinstance(d, pd.CategoricalDtype) else d for c, d in dtypes.items()}
+
+def compact_frame(df):
+    """
+    Cast the known columns of `df` to the compact schema, for frames read
+    from other sources or written with an older schema. Columns that already
+    have their compact dtype are not copied.
+    """
+    dtypes = {c: d for c, d in FRAME_DTYPES.items() if c in df and df[c].dtype != d}
+    if not dtypes:
+        return df
+    if 'sourcemmsi' in dtypes and df.sourcemmsi.dtype.kind not in 'iuf':
+        df = df.assign(sourcemmsi=pd.to_numeric(df.sourcemmsi))
+    for c, d in dtypes.items():
+        if isinstance(d, pd.CategoricalDtype) and not isinstance(df[c].dtype, pd.CategoricalDtype):
+            df = df.assign(**{c: df[c].where(df[c].isin(d.categories))})
+    return df.astype(dtypes)
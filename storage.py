@@ -0,0 +1,110 @@
+import pandas as pd
+import geopandas as gpd
+import sys, os
+import shutil
+import uuid
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
+import config as cfg
+import pyarrow as pa
+import pyarrow.dataset as ds
+from schema import compact_frame
+from polygon_index import PolygonIndex, write_index, index_path
+
+# Columnar storage for the data passed between the pipeline stages. AIS points
+# are written as a Parquet dataset partitioned by day or by MMSI bucket and are
+# read back in the compact frame schema. The point geometry is not stored, it
+# can be rebuilt from lon/lat on read which is cheaper than decoding WKB.
+# Cluster polygons are written as GeoParquet (WKB), with a polygon index for
+# point lookups next to them.
+
+SECONDS_IN_DAY = 86400
+
+def stage_path(name):
+    return os.path.join(cfg.STAGE_DIR, name)
+
+def _partition_key(df, partition_by):
+    if partition_by == 'day':
+        return 'day', (df.t // SECONDS_IN_DAY).astype('int32')
+    if partition_by == 'sourcemmsi':
+        codes = pd.util.hash_array(df.sourcemmsi.astype(str).values) % cfg.MMSI_BUCKETS
+        return 'mmsi_bucket', codes.astype('int32')
+    raise ValueError(f'Unknown partitioning: {partition_by}')
+
+def write_stage(df, name, partition_by=cfg.STAGE_PARTITION, append=False):
+    """
+    Write AIS points to the stage dataset `name`, replacing the whole stage
+    unless `append` is set. `partition_by` is 'day', 'sourcemmsi' or None.
+    """
+    df = pd.DataFrame(df.drop(columns='geometry', errors='ignore'))
+    table_df = df.reset_index(drop=True)
+    partitioning = None
+    # pyarrow refuses to write more than 1024 partitions by default, under three years of days
+    max_partitions = 1024
+    if partition_by is not None:
+        key, values = _partition_key(table_df, partition_by)
+        table_df[key] = values
+        partitioning = ds.partitioning(pa.schema([(key, pa.int32())]), flavor='hive')
+        max_partitions = max(max_partitions, len(pd.unique(values)))
+    table = pa.Table.from_pandas(table_df, preserve_index=False)
+    if append:
+        # Unique file names so earlier files in the same partitions are kept
+        ds.write_dataset(table, stage_path(name), format='parquet', partitioning=partitioning, max_partitions=max_partitions,
+                         basename_template='part-' + uuid.uuid4().hex + '-{i}.parquet', existing_data_behavior='overwrite_or_ignore')
+    else:
+        # Partitions of an earlier run that this frame does not touch would otherwise be read with it
+        if stage_exists(name):
+            shutil.rmtree(stage_path(name))
+        ds.write_dataset(table, stage_path(name), format='parquet', partitioning=partitioning, max_partitions=max_partitions)
+
+def stage_exists(name):
+    return os.path.isdir(stage_path(name))
+
+def stage_buckets(name):
+    # MMSI buckets present in a stage written with partition_by='sourcemmsi'
+    return sorted(int(d.split('=')[1]) for d in os.listdir(stage_path(name)) if d.startswith('mmsi_bucket='))
+
+def read_stage(name, columns=None, start=None, end=None, geometry=False, bucket=None):
+    """
+    Read the stage dataset `name`. Only `columns` are read (columns missing
+    from the dataset are skipped) and only rows with start <= t < end, which
+    is pushed down to the Parquet reader and to the day partitions. With
+    `bucket` only that MMSI bucket is read. With `geometry` a GeoDataFrame
+    of the points is returned.
+    """
+    dataset = ds.dataset(stage_path(name), format='parquet', partitioning='hive')
+    if 't' in dataset.schema.names and dataset.schema.field('t').type != pa.int64():
+        # Stages written with int32 times are read with the int64 times of the schema
+        schema = dataset.schema.set(dataset.schema.get_field_index('t'), pa.field('t', pa.int64()))
+        dataset = ds.dataset(stage_path(name), schema=schema, format='parquet', partitioning='hive')
+    names = [n for n in dataset.schema.names if n not in ('day', 'mmsi_bucket')]
+    if columns is not None:
+        names = [n for n in columns if n in names]
+    if geometry and not {'lon', 'lat'} <= set(names) and {'lon', 'lat'} <= set(dataset.schema.names):
+        names = names + [c for c in ('lon', 'lat') if c not in names]
+    expr = None
+    if start is not None:
+        expr = ds.field('t') >= start
+        if 'day' in dataset.schema.names:
+            expr = expr & (ds.field('day') >= start // SECONDS_IN_DAY)
+    if end is not None:
+        end_expr = ds.field('t') < end
+        if 'day' in dataset.schema.names:
+            end_expr = end_expr & (ds.field('day') <= end // SECONDS_IN_DAY)
+        expr = end_expr if expr is None else expr & end_expr
+    if bucket is not None:
+        bucket_expr = ds.field('mmsi_bucket') == bucket
+        expr = bucket_expr if expr is None else expr & bucket_expr
+    df = compact_frame(dataset.to_table(columns=names, filter=expr).to_pandas())
+    if geometry:
+        return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.lon, df.lat), crs='epsg:4326')
+    return df
+
+def write_polygons(polygons, filepath=cfg.POLYGON_OUT):
+    polygons = gpd.GeoDataFrame(polygons)
+    if polygons.crs is None:
+        polygons = polygons.set_crs('epsg:4326')
+    polygons.to_parquet(filepath, index=False)
+    write_index(PolygonIndex.from_polygons(polygons), index_path(filepath))
+
+def read_polygons(filepath=cfg.POLYGON_OUT, columns=None):
+    return gpd.read_parquet(filepath, columns=columns)
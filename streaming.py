@@ -0,0 +1,165 @@
+import pandas as pd
+import sys, os
+import math
+import random
+import statistics
+from collections import OrderedDict, namedtuple
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
+import config as cfg
+from preprocess import iter_ais, port_bounds, vessel_type_mmsis, EARTH_RADIUS_M
+
+# Berth visits found from a time ordered stream of AIS messages, one message at
+# a time. A visit is segmented as in the batch pipeline: a run of messages of
+# one ship with navigational status 5, a moored message more than 1 m/s away
+# from the previous message of the ship is dropped, and a missing status ends
+# the run. A visit is emitted when it closes, with the median position of its
+# messages as its center.
+#
+# The visits are not filtered like the batch ones. There is no static data:
+# ships without static messages are kept (include_static_data drops them) and
+# ship types are not selected per message (select_ship_types); only the
+# MMSI filter given to iter_messages, e.g. vessel_type_mmsis, is applied. The
+# port bounding box given to iter_messages drops messages before they are
+# segmented, so a visit only holds the messages inside it.
+#
+# Only the last message and the open visit of every ship are kept. Ships are
+# evicted when silent for cfg.STREAM_IDLE_TIMEOUT seconds or when more than
+# cfg.STREAM_MAX_VESSELS ships are tracked, which closes their open visit.
+
+MOORED = 5
+
+Visit = namedtuple('Visit', ['sourcemmsi', 'start', 'end', 'lat', 'lon', 'points'])
+
+class _Vessel:
+    __slots__ = ('t', 'lon', 'lat', 'status', 'start', 'end', 'points', 'lons', 'lats')
+
+    def __init__(self):
+        self.t = None
+        self.status = -1
+        self.points = 0
+
+def _speed(t0, lon0, lat0, t1, lon1, lat1):
+    # Haversine speed in m/s, as calculate_speed in preprocess.py
+    dlat, dlon = math.radians(lat1 - lat0), math.radians(lon1 - lon0)
+    a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat0)) * math.sin(dlon/2)**2
+    dist_m = 2 * math.asin(math.sqrt(min(max(a, 0), 1))) * EARTH_RADIUS_M
+    # t1 > t0, update skips messages not later than the previous one of the ship
+    return dist_m / (t1 - t0)
+
+class BerthVisitDetector:
+    def __init__(self, idle_timeout=cfg.STREAM_IDLE_TIMEOUT, max_vessels=cfg.STREAM_MAX_VESSELS,
+                 median_sample=cfg.STREAM_MEDIAN_SAMPLE, seed=0):
+        self.idle_timeout = idle_timeout
+        self.max_vessels = max_vessels
+        self.median_sample = median_sample
+        self.rng = random.Random(seed)
+        # Least recently seen ship first
+        self.vessels = OrderedDict()
+        self.now = None
+
+    def _close(self, mmsi, vessel):
+        if vessel.status != MOORED or vessel.points == 0:
+            return None
+        visit = Visit(mmsi, vessel.start, vessel.end, statistics.median(vessel.lats), statistics.median(vessel.lons), vessel.points)
+        vessel.points, vessel.lons, vessel.lats = 0, None, None
+        return visit
+
+    def _add(self, vessel, t, lon, lat):
+        if vessel.points == 0:
+            vessel.start, vessel.lons, vessel.lats = t, [], []
+        vessel.end = t
+        vessel.points += 1
+        if len(vessel.lons) < self.median_sample:
+            vessel.lons.append(lon)
+            vessel.lats.append(lat)
+        else:
+            # Reservoir sample, every position of the visit is kept with equal probability
+            i = self.rng.randrange(vessel.points)
+            if i < self.median_sample:
+                vessel.lons[i], vessel.lats[i] = lon, lat
+
+    def _evict(self):
+        visits = []
+        while self.vessels:
+            mmsi, vessel = next(iter(self.vessels.items()))
+            if len(self.vessels) <= self.max_vessels and vessel.t >= self.now - self.idle_timeout:
+                break
+            del self.vessels[mmsi]
+            visit = self._close(mmsi, vessel)
+            if visit is not None:
+                visits.append(visit)
+        return visits
+
+    def update(self, mmsi, t, lon, lat, status):
+        """
+        Add one AIS message and return the visits it closed. Messages must
+        arrive in time order; a message not later than the previous one of
+        the same ship is skipped. A missing status is None, NaN or -1.
+        """
+        status = -1 if status is None or status != status else int(status)
+        vessel = self.vessels.get(mmsi)
+        if vessel is None:
+            vessel = self.vessels[mmsi] = _Vessel()
+        elif t <= vessel.t:
+            return []
+        else:
+            self.vessels.move_to_end(mmsi)
+        visits = []
+        moving = vessel.t is not None and _speed(vessel.t, vessel.lon, vessel.lat, t, lon, lat) > 1
+        vessel.t, vessel.lon, vessel.lat = t, lon, lat
+        if not (moving and status == MOORED):
+            # A new status, or a missing one, closes the open visit
+            if status != vessel.status or status == -1:
+                visit = self._close(mmsi, vessel)
+                if visit is not None:
+                    visits.append(visit)
+                vessel.status = status
+            if status == MOORED:
+                self._add(vessel, t, lon, lat)
+        if self.now is None or t > self.now:
+            self.now = t
+        return visits + self._evict()
+
+    def flush(self):
+        # Close the open visits of all ships, e.g. at the end of the stream
+        visits = [self._close(mmsi, vessel) for mmsi, vessel in self.vessels.items()]
+        self.vessels.clear()
+        return [v for v in visits if v is not None]
+
+def iter_messages(filepath, bounds=None, mmsis=None, chunksize=cfg.CSV_CHUNK_SIZE):
+    # (sourcemmsi, t, lon, lat, status) tuples of a time ordered AIS CSV, missing statuses are -1
+    for chunk in iter_ais(filepath, bounds, mmsis, chunksize):
+        yield from zip(chunk.sourcemmsi.tolist(), chunk.t.tolist(), chunk.lon.tolist(), chunk.lat.tolist(),
+                       chunk.navigationalstatus.cat.codes.tolist())
+
+def stream_visits(messages, detector=None):
+    """
+    Yield the berth visits of an iterable of (sourcemmsi, t, lon, lat,
+    status) messages as they close; the visits still open are yielded at
+    the end of the messages.
+    """
+    detector = detector or BerthVisitDetector()
+    for message in messages:
+        yield from detector.update(*message)
+    yield from detector.flush()
+
+async def queue_visits(queue, detector=None):
+    # As stream_visits for messages put on an asyncio queue, None ends the stream
+    detector = detector or BerthVisitDetector()
+    while (message := await queue.get()) is not None:
+        for visit in detector.update(*message):
+            yield visit
+    for visit in detector.flush():
+        yield visit
+
+def visits_frame(visits):
+    # Visits in the columns of dbscan.berth_visit_centers
+    visits = pd.DataFrame(list(visits), columns=Visit._fields)
+    return visits.astype({'sourcemmsi': 'int32', 'start': 'int64', 'end': 'int64', 'points': 'int64'})
+
+if __name__ == "__main__":
+    print('[Streaming visits] Detecting berth visits in ' + cfg.AIS_CSV_IN + '...')
+    mmsis = vessel_type_mmsis() if cfg.FILTER_VESSEL_TYPES_ON_LOAD else None
+    visits = visits_frame(stream_visits(iter_messages(cfg.AIS_CSV_IN, port_bounds(), mmsis)))
+    visits.to_csv(str(cfg.FILE_PREFIX + '_visits.csv'), index=False)
+    print(f'{len(visits)} berth visits written')
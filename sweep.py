@@ -0,0 +1,24 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
+import argparse
+import config as cfg
+from dbscan import dbscan_sweep, cached_centers, CENTER_COLUMNS, EARTH_RADIUS_KM
+from storage import read_stage, stage_path
+from cache import path_fingerprint
+from validation import reference_available, load_reference
+
+# Compares DBSCAN parameters on the berth visit centers of the processed_ais
+# stage, e.g. python sweep.py --eps 20 50 100 --min-samples 3 5
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DBSCAN epsilon and min_samples sweep')
+    parser.add_argument('--eps', type=float, nargs='+', required=True, help='epsilon values in meters, as cfg.MAX_EPS_M')
+    parser.add_argument('--min-samples', type=int, nargs='+', default=[cfg.MIN_SAMPLES])
+    args = parser.parse_args()
+    load = lambda: read_stage(cfg.PROCESSED_AIS, columns=CENTER_COLUMNS, geometry=False)
+    coords = cached_centers(path_fingerprint(stage_path(cfg.PROCESSED_AIS)), load)
+    # Every setting is scored against the reference quays when they are available
+    reference = load_reference() if reference_available() else None
+    results, _ = dbscan_sweep(coords, [eps/1000/EARTH_RADIUS_KM for eps in args.eps], args.min_samples, reference)
+    print(results.to_string(index=False))
+    results.to_html(str(cfg.FILE_PREFIX + '_sweep.html'), index=False)
@@ -0,0 +1,123 @@
+import pandas as pd
+import geopandas as gpd
+import numpy as np
+import sys, os
+import argparse
+from functools import lru_cache
+import shapely
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
+import config as cfg
+from profiling import profiled
+
+# Scoring of the cluster polygons against reference quay lines. The reference
+# is projected to meters and put in an STRtree once, every scoring is a few
+# bulk tree queries:
+#
+#   precision       share of the polygons within `tolerance` meters of a quay
+#   recall          share of the quays within `tolerance` meters of a polygon
+#   matched length  length of the quay lines within `tolerance` meters of a
+#                   polygon, against the total quay length
+#
+# and the distance from every polygon to its nearest quay, so polygons that do
+# not match show how far off they are.
+
+class QuayReference:
+    def __init__(self, quays, crs=None):
+        """
+        Reference of the quay geometries in the GeoDataFrame or GeoSeries
+        `quays` (WGS84 when it has no CRS). Distances are measured in `crs`,
+        by default the UTM zone of the quays.
+        """
+        quays = gpd.GeoSeries(quays.geometry if isinstance(quays, gpd.GeoDataFrame) else quays)
+        if quays.crs is None:
+            quays = quays.set_crs('epsg:4326')
+        quays = quays[~(quays.isna() | quays.is_empty)]
+        if len(quays) == 0:
+            raise ValueError('the reference holds no quay geometries')
+        self.crs = quays.estimate_utm_crs() if crs is None else crs
+        self.quays = np.asarray(quays.to_crs(self.crs).values)
+        self.lengths = shapely.length(self.quays)
+        self.tree = shapely.STRtree(self.quays)
+
+    @classmethod
+    def from_file(cls, path=cfg.VALIDATION_DATA, crs=None):
+        return cls(gpd.read_file(path), crs)
+
+    def project(self, polygons):
+        # Geometries of the cluster polygons (cluster -1 left out) in the reference CRS
+        if 'cluster_id' in polygons:
+            polygons = polygons[polygons.cluster_id.values >= 0]
+        geometry = polygons.geometry if polygons.crs is not None else polygons.geometry.set_crs('epsg:4326')
+        return np.asarray(geometry.to_crs(self.crs).values)
+
+    def matched_length(self, polygons, quay_idx, tolerance):
+        # Length of the quays within `tolerance` of the polygon they are paired with
+        order = np.argsort(quay_idx, kind='stable')
+        quay_idx = quay_idx[order]
+        pieces = shapely.intersection(self.quays[quay_idx], shapely.buffer(polygons[order], tolerance))
+        starts = np.flatnonzero(np.r_[True, quay_idx[1:] != quay_idx[:-1]]) if len(quay_idx) else np.arange(0)
+        ends = np.r_[starts[1:], len(quay_idx)]
+        # Pieces of a quay near several polygons may overlap, they are merged before measuring
+        lengths = [shapely.length(pieces[start]) if end - start == 1 else shapely.length(shapely.union_all(pieces[start:end]))
+                   for start, end in zip(starts, ends)]
+        return float(np.sum(lengths))
+
+    def score(self, polygons, tolerance=cfg.VALIDATION_TOLERANCE_M):
+        """
+        Summary scores of the cluster `polygons` (a GeoDataFrame as written
+        by write_polygons) and a frame with the matched quays and the
+        distance to the nearest quay in meters of every polygon.
+        """
+        geometries = self.project(polygons)
+        distance = np.full(len(geometries), np.nan)
+        pairs, nearest = self.tree.query_nearest(geometries, return_distance=True, all_matches=False)
+        distance[pairs[0]] = nearest
+        matched = distance <= tolerance
+        # Every quay near a polygon counts for the recall, not only the nearest
+        polygon_idx, quay_idx = self.tree.query(geometries[matched], predicate='dwithin', distance=tolerance)
+        matched_quays = np.unique(quay_idx)
+        matched_length = self.matched_length(geometries[matched][polygon_idx], quay_idx, tolerance)
+        ids = polygons.cluster_id.values[polygons.cluster_id.values >= 0] if 'cluster_id' in polygons else np.arange(len(geometries))
+        quays = np.zeros(len(geometries), dtype=np.int64)
+        quays[matched] = np.bincount(polygon_idx, minlength=matched.sum())
+        per_polygon = pd.DataFrame({'cluster_id': ids, 'quays': quays, 'nearest_quay_m': distance})
+        summary = {'polygons': len(geometries), 'quays': len(self.quays),
+                   'precision': matched.mean() if len(geometries) else np.nan,
+                   'recall': len(matched_quays) / len(self.quays),
+                   'matched_length_m': matched_length, 'quay_length_m': float(self.lengths.sum()),
+                   'median_unmatched_m': float(np.median(distance[~matched])) if (~matched).any() else np.nan}
+        return summary, per_polygon
+
+def reference_available(path=cfg.VALIDATION_DATA):
+    return path is not None and os.path.exists(path)
+
+@lru_cache(maxsize=4)
+def load_reference(path=cfg.VALIDATION_DATA):
+    # The reference of a file is read and indexed once per process
+    return QuayReference.from_file(path)
+
+@profiled
+def validate_polygons(polygons, reference=None, tolerance=cfg.VALIDATION_TOLERANCE_M):
+    """
+    Score `polygons` against `reference`, by default the quays of
+    cfg.VALIDATION_DATA. Returns the summary and the per polygon frame of
+    QuayReference.score.
+    """
+    reference = load_reference() if reference is None else reference
+    return reference.score(polygons, tolerance)
+
+def print_scores(summary):
+    print(f"[validation] {summary['polygons']} polygons, {summary['quays']} quays: precision {summary['precision']:.3f}, "
+          f"recall {summary['recall']:.3f}, matched quay length {summary['matched_length_m']:.0f} of {summary['quay_length_m']:.0f} m, "
+          f"median distance of unmatched polygons {summary['median_unmatched_m']:.0f} m")
+
+if __name__ == "__main__":
+    from storage import read_polygons
+    parser = argparse.ArgumentParser(description='Score the cluster polygons against reference quay data')
+    parser.add_argument('--polygons', default=cfg.POLYGON_OUT)
+    parser.add_argument('--reference', default=cfg.VALIDATION_DATA)
+    parser.add_argument('--tolerance', type=float, default=cfg.VALIDATION_TOLERANCE_M, help='meters')
+    args = parser.parse_args()
+    summary, per_polygon = validate_polygons(read_polygons(args.polygons), load_reference(args.reference), args.tolerance)
+    print_scores(summary)
+    per_polygon.to_html(str(cfg.FILE_PREFIX + '_validation.html'), index=False)